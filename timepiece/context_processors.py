@@ -1,11 +1,11 @@
-from django.db.models import Q
+from django.db.models import Max
 from django.conf import settings
+from django.utils.functional import SimpleLazyObject
 
 from timepiece import utils
 from timepiece.crm.forms import QuickSearchForm
 
 from timepiece.crm.models import Project
-from timepiece.entries.models import Entry
 
 
 def quick_search(request):
@@ -14,38 +14,47 @@ def quick_search(request):
     }
 
 
+def get_quick_clock_in_projects(user):
+    """
+    Returns (work_projects, leave_projects) for the user's quick clock in
+    menu: the 10 trackable projects which the user most recently clocked in
+    to, and the trackable paid leave projects which the user is assigned to.
+    """
+    cache = utils.get_quick_clock_in_cache()
+    key = utils.get_quick_clock_in_key(user.pk) if cache else None
+    projects = cache.get(key) if cache else None
+    if projects is None:
+        leave_ids = utils.get_setting('TIMEPIECE_PAID_LEAVE_PROJECTS').values()
+        trackable = Project.trackable.select_related('business')
+
+        work_projects = trackable.filter(entries__user=user)
+        work_projects = work_projects.exclude(id__in=leave_ids)
+        work_projects = work_projects.annotate(
+            last_clocked_in=Max('entries__start_time'))
+        work_projects = work_projects.order_by('-last_clocked_in', 'name')[:10]
+
+        leave_projects = trackable.filter(users=user, id__in=leave_ids)
+        leave_projects = leave_projects.order_by('name')
+
+        projects = (list(work_projects), list(leave_projects))
+        if cache:
+            cache.set(key, projects)
+    return projects
+
+
 def quick_clock_in(request):
     user = request.user
-    work_projects = []
-    leave_projects = []
-
-    if user.is_authenticated() and user.is_active:
-        # Display all active paid leave projects that the user is assigned to.
-        leave_ids = utils.get_setting('TIMEPIECE_PAID_LEAVE_PROJECTS').values()
-        lq = Q(users=user) & Q(id__in=leave_ids)
-        leave_projects = Project.trackable.filter(lq).order_by('name')
-
-        # Get all projects this user has clocked in to.
-        entries = Entry.objects.filter(user=user)
-        project_ids = list(entries.values_list('project', flat=True))
-
-        # Narrow to projects which can still be clocked in to.
-        pq = Q(id__in=project_ids)
-        valid_projects = Project.trackable.filter(pq).exclude(id__in=leave_ids)
-        valid_ids = list(valid_projects.values_list('id', flat=True))
-
-        # Display the 10 projects this user most recently clocked into.
-        work_ids = []
-        for i in project_ids:
-            if len(work_ids) > 10:
-                break
-            if i in valid_ids and i not in work_ids:
-                work_ids.append(i)
-        work_projects = [valid_projects.get(pk=i) for i in work_ids]
+    if not (user.is_authenticated() and user.is_active):
+        return {
+            'leave_projects': [],
+            'work_projects': [],
+        }
 
+    # The projects are only looked up if the template uses them.
+    projects = SimpleLazyObject(lambda: get_quick_clock_in_projects(user))
     return {
-        'leave_projects': leave_projects,
-        'work_projects': work_projects,
+        'leave_projects': SimpleLazyObject(lambda: projects[1]),
+        'work_projects': SimpleLazyObject(lambda: projects[0]),
     }
 
 
@@ -1,5 +1,6 @@
 from collections import OrderedDict
 import datetime
+from timeit import default_timer
 
 from dateutil.relativedelta import relativedelta
 
@@ -8,14 +9,56 @@ from django.contrib.sites.models import Site
 from django.core.exceptions import ValidationError
 from django.core.mail import send_mail
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import connections, models, transaction
 from django.db.models import Sum
 from django.db.models.expressions import F, Func, Value
 from django.template.loader import render_to_string
 from django.utils.encoding import python_2_unicode_compatible
 
 from timepiece import utils
-from timepiece.entries.models import Entry
+from timepiece.crm.timesheet import capture_snapshots
+from timepiece.entries.models import Activity, Entry
+
+
+class ProjectContractQuerySet(models.QuerySet):
+
+    def with_metrics(self):
+        """
+        Selects each contract's approved and pending contracted hours and its
+        billable and non-billable hours worked, with correlated subqueries,
+        so that a list of contracts doesn't need queries for each one.
+        """
+        qn = connections[self.db].ops.quote_name
+        tables = {
+            'contract': qn(self.model._meta.db_table),
+            'contract_hour': qn(ContractHour._meta.db_table),
+            'contract_projects': qn(self.model.projects.through._meta.db_table),
+            'entry': qn(Entry._meta.db_table),
+            'activity': qn(Activity._meta.db_table),
+        }
+        hours_sql = (
+            'SELECT COALESCE(SUM({contract_hour}.hours), 0) FROM {contract_hour} '
+            'WHERE {contract_hour}.contract_id = {contract}.id '
+            'AND {contract_hour}.status = %s').format(**tables)
+        # The same entries as ProjectContract.entries.
+        worked_sql = (
+            'SELECT COALESCE(SUM({entry}.hours), 0) FROM {entry} '
+            'INNER JOIN {activity} ON {activity}.id = {entry}.activity_id '
+            'WHERE {entry}.project_id IN ('
+            'SELECT {contract_projects}.project_id FROM {contract_projects} '
+            'WHERE {contract_projects}.projectcontract_id = {contract}.id) '
+            'AND {entry}.start_time >= {contract}.start_date '
+            'AND {entry}.end_time < {contract}.end_date + 1 '
+            'AND {activity}.billable = %s').format(**tables)
+        select = OrderedDict((
+            ('_contracted', hours_sql),
+            ('_pending', hours_sql),
+            ('_worked', worked_sql),
+            ('_nb_worked', worked_sql),
+        ))
+        params = [ContractHour.APPROVED_STATUS, ContractHour.PENDING_STATUS,
+                  True, False]
+        return self.extra(select=select, select_params=params)
 
 
 @python_2_unicode_compatible
@@ -47,6 +90,8 @@ class ProjectContract(models.Model):
         choices=CONTRACT_STATUS.items(), default=STATUS_UPCOMING, max_length=32)
     type = models.IntegerField(choices=PROJECT_TYPE.items())
 
+    objects = ProjectContractQuerySet.as_manager()
+
     class Meta:
         ordering = ('-end_date',)
         verbose_name = 'contract'
@@ -65,24 +110,36 @@ class ProjectContract(models.Model):
         """
         Given a set of entries, exclude those included in any contract affiliated
         with any project associated with this contract.
+
+        This is a single NOT EXISTS against the date windows of those
+        contracts, rather than a query for each project and contract.
         """
-        contracts = []
-        for project in self.projects.all():
-            contracts.extend(project.contracts.all())
-
-        for contract in contracts:
-            entries.exclude(
-                project__in=contract.projects.all(),
-                start_time__gte=contract.start_date,
-                end_time__lt=contract.end_date + relativedelta(days=1)
-                )
-        return entries
+        qn = connections[entries.db].ops.quote_name
+        tables = {
+            'contract': qn(self._meta.db_table),
+            'contract_projects': qn(self.projects.through._meta.db_table),
+            'entry': qn(entries.model._meta.db_table),
+        }
+        sql = (
+            'NOT EXISTS (SELECT 1 FROM {contract} sibling '
+            'INNER JOIN {contract_projects} sibling_projects '
+            'ON sibling_projects.projectcontract_id = sibling.id '
+            'WHERE sibling_projects.project_id = {entry}.project_id '
+            'AND {entry}.start_time >= sibling.start_date '
+            'AND {entry}.end_time < sibling.end_date + 1 '
+            'AND sibling.id IN ('
+            'SELECT shared.projectcontract_id FROM {contract_projects} shared '
+            'INNER JOIN {contract_projects} own '
+            'ON own.project_id = shared.project_id '
+            'WHERE own.projectcontract_id = %s))').format(**tables)
+        return entries.extra(where=[sql], params=[self.pk])
 
     @property
     def pre_launch_entries(self):
         entries = Entry.objects.filter(
             project__in=self.projects.all(),
             start_time__lt=self.start_date,)
+        entries = entries.select_related('user', 'project__business')
         return self.get_noncontract_entries(entries)
 
     @property
@@ -105,8 +162,25 @@ class ProjectContract(models.Model):
         entries = Entry.objects.filter(
             project__in=self.projects.all(),
             start_time__gt=self.end_date + relativedelta(days=1),)
+        entries = entries.select_related('user', 'project__business')
         return self.get_noncontract_entries(entries)
 
+    def get_project_hours(self):
+        """
+        Returns the projects in this contract, each with the billable_hours
+        and nonbillable_hours worked on it during the contract period. The
+        hours for every project are totaled with one grouped query.
+        """
+        hours = self.entries.values('project', 'activity__billable')
+        hours = hours.annotate(s=Sum('hours')).order_by()
+        totals = dict(((h['project'], h['activity__billable']), h['s'])
+                      for h in hours)
+        projects = list(self.projects.all())
+        for project in projects:
+            project.billable_hours = totals.get((project.pk, True)) or 0
+            project.nonbillable_hours = totals.get((project.pk, False)) or 0
+        return projects
+
     def contracted_hours(self, approved_only=True):
         """Compute the hours contracted for this contract.
         (This replaces the old `num_hours` field.)
@@ -118,6 +192,11 @@ class ProjectContract(models.Model):
         :rtype: Decimal
         """
 
+        if hasattr(self, '_contracted'):
+            # Selected by ProjectContract.objects.with_metrics().
+            if approved_only:
+                return self._contracted
+            return self._contracted + self.pending_hours()
         qset = self.contract_hours
         if approved_only:
             qset = qset.filter(status=ContractHour.APPROVED_STATUS)
@@ -126,6 +205,8 @@ class ProjectContract(models.Model):
 
     def pending_hours(self):
         """Compute the contract hours still in pending status"""
+        if hasattr(self, '_pending'):
+            return self._pending
         qset = self.contract_hours.filter(status=ContractHour.PENDING_STATUS)
         result = qset.aggregate(sum=Sum('hours'))['sum']
         return result or 0
@@ -165,7 +246,6 @@ class ProjectContract(models.Model):
     def hours_worked(self):
         """Number of billable hours worked on the contract."""
         if not hasattr(self, '_worked'):
-            # TODO put this in a .extra w/a subselect
             entries = self.entries.filter(activity__billable=True)
             self._worked = entries.aggregate(s=Sum('hours'))['s'] or 0
         return self._worked or 0
@@ -174,7 +254,6 @@ class ProjectContract(models.Model):
     def nonbillable_hours_worked(self):
         """Number of non-billable hours worked on the contract."""
         if not hasattr(self, '_nb_worked'):
-            # TODO put this in a .extra w/a subselect
             entries = self.entries.filter(activity__billable=False)
             self._nb_worked = entries.aggregate(s=Sum('hours'))['s'] or 0
         return self._nb_worked or 0
@@ -184,8 +263,9 @@ class ProjectContract(models.Model):
         """Fraction of contracted hours that have been worked.  E.g.
         if 50 hours have been worked of 100 contracted, value is 0.5.
         """
-        if self.contracted_hours():
-            return float(self.hours_worked) / float(self.contracted_hours())
+        contracted_hours = self.contracted_hours()
+        if contracted_hours:
+            return float(self.hours_worked) / float(contracted_hours)
         return 0.0
 
     @property
@@ -332,6 +412,34 @@ class ContractHour(models.Model):
             self._send_mail(subject, ctx)
 
 
+class ContractAssignmentQuerySet(models.QuerySet):
+
+    def with_hours_worked(self):
+        """
+        Selects the hours each assignment's user worked on the contract's
+        projects during the assignment, so hours_worked doesn't need a query
+        for each assignment.
+        """
+        qn = connections[self.db].ops.quote_name
+        tables = {
+            'assignment': qn(self.model._meta.db_table),
+            'contract_projects': qn(
+                ProjectContract.projects.through._meta.db_table),
+            'entry': qn(Entry._meta.db_table),
+        }
+        # The same entries as ContractAssignment.entries.
+        sql = (
+            'SELECT COALESCE(SUM({entry}.hours), 0) FROM {entry} '
+            'WHERE {entry}.user_id = {assignment}.user_id '
+            'AND {entry}.project_id IN ('
+            'SELECT {contract_projects}.project_id FROM {contract_projects} '
+            'WHERE {contract_projects}.projectcontract_id = '
+            '{assignment}.contract_id) '
+            'AND {entry}.start_time >= {assignment}.start_date '
+            'AND {entry}.end_time < {assignment}.end_date + 1').format(**tables)
+        return self.extra(select={'_worked': sql})
+
+
 @python_2_unicode_compatible
 class ContractAssignment(models.Model):
     contract = models.ForeignKey(ProjectContract, related_name='assignments')
@@ -341,6 +449,8 @@ class ContractAssignment(models.Model):
     num_hours = models.DecimalField(max_digits=8, decimal_places=2, default=0)
     min_hours_per_week = models.IntegerField(default=0)
 
+    objects = ContractAssignmentQuerySet.as_manager()
+
     class Meta:
         unique_together = (('contract', 'user'),)
         db_table = 'timepiece_contractassignment'  # Using legacy table name.
@@ -369,46 +479,51 @@ class ContractAssignment(models.Model):
 class HourGroupManager(models.Manager):
 
     def summaries(self, entries):
-        # Get the list of bundle names and hour sums
-        bundled_entries = entries.values('activity__activity_bundle',
-                                         'activity__activity_bundle__name')
-        bundled_entries = bundled_entries.annotate(hours__sum=Sum(
-            Func(F('hours'), Value(2), function='ROUND'))
+        """
+        Returns the hours of the entries totaled by hour group, as a list of
+        (name, (hours, [(activity name, hours), ...])) sorted by name.
+        Activities not in any hour group are totaled as 'Other', and the
+        last item is the 'Total' of all of the entries.
+        """
+        return self._get_summaries(self._get_activity_totals(entries))
+
+    def billing_summaries(self, entries):
+        """
+        Returns the summaries of the billable and non-billable entries, in
+        that order, using one grouped query for both.
+        """
+        rows = self._get_activity_totals(entries, ('activity__billable',))
+        return (
+            self._get_summaries(r for r in rows if r['activity__billable']),
+            self._get_summaries(r for r in rows if not r['activity__billable']),
         )
-        bundled_entries = bundled_entries.order_by(
-            'activity__activity_bundle__order', 'activity__activity_bundle__name')
-        bundled_totals = list(bundled_entries.values_list(
-            'activity__activity_bundle__name',
-            'activity__activity_bundle',
-            'hours__sum',
-        ))
-        # Get the list of activity names and hour sums
-        activity_entries = entries.values('activity', 'activity__name',
-                                          'activity__activity_bundle')
-        activity_entries = activity_entries.annotate(hours__sum=Sum(
+
+    def _get_activity_totals(self, entries, values=()):
+        """Totals the rounded hours for each activity and hour group."""
+        totals = entries.values('activity', 'activity__name',
+                                'activity__activity_bundle',
+                                'activity__activity_bundle__name', *values)
+        totals = totals.annotate(hours__sum=Sum(
             Func(F('hours'), Value(2), function='ROUND'))
         )
-        activity_entries = activity_entries.order_by('activity')
-        activity_totals = list(activity_entries.values_list(
-            'activity__name',
-            'activity__activity_bundle',
-            'hours__sum',
-        ))
-        totals = {}
-        other_values = ()
-        for bundle in bundled_totals:
-            bundle_key, bundle_value = bundle[0], bundle[2]
-            act_values = [(act[0], act[2]) for act in activity_totals
-                          if act[1] == bundle[1]]
-            if bundle_key is not None:
-                totals[bundle_key] = (bundle_value, act_values)
-            else:
-                other_values = (bundle_value, act_values)
-        totals = sorted(totals.items())
-        if other_values:
-            totals.append(('Other', other_values))
-        all_totals = sum([bt[2] for bt in bundled_totals])
-        totals.append(('Total', (all_totals, [])))
+        return list(totals.order_by('activity'))
+
+    def _get_summaries(self, rows):
+        bundles = {}
+        activities = {}
+        for row in rows:
+            name = row['activity__activity_bundle__name']
+            bundle = bundles.setdefault(name, [0, []])
+            bundle[0] += row['hours__sum']
+            bundle[1].append((row['activity__name'], row['hours__sum']))
+            # An activity in several hour groups is only counted once in
+            # the total.
+            activities[row['activity']] = row['hours__sum']
+        other = bundles.pop(None, None)
+        totals = sorted((name, tuple(bundle)) for name, bundle in bundles.items())
+        if other:
+            totals.append(('Other', tuple(other)))
+        totals.append(('Total', (sum(activities.values()), [])))
         return totals
 
 
@@ -429,6 +544,77 @@ class HourGroup(models.Model):
         return self.name
 
 
+class EntryGroupManager(models.Manager):
+
+    def get_billable_entries(self, to_date, from_date=None):
+        """
+        Returns the approved entries on billable projects which ended during
+        the billing period, including all of to_date.
+        """
+        entries = Entry.no_join.filter(
+            status=Entry.APPROVED, end_time__lt=to_date + relativedelta(days=1),
+            project__type__billable=True, project__status__billable=True)
+        if from_date:
+            entries = entries.filter(end_time__gte=from_date)
+        return entries
+
+    def create_invoices(self, user, to_date, from_date=None, projects=None,
+                        status=Entry.INVOICED, chunk_size=50):
+        """
+        Creates an invoice for each billable project with approved entries in
+        the billing period, and attaches the entries to it.
+
+        Projects are invoiced chunk_size at a time, each chunk in its own
+        transaction. The entries in a chunk are locked with SKIP LOCKED, so
+        runs in parallel, and the create_invoice view, invoice different
+        entries rather than waiting for or duplicating each other. Yields a
+        list of (invoice, number of entries, seconds taken) for each chunk.
+        """
+        entries = self.get_billable_entries(to_date, from_date)
+        if projects is not None:
+            entries = entries.filter(project__in=projects)
+        project_ids = sorted(set(
+            entries.order_by().values_list('project', flat=True).distinct()))
+        for i in range(0, len(project_ids), chunk_size):
+            yield self._invoice_projects(
+                entries, project_ids[i:i + chunk_size], user=user,
+                status=status, start=from_date, end=to_date)
+
+    def _invoice_projects(self, entries, project_ids, **invoice_data):
+        results = []
+        with transaction.atomic(using=self.db):
+            # Another run may have invoiced some of the entries before they
+            # were locked, or still hold them.
+            locked = OrderedDict()
+            for pk, project_id in self._lock_entries(
+                    entries.filter(project__in=project_ids)):
+                locked.setdefault(project_id, []).append(pk)
+            for project_id, pks in locked.items():
+                began = default_timer()
+                invoice = self.create(project_id=project_id, **invoice_data)
+                num_entries = Entry.no_join.filter(pk__in=pks).update(
+                    status=invoice.status, entry_group=invoice)
+                capture_snapshots(Entry.no_join.filter(entry_group=invoice))
+                results.append((invoice, num_entries, default_timer() - began))
+        return results
+
+    def _lock_entries(self, entries):
+        """
+        Locks the entries which aren't locked by another transaction, the
+        same rows create_invoice locks. Returns their (pk, project) pairs,
+        ordered by project.
+        """
+        entries = entries.using(self.db).order_by('project__id', 'pk')
+        sql, params = entries.values_list('pk', 'project').query.sql_with_params()
+        # Only the entries are locked, not the projects and their types and
+        # statuses they are filtered by.
+        table = connections[self.db].ops.quote_name(Entry._meta.db_table)
+        sql = '{0} FOR UPDATE OF {1} SKIP LOCKED'.format(sql, table)
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+
 @python_2_unicode_compatible
 class EntryGroup(models.Model):
     INVOICED = Entry.INVOICED
@@ -450,6 +636,8 @@ class EntryGroup(models.Model):
     start = models.DateField(blank=True, null=True)
     end = models.DateField()
 
+    objects = EntryGroupManager()
+
     class Meta:
         db_table = 'timepiece_entrygroup'  # Using legacy table name.
 
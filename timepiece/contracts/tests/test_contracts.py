@@ -6,10 +6,13 @@ from dateutil.relativedelta import relativedelta
 from django.contrib.auth.models import Permission
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
-from timepiece.contracts.models import ProjectContract, ContractHour
+from timepiece.contracts.models import (
+    ContractAssignment, ContractHour, ProjectContract)
 from timepiece.entries.models import Entry
 from timepiece.tests.base import ViewTestMixin
 from timepiece.tests import factories
@@ -72,6 +75,19 @@ class ContractListTestCase(ViewTestMixin, TestCase):
         for i in range(3):
             self.assertTrue(correct_contracts[i] in contracts)
 
+    def test_query_count(self):
+        """The number of queries doesn't grow with the number of contracts."""
+        factories.ProjectContract(
+            projects=self.projects, status=ProjectContract.STATUS_CURRENT)
+        with CaptureQueriesContext(connection) as queries:
+            self._get()
+        for status in (ProjectContract.STATUS_CURRENT,
+                       ProjectContract.STATUS_UPCOMING,
+                       ProjectContract.STATUS_COMPLETE):
+            factories.ProjectContract(projects=self.projects, status=status)
+        with self.assertNumQueries(len(queries)):
+            self._get()
+
     def test_non_current_contracts(self):
         """List should return all current contracts."""
         factories.ProjectContract(
@@ -143,6 +159,31 @@ class ContractViewTestCase(ViewTestMixin, TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(contract, response.context['contract'])
 
+    def test_query_count(self):
+        """
+        The number of queries doesn't grow with the number of projects or
+        entries on the contract.
+        """
+        def log_time(project):
+            start_time = timezone.now().replace(hour=9) - relativedelta(days=2)
+            entry = factories.Entry(project=project, start_time=start_time,
+                                    end_time=start_time + relativedelta(hours=1))
+            factories.ContractAssignment(
+                contract=self.contract, user=entry.user,
+                start_date=start_time.date(), end_date=start_time.date())
+        log_time(self.project1)
+        with CaptureQueriesContext(connection) as queries:
+            self._get()
+        for i in range(3):
+            project = factories.Project()
+            self.contract.projects.add(project)
+            log_time(project)
+        with self.assertNumQueries(len(queries)):
+            response = self._get()
+        self.assertEqual(len(response.context['projects']), 5)
+        self.assertEqual([a.hours_worked for a in response.context['assignments']],
+                         [1, 1, 1, 1])
+
 
 class ContractHourTestCase(TestCase):
 
@@ -334,12 +375,14 @@ class ProjectContractEntryTestCase(TestCase):
         self.assertEqual(self.contract1.hours_worked, 10.0)
 
     def testContract1PostValues(self):
-        self.assertEqual(self.contract1.post_launch_entries.count(), 24)
-        self.assertEqual(self.contract1.post_launch_hours_worked, 24.0)
+        # Project B's entries during contract 2 are excluded.
+        self.assertEqual(self.contract1.post_launch_entries.count(), 19)
+        self.assertEqual(self.contract1.post_launch_hours_worked, 19.0)
 
     def testContract2PreValues(self):
-        self.assertEqual(self.contract2.pre_launch_entries.count(), 11)
-        self.assertEqual(self.contract2.pre_launch_hours_worked, 11.0)
+        # Project B's entries during contract 1 are excluded.
+        self.assertEqual(self.contract2.pre_launch_entries.count(), 6)
+        self.assertEqual(self.contract2.pre_launch_hours_worked, 6.0)
 
     def testContract2Values(self):
         self.assertEqual(self.contract2.entries.count(), 5)
@@ -348,3 +391,51 @@ class ProjectContractEntryTestCase(TestCase):
     def testContract2PostValues(self):
         self.assertEqual(self.contract2.post_launch_entries.count(), 4)
         self.assertEqual(self.contract2.post_launch_hours_worked, 4.0)
+
+    def testLaunchHoursQueries(self):
+        """
+        Pre- and post-launch hours take a query each, however many projects
+        and sibling contracts there are.
+        """
+        factories.ProjectContract(projects=[self.project_a, self.project_b])
+        contract = ProjectContract.objects.get(pk=self.contract1.pk)
+        with self.assertNumQueries(2):
+            contract.pre_launch_hours_worked
+            contract.post_launch_hours_worked
+
+    def testProjectHours(self):
+        projects = self.contract1.get_project_hours()
+        self.assertEqual([p.pk for p in projects],
+                         [self.project_a.pk, self.project_b.pk])
+        for project in projects:
+            self.assertEqual(project.billable_hours, 5)
+            self.assertEqual(project.nonbillable_hours, 0)
+
+    def testAssignmentsWithHoursWorked(self):
+        factories.ContractAssignment(
+            contract=self.contract2, user=self.user_b,
+            start_date=self.contract2.start_date,
+            end_date=self.contract2.end_date)
+        factories.ContractAssignment(
+            contract=self.contract1, user=self.user_a,
+            start_date=self.contract1.start_date,
+            end_date=self.contract1.end_date)
+        assignments = ContractAssignment.objects.order_by('contract__name')
+        expected = [a.hours_worked for a in assignments]
+        self.assertEqual(expected, [5, 5])
+        with self.assertNumQueries(1):
+            assignments = assignments.with_hours_worked()
+            self.assertEqual([a.hours_worked for a in assignments], expected)
+
+    def testWithMetrics(self):
+        """with_metrics() selects the same hours the properties compute."""
+        def metrics(contract):
+            return (contract.contracted_hours(), contract.pending_hours(),
+                    contract.hours_worked, contract.nonbillable_hours_worked)
+        factories.ContractHour(contract=self.contract2, hours=3,
+                               status=ContractHour.PENDING_STATUS)
+        expected = [metrics(ProjectContract.objects.get(pk=contract.pk))
+                    for contract in (self.contract1, self.contract2)]
+        with self.assertNumQueries(1):
+            contracts = ProjectContract.objects.with_metrics().order_by('name')
+            self.assertEqual([metrics(contract) for contract in contracts], expected)
@@ -1,19 +1,22 @@
 import datetime
 from dateutil.relativedelta import relativedelta
+from decimal import Decimal
 import random
 
 from six.moves.urllib.parse import urlencode
 
 from django.contrib.auth.models import Permission
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 
 from timepiece import utils
 from timepiece.forms import DATE_FORM_FORMAT
 from timepiece.tests import factories
 from timepiece.tests.base import ViewTestMixin, LogTimeMixin
 
-from timepiece.contracts.models import EntryGroup, HourGroup
+from timepiece.contracts.models import EntryGroup, HourGroup, ProjectContract
 from timepiece.crm.models import Attribute
 from timepiece.entries.models import Activity, Entry
 
@@ -214,6 +217,19 @@ class InvoiceViewPreviousTestCase(ViewTestMixin, LogTimeMixin, TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertTrue(response.context['invoice'])
 
+    def test_invoice_entries_totals(self):
+        """Totals of invoices without any entries of a kind are None."""
+        invoice = EntryGroup.objects.get(project=self.project)
+        url = reverse('view_invoice_entries', args=[invoice.id])
+        response = self.client.get(url)
+        total = response.context['billable_total']
+        self.assertTrue(total > 0)
+        self.assertIsNone(response.context['nonbillable_total'])
+        Activity.objects.update(billable=False)
+        response = self.client.get(url)
+        self.assertIsNone(response.context['billable_total'])
+        self.assertEqual(response.context['nonbillable_total'], total)
+
     def test_invoice_csv(self):
         invoice = self.get_invoice()
         url = reverse('view_invoice_csv', args=[invoice.id])
@@ -520,6 +536,26 @@ class InvoiceCreateTestCase(ViewTestMixin, TestCase):
                 self.assertEqual(total, 0.25)
                 self.assertNotAlmostEqual(float(total), 0.26, places=2)
 
+    def test_billing_summaries(self):
+        """
+        Billable and non-billable summaries come from one query, and an
+        activity in several hour groups is only counted once in the total.
+        """
+        self.make_hourgroups()
+        everything = HourGroup.objects.create(name='Everything')
+        everything.activities.add(*Activity.objects.all())
+        entries = Entry.objects.filter(
+            project__in=[self.project_billable, self.project_billable2])
+        with self.assertNumQueries(1):
+            billable, nonbillable = HourGroup.objects.billing_summaries(entries)
+        self.assertEqual(billable, HourGroup.objects.summaries(
+            entries.filter(activity__billable=True)))
+        self.assertEqual(nonbillable, HourGroup.objects.summaries(
+            entries.filter(activity__billable=False)))
+        self.assertEqual(dict(billable)['Everything'][0], 8)
+        self.assertEqual(billable[-1], ('Total', (8, [])))
+        self.assertEqual(nonbillable[-1], ('Total', (4, [])))
+
     def test_invoice_confirm_bad_args(self):
         # A year/month/project with no entries should raise a 404
         kwargs = {
@@ -592,6 +628,54 @@ class InvoiceCreateTestCase(ViewTestMixin, TestCase):
             self.assertEqual(entry.entry_group_id, invoice.id)
 
 
+class InvoiceLockTestCase(ViewTestMixin, TransactionTestCase):
+    """Entries held by another invoicing transaction are not invoiced twice."""
+
+    def setUp(self):
+        super(InvoiceLockTestCase, self).setUp()
+        self.user = factories.Superuser()
+        self.login_user(self.user)
+        self.to_date = datetime.date(2011, 1, 31)
+        start = utils.add_timezone(datetime.datetime(2011, 1, 3, 8))
+        self.projects = [factories.BillableProject() for i in range(2)]
+        self.entries = [factories.Entry(
+            user=self.user, project=project, status=Entry.APPROVED,
+            start_time=start + relativedelta(days=days),
+            end_time=start + relativedelta(days=days, hours=2))
+            for project in self.projects for days in (0, 1)]
+
+    def lock_elsewhere(self, entries):
+        """Locks the entries from another connection until the test ends."""
+        other = connection.get_new_connection(connection.get_connection_params())
+        self.addCleanup(other.close)
+        other.cursor().execute(
+            'SELECT id FROM timepiece_entry WHERE id IN %s FOR UPDATE',
+            [tuple(entry.pk for entry in entries)])
+
+    def test_create_invoices_skips_locked(self):
+        self.lock_elsewhere(self.entries[:1])
+        results = [result for chunk in EntryGroup.objects.create_invoices(
+            self.user, self.to_date) for result in chunk]
+        self.assertEqual([(invoice.project, num_entries)
+                          for invoice, num_entries, seconds in results],
+                         [(self.projects[0], 1), (self.projects[1], 2)])
+        self.assertEqual(Entry.objects.get(pk=self.entries[0].pk).status,
+                         Entry.APPROVED)
+
+    def test_create_invoice_waits_for_lock(self):
+        self.lock_elsewhere(self.entries[:1])
+        url = '{0}?{1}'.format(reverse('create_invoice'), urlencode({
+            'project': self.projects[0].pk,
+            'to_date': self.to_date.strftime(DATE_FORM_FORMAT),
+        }))
+        response = self.client.post(url, {'number': '3',
+                                          'status': EntryGroup.INVOICED})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(EntryGroup.objects.exists())
+        self.assertEqual([str(m) for m in response.context['messages']],
+                         ['Lock error trying to get entries'])
+
+
 class ListOutstandingInvoicesViewTestCase(ViewTestMixin, TestCase):
     url_name = 'list_outstanding_invoices'
 
@@ -644,7 +728,7 @@ class ListOutstandingInvoicesViewTestCase(ViewTestMixin, TestCase):
         form = response.context['form']
         self.assertFalse(form.is_bound)
         self.assertFalse(form.is_valid())
-        self.assertEquals(response.context['project_totals'].count(), 3)
+        self.assertEquals(response.context['project_totals'].count(), 2)
 
     def test_list_outstanding(self):
         """Only billable projects should be listed."""
@@ -652,8 +736,8 @@ class ListOutstandingInvoicesViewTestCase(ViewTestMixin, TestCase):
         self.assertEquals(response.status_code, 200)
         form = response.context['form']
         self.assertTrue(form.is_valid(), form.errors)
-        # The number of projects should be 3 because entry4 has billable=False
-        self.assertEquals(response.context['project_totals'].count(), 3)
+        # The number of projects should be 2 because entry4 has billable=False
+        self.assertEquals(response.context['project_totals'].count(), 2)
         # Verify that the date on the mark as invoiced links will be correct
         self.assertEquals(response.context['to_date'], self.to_date.date())
         self.assertEquals(list(response.context['unverified']), [])
@@ -705,6 +789,57 @@ class ListOutstandingInvoicesViewTestCase(ViewTestMixin, TestCase):
         self.assertEquals(unverified, set())
         self.assertEquals(unapproved, expected_unapproved)
 
+    def test_project_totals(self):
+        """Each project's hours are totaled, split by activity."""
+        response = self._get()
+        totals = dict((row['project'], row) for row in response.context['project_totals'])
+        self.assertEquals(set(totals), set([
+            self.project_billable.pk, self.project_billable2.pk]))
+        billable = totals[self.project_billable.pk]
+        self.assertEquals(billable['billable_hours'], Decimal('8.00'))
+        self.assertEquals(billable['nonbillable_hours'], Decimal('0.00'))
+        self.assertEquals(billable['uninvoiced_hours'], Decimal('8.00'))
+        nonbillable = totals[self.project_billable2.pk]
+        self.assertEquals(nonbillable['billable_hours'], Decimal('0.00'))
+        self.assertEquals(nonbillable['nonbillable_hours'], Decimal('4.00'))
+
+    def test_active_contracts(self):
+        """Each project's unfinished contracts are listed, latest ending first."""
+        today = datetime.date.today()
+        contracts = [factories.ProjectContract(
+            projects=[self.project_billable], name=name,
+            status=ProjectContract.STATUS_CURRENT,
+            end_date=today + relativedelta(days=days))
+            for name, days in (('A', 10), ('B', 30), ('C', 20))]
+        factories.ProjectContract(
+            projects=[self.project_billable],
+            status=ProjectContract.STATUS_COMPLETE)
+        response = self._get()
+        rows = dict((row['project'], row) for row in response.context['page_obj'])
+        self.assertEquals(rows[self.project_billable.pk]['active_contracts'],
+                          [contracts[1], contracts[2], contracts[0]])
+        self.assertEquals(rows[self.project_billable2.pk]['active_contracts'], [])
+
+    def test_query_count(self):
+        """The number of queries doesn't grow with the number of entries."""
+        with CaptureQueriesContext(connection) as queries:
+            self._get()
+        for i in range(3):
+            start = utils.add_timezone(datetime.datetime(2011, 1, 10 + i, 8))
+            # The statuses filtered on were listed before this one was created.
+            project = factories.BillableProject(status=self.project_billable.status)
+            factories.ProjectContract(projects=[project])
+            factories.Entry(
+                user=self.user, project=project, start_time=start,
+                end_time=start + relativedelta(hours=1), status=Entry.APPROVED)
+            factories.Entry(
+                project=project, start_time=start, status=Entry.VERIFIED,
+                end_time=start + relativedelta(hours=1))
+        with self.assertNumQueries(len(queries)):
+            response = self._get()
+        self.assertEquals(response.context['project_totals'].count(), 5)
+        self.assertEquals(len(response.context['unapproved']), 3)
+
     def test_no_statuses(self):
         self.get_kwargs.pop('statuses')
         response = self._get()
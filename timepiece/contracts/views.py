@@ -5,7 +5,8 @@ from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib import messages
 from django.core.urlresolvers import reverse
 from django.db import transaction, DatabaseError
-from django.db.models import Sum, Q
+from django.core.paginator import InvalidPage, Paginator
+from django.db.models import Case, DecimalField, Q, Sum, When
 from django.db.models.expressions import F, Func, Value
 from django.http import HttpResponseRedirect, Http404, HttpResponseForbidden
 from django.shortcuts import get_object_or_404, redirect, render
@@ -13,12 +14,13 @@ from django.views.generic import ListView, DetailView
 
 from timepiece import utils
 from timepiece.templatetags.timepiece_tags import seconds_to_hours
-from timepiece.utils.csv import CSVViewMixin
+from timepiece.utils.csv import CSVViewMixin, iterate_in_chunks
 from timepiece.utils.search import SearchListView
 from timepiece.utils.views import cbv_decorator
 
 from timepiece.contracts.forms import InvoiceForm, OutstandingHoursFilterForm
 from timepiece.contracts.models import ProjectContract, HourGroup, EntryGroup
+from timepiece.crm.timesheet import capture_snapshots
 from timepiece.entries.models import Project, Entry
 
 
@@ -28,12 +30,18 @@ class ContractDetail(DetailView):
     model = ProjectContract
     context_object_name = 'contract'
     pk_url_kwarg = 'contract_id'
+    queryset = ProjectContract.objects.with_metrics()
 
     def get_context_data(self, *args, **kwargs):
         if 'today' not in kwargs:
             kwargs['today'] = datetime.date.today()
         if 'warning_date' not in kwargs:
             kwargs['warning_date'] = datetime.date.today() + relativedelta(weeks=2)
+        if 'projects' not in kwargs:
+            kwargs['projects'] = self.object.get_project_hours()
+        if 'assignments' not in kwargs:
+            kwargs['assignments'] = self.object.assignments.with_hours_worked() \
+                .select_related('user').order_by('start_date', 'user__last_name')
         return super(ContractDetail, self).get_context_data(*args, **kwargs)
 
 
@@ -43,21 +51,23 @@ class ContractList(ListView):
     model = ProjectContract
     context_object_name = 'contracts'
     queryset = ProjectContract.objects.filter(
-        status=ProjectContract.STATUS_CURRENT).order_by('name')
+        status=ProjectContract.STATUS_CURRENT).with_metrics().order_by('name')
 
     def get_context_data(self, *args, **kwargs):
         if 'today' not in kwargs:
             kwargs['today'] = datetime.date.today()
         if 'warning_date' not in kwargs:
             kwargs['warning_date'] = datetime.date.today() + relativedelta(weeks=2)
+        # The same contracts are listed by the template, so they are only
+        # fetched once.
         kwargs['max_work_fraction'] = max(
-            [0.0] + [c.fraction_hours for c in self.queryset.all()])
+            [0.0] + [c.fraction_hours for c in self.object_list])
         kwargs['max_schedule_fraction'] = max(
-            [0.0] + [c.fraction_schedule for c in self.queryset.all()])
+            [0.0] + [c.fraction_schedule for c in self.object_list])
         kwargs['projects_pending'] = ProjectContract.objects.filter(
-            status=ProjectContract.STATUS_UPCOMING).order_by('name')
+            status=ProjectContract.STATUS_UPCOMING).with_metrics().order_by('name')
         kwargs['projects_complete'] = ProjectContract.objects.filter(
-            status=ProjectContract.STATUS_COMPLETE).order_by('name')
+            status=ProjectContract.STATUS_COMPLETE).with_metrics().order_by('name')
         return super(ContractList, self).get_context_data(*args, **kwargs)
 
 
@@ -106,7 +116,11 @@ def create_invoice(request):
             # throw a DatabaseError.  That can happen if someone double-clicks
             # the Create Invoice button.
             try:
-                entries.select_for_update(nowait=True)
+                # The queryset must be evaluated to take the lock, and in a
+                # savepoint so the transaction can continue if it fails.
+                with transaction.atomic():
+                    locked = list(entries.select_for_update(nowait=True)
+                                         .values_list('pk', flat=True))
             except DatabaseError:
                 # Whoops, we lost the race
                 messages.add_message(request, messages.ERROR,
@@ -114,8 +128,9 @@ def create_invoice(request):
             else:
                 # We got the lock, we can carry on
                 invoice = invoice_form.save()
-                Entry.no_join.filter(pk__in=entries).update(
+                Entry.no_join.filter(pk__in=locked).update(
                     status=invoice.status, entry_group=invoice)
+                capture_snapshots(Entry.no_join.filter(entry_group=invoice))
                 messages.add_message(request, messages.INFO,
                                      "Invoice created")
                 return HttpResponseRedirect(reverse('view_invoice',
@@ -133,13 +148,15 @@ def create_invoice(request):
         .select_related()
     nonbillable_entries = entries.filter(activity__billable=False) \
         .select_related()
+    billable_totals, nonbillable_totals = \
+        HourGroup.objects.billing_summaries(entries)
     return render(request, 'timepiece/invoice/create.html', {
         'invoice_form': invoice_form,
         'billable_entries': billable_entries,
         'nonbillable_entries': nonbillable_entries,
         'project': project,
-        'billable_totals': HourGroup.objects.summaries(billable_entries),
-        'nonbillable_totals': HourGroup.objects.summaries(nonbillable_entries),
+        'billable_totals': billable_totals,
+        'nonbillable_totals': nonbillable_totals,
         'from_date': from_date,
         'to_date': to_date,
     })
@@ -163,21 +180,55 @@ def list_outstanding_invoices(request):
         project_status = Q(project__status__in=statuses) if statuses is not None else Q()
         # Calculate hours for each project
         ordering = ('project__type__label', 'project__status__label',
-                    'project__business__name', 'project__name', 'status')
-        project_totals = Entry.objects.filter(
-            dates, billable, entry_status, project_status).order_by(*ordering)
+                    'project__business__name', 'project__name', 'project__id')
+        uninvoiced = ~Q(status__in=[Entry.INVOICED, Entry.NOT_INVOICED])
+        project_totals = Entry.no_join.filter(
+            dates, billable, entry_status, project_status)
+        project_totals = project_totals.values(
+            'project', 'project__name', 'project__type__label',
+            'project__status__label', 'project__business__name',
+            'project__business__short_name')
+        project_totals = project_totals.annotate(
+            billable_hours=_sum_hours(uninvoiced, activity__billable=True),
+            nonbillable_hours=_sum_hours(uninvoiced, activity__billable=False),
+            uninvoiced_hours=_sum_hours(uninvoiced),
+        ).order_by(*ordering)
         # Find users with unverified/unapproved entries to warn invoice creator
-        date_range_entries = Entry.objects.filter(dates)
         user_values = ['user__pk', 'user__first_name', 'user__last_name']
-        unverified = date_range_entries.filter(status=Entry.UNVERIFIED)
-        unverified = unverified.values_list(*user_values).order_by('user__first_name').distinct()
-        unapproved = date_range_entries.filter(status=Entry.VERIFIED)
-        unapproved = unapproved.values_list(*user_values).order_by('user__first_name').distinct()
+        users = Entry.no_join.filter(
+            dates, status__in=[Entry.UNVERIFIED, Entry.VERIFIED])
+        users = users.values_list('status', *user_values)
+        users = list(users.order_by('user__first_name').distinct())
+        unverified = [user[1:] for user in users if user[0] == Entry.UNVERIFIED]
+        unapproved = [user[1:] for user in users if user[0] == Entry.VERIFIED]
     else:
-        project_totals = unverified = unapproved = Entry.objects.none()
+        project_totals = Entry.no_join.none()
+        unverified = unapproved = []
+    paginator = Paginator(project_totals, 50)
+    try:
+        page = paginator.page(request.GET.get('page', 1))
+    except InvalidPage:
+        raise Http404
+    page.object_list = list(page.object_list)
+    # Look up the active contracts for every project on the page at once.
+    project_ids = [row['project'] for row in page.object_list]
+    contracts = ProjectContract.projects.through.objects.filter(
+        project__in=project_ids).exclude(
+        projectcontract__status=ProjectContract.STATUS_COMPLETE)
+    contracts = contracts.select_related('projectcontract')
+    active_contracts = dict((pk, []) for pk in project_ids)
+    # In ProjectContract's default order, as project.get_active_contracts()
+    # returned them.
+    for contract in contracts.order_by('-projectcontract__end_date'):
+        active_contracts[contract.project_id].append(contract.projectcontract)
+    for row in page.object_list:
+        row['active_contracts'] = active_contracts[row['project']]
     return render(request, 'timepiece/invoice/outstanding.html', {
         'date_form': form,
         'project_totals': project_totals,
+        'page_obj': page,
+        'paginator': paginator,
+        'is_paginated': page.has_other_pages(),
         'unverified': unverified,
         'unapproved': unapproved,
         'to_date': form.get_to_date(),
@@ -185,6 +236,12 @@ def list_outstanding_invoices(request):
     })
 
 
+def _sum_hours(*args, **kwargs):
+    """Sums the hours of the entries which match the given filters."""
+    return Sum(Case(When(Q(*args, **kwargs), then='hours'),
+                    default=Value(0), output_field=DecimalField()))
+
+
 @cbv_decorator(permission_required('contracts.add_entrygroup'))
 class ListInvoices(SearchListView):
     model = EntryGroup
@@ -214,14 +271,14 @@ class InvoiceDetail(DetailView):
         nonbillable_entries = invoice.entries.filter(activity__billable=False)\
                                              .order_by('start_time')\
                                              .select_related()
+        billable_totals, nonbillable_totals = \
+            HourGroup.objects.billing_summaries(invoice.entries.all())
         return {
             'invoice': invoice,
             'billable_entries': billable_entries,
-            'billable_totals': HourGroup.objects
-                                        .summaries(billable_entries),
+            'billable_totals': billable_totals,
             'nonbillable_entries': nonbillable_entries,
-            'nonbillable_totals': HourGroup.objects
-                                           .summaries(nonbillable_entries),
+            'nonbillable_totals': nonbillable_totals,
             'from_date': invoice.start,
             'to_date': invoice.end,
             'project': invoice.project,
@@ -233,18 +290,20 @@ class InvoiceEntriesDetail(InvoiceDetail):
 
     def get_context_data(self, **kwargs):
         context = super(InvoiceEntriesDetail, self).get_context_data(**kwargs)
-        billable_entries = context['billable_entries']
-        nonbillable_entries = context['nonbillable_entries']
         context.update({
-            'billable_total': billable_entries.aggregate(hours=Sum(
-                Func(F('hours'), Value(2), function='ROUND'))
-            )['hours'],
-            'nonbillable_total': nonbillable_entries.aggregate(hours=Sum(
-                Func(F('hours'), Value(2), function='ROUND'))
-            )['hours'],
+            'billable_total': self._get_total(context['billable_totals']),
+            'nonbillable_total': self._get_total(context['nonbillable_totals']),
         })
         return context
 
+    def _get_total(self, summaries):
+        """
+        Returns the hours of the summaries' Total row, which is the only row
+        if there were no entries. Then, like an aggregate, it returns None.
+        """
+        name, (hours, activities) = summaries[-1]
+        return hours if len(summaries) > 1 else None
+
 
 class InvoiceDetailCSV(CSVViewMixin, InvoiceDetail):
 
@@ -255,8 +314,7 @@ class InvoiceDetailCSV(CSVViewMixin, InvoiceDetail):
         return 'Invoice-{0}-{1}'.format(project, end_day)
 
     def convert_context_to_csv(self, context):
-        rows = []
-        rows.append([
+        yield [
             'Date',
             'Weekday',
             'Name',
@@ -265,9 +323,10 @@ class InvoiceDetailCSV(CSVViewMixin, InvoiceDetail):
             'Time Out',
             'Breaks',
             'Hours',
-        ])
-        for entry in context['billable_entries']:
-            data = [
+        ]
+        entries = context['billable_entries']
+        for entry in iterate_in_chunks(entries, ('start_time', 'id')):
+            yield [
                 entry.start_time.strftime('%x'),
                 entry.start_time.strftime('%A'),
                 entry.user.get_name_or_username(),
@@ -277,12 +336,10 @@ class InvoiceDetailCSV(CSVViewMixin, InvoiceDetail):
                 seconds_to_hours(entry.seconds_paused),
                 "{0:.2f}".format(entry.hours),
             ]
-            rows.append(data)
-        total = context['billable_entries'].aggregate(hours=Sum(
+        total = entries.aggregate(hours=Sum(
             Func(F('hours'), Value(2), function='ROUND'))
         )['hours']
-        rows.append(('', '', '', '', '', '', 'Total:', "{0:.2f}".format(total)))
-        return rows
+        yield ('', '', '', '', '', '', 'Total:', "{0:.2f}".format(total))
 
 
 class InvoiceEdit(InvoiceDetail):
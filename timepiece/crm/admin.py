@@ -1,5 +1,9 @@
+from dateutil.relativedelta import relativedelta
+
 from django.contrib import admin
 
+from timepiece import utils
+from timepiece.contracts.models import EntryGroup
 from timepiece.crm.models import (
     Attribute, Business, Project, RelationshipType, UserProfile)
 
@@ -23,6 +27,20 @@ class ProjectAdmin(admin.ModelAdmin):
     search_fields = ('name', 'business__name', 'point_person__username',
                      'point_person__first_name', 'point_person__last_name',
                      'description')
+    actions = ['create_invoices']
+
+    def create_invoices(self, request, queryset):
+        """Invoices the approved entries of the projects through last month."""
+        to_date = utils.get_month_start().date() - relativedelta(days=1)
+        num_invoices = num_entries = 0
+        for results in EntryGroup.objects.create_invoices(
+                request.user, to_date, projects=queryset.values('pk')):
+            num_invoices += len(results)
+            num_entries += sum(count for invoice, count, elapsed in results)
+        self.message_user(request, 'Created {0} invoices for {1} entries.'.format(
+            num_invoices, num_entries))
+    create_invoices.short_description = \
+        'Invoice approved entries through the end of last month'
 
 
 class RelationshipTypeAdmin(admin.ModelAdmin):
@@ -1,9 +1,12 @@
 from django import forms
 from django.contrib.auth.forms import UserCreationForm, UserChangeForm
-from django.contrib.auth.models import User
+from django.contrib.auth.models import Group, User
+from django.db.models import Q
 
 from selectable import forms as selectable
 
+from timepiece.fields import UserModelMultipleChoiceField
+from timepiece.forms import YearMonthForm
 from timepiece.utils.search import SearchForm
 
 from timepiece.crm.lookups import (
@@ -12,6 +15,37 @@ from timepiece.crm.models import (
     Attribute, Business, Project, ProjectRelationship)
 
 
+class BulkTimesheetForm(YearMonthForm):
+    """
+    Selects a month and the users, or group of users, whose time sheets to
+    verify or approve.
+    """
+    users = UserModelMultipleChoiceField(
+        required=False, queryset=None, widget=forms.CheckboxSelectMultiple())
+    group = forms.ModelChoiceField(required=False, queryset=Group.objects.all())
+
+    def __init__(self, *args, **kwargs):
+        super(BulkTimesheetForm, self).__init__(*args, **kwargs)
+        self.fields['month'].label = 'Month'
+        self.fields['year'].label = 'Year'
+        self.fields['users'].queryset = User.objects.filter(
+            is_active=True).order_by('last_name', 'first_name')
+
+    def clean(self):
+        cleaned_data = super(BulkTimesheetForm, self).clean()
+        if not cleaned_data.get('users') and not cleaned_data.get('group'):
+            raise forms.ValidationError('Select some users or a group.')
+        return cleaned_data
+
+    def get_users(self):
+        """Returns the selected users, and the members of the group."""
+        users = Q(pk__in=self.cleaned_data['users'])
+        if self.cleaned_data['group']:
+            users |= Q(groups=self.cleaned_data['group'])
+        return User.objects.filter(users).distinct().order_by(
+            'last_name', 'first_name', 'pk')
+
+
 class CreateEditBusinessForm(forms.ModelForm):
 
     class Meta:
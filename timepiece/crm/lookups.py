@@ -7,13 +7,39 @@ from selectable.base import LookupBase
 from selectable.base import ModelLookup
 from selectable.registry import registry
 
+from timepiece.crm import search
 from timepiece.crm.models import Project, Business
 
 
-class ProjectLookup(ModelLookup):
+SearchResult = namedtuple('SearchResult', ['result_type', 'item', 'label', 'value'])
+
+
+class RankedLookupMixin(object):
+    """
+    Returns the best matches of the search fields first (see
+    timepiece.crm.search), as a queryset which selectable pages through.
+    Matches of the same rank are ordered by the fields in ordering. search()
+    returns only the best few matches, for the quick search.
+    """
+    ordering = ()
+
+    def get_search_fields(self):
+        return [field.rsplit('__', 1)[0] for field in self.search_fields]
+
+    def get_query(self, request, term):
+        return search.rank(self.get_queryset(), self.get_search_fields(), term,
+                           self.ordering)
+
+    def search(self, term, limit=search.SEARCH_LIMIT):
+        return search.search(self.name(), self.get_queryset(), self.get_search_fields(),
+                             term, self.ordering, limit)
+
+
+class ProjectLookup(RankedLookupMixin, ModelLookup):
     model = Project
     search_fields = ('name__icontains', 'business__name__icontains',
                      'business__short_name__icontains')
+    ordering = ('name',)
 
     def get_item_label(self, project):
         return mark_safe(u'<span class="project">%s</span>' % self.get_item_value(project))
@@ -22,9 +48,10 @@ class ProjectLookup(ModelLookup):
         return project.name if project else ''
 
 
-class BusinessLookup(ModelLookup):
+class BusinessLookup(RankedLookupMixin, ModelLookup):
     model = Business
     search_fields = ('name__icontains', 'short_name__icontains')
+    ordering = ('name',)
 
     def get_item_label(self, business):
         return mark_safe(u'<span class="business">%s</span>' % self.get_item_value(business))
@@ -33,13 +60,11 @@ class BusinessLookup(ModelLookup):
         return business.name if business else ''
 
 
-class UserLookup(ModelLookup):
+class UserLookup(RankedLookupMixin, ModelLookup):
     model = User
     search_fields = ('username__icontains', 'first_name__icontains',
                      'last_name__icontains', 'email__icontains')
-
-    def get_query(self, request, q):
-        return super(UserLookup, self).get_query(request, q).order_by('last_name')
+    ordering = ('last_name', 'first_name')
 
     def get_item_label(self, user):
         return mark_safe(u'<span class="user">%s</span>' % self.get_item_value(user))
@@ -60,15 +85,14 @@ class QuickLookup(LookupBase):
 
     def get_query(self, request, q):
         results = []
-        SearchResult = namedtuple('SearchResult', ['result_type', 'item', 'label', 'value'])
-
         for result_type, lookup in self.lookups.items():
-            for item in lookup.get_query(request, q)[:10]:
+            for item in lookup.search(q, limit=10):
                 label = lookup.get_item_label(item)
                 value = lookup.get_item_value(item)
                 results.append(SearchResult(result_type, item, label, value))
 
-        results.sort(key=lambda a: a.value)
+        # Show the best matches of every type first.
+        results.sort(key=lambda a: (getattr(a.item, 'search_rank', 0), a.value))
         return results
 
     def get_item_label(self, item):
@@ -4,15 +4,27 @@ from django.apps import apps
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 from django.db import models
+from django.db.models.signals import post_save, pre_save
+from django.dispatch import receiver
 from django.utils.encoding import python_2_unicode_compatible
 
-from timepiece.utils import get_active_entry
+from timepiece.utils import forget_quick_clock_in, get_active_entry
 
 
 # Add a utility method to the User class that will tell whether or not a
-# particular user has any unclosed entries
-_clocked_in = lambda user: bool(get_active_entry(user))
-User.add_to_class('clocked_in', property(_clocked_in))
+# particular user has any unclosed entries. The value may already have been
+# selected for a list of users by utils.annotate_clocked_in.
+def _get_clocked_in(user):
+    if '_clocked_in' in user.__dict__:
+        return user.__dict__['_clocked_in']
+    return bool(get_active_entry(user))
+
+
+def _set_clocked_in(user, value):
+    user.__dict__['_clocked_in'] = bool(value)
+
+
+User.add_to_class('clocked_in', property(_get_clocked_in, _set_clocked_in))
 
 
 # Utility method to get user's name, falling back to username.
@@ -37,6 +49,43 @@ class UserProfile(models.Model):
         return self.user
 
 
+class QuickClockInMixin(object):
+    """
+    Discards every user's cached quick clock in projects when an instance is
+    saved or deleted, as the projects are shown or chosen by it.
+    """
+
+    def save(self, *args, **kwargs):
+        super(QuickClockInMixin, self).save(*args, **kwargs)
+        forget_quick_clock_in()
+
+    def delete(self, *args, **kwargs):
+        super(QuickClockInMixin, self).delete(*args, **kwargs)
+        forget_quick_clock_in()
+
+
+def _forget_snapshots():
+    TimesheetSnapshot = apps.get_model('entries', 'TimesheetSnapshot')
+    TimesheetSnapshot.objects.forget_all()
+
+
+# Time sheet snapshots show the names of the users who logged the time.
+@receiver(pre_save, sender=User)
+def _check_renamed_user(sender, instance, raw=False, update_fields=None, **kwargs):
+    # Logging in only saves last_login, so it isn't looked up then.
+    names = set(['first_name', 'last_name'])
+    if raw or not instance.pk or (update_fields and not names & set(update_fields)):
+        return
+    instance._renamed = User.objects.filter(pk=instance.pk).exclude(
+        first_name=instance.first_name, last_name=instance.last_name).exists()
+
+
+@receiver(post_save, sender=User)
+def _forget_renamed_user(sender, instance, **kwargs):
+    if instance.__dict__.pop('_renamed', False):
+        _forget_snapshots()
+
+
 class TypeAttributeManager(models.Manager):
     """Object manager for type attributes."""
 
@@ -54,7 +103,7 @@ class StatusAttributeManager(models.Manager):
 
 
 @python_2_unicode_compatible
-class Attribute(models.Model):
+class Attribute(QuickClockInMixin, models.Model):
     PROJECT_TYPE = 'project-type'
     PROJECT_STATUS = 'project-status'
     ATTRIBUTE_TYPES = OrderedDict((
@@ -85,9 +134,18 @@ class Attribute(models.Model):
     def __str__(self):
         return self.label
 
+    def save(self, *args, **kwargs):
+        # Time sheet snapshots total billable hours by project type, and
+        # show its label.
+        changed = self.pk and Attribute.objects.filter(pk=self.pk).exclude(
+            billable=self.billable, label=self.label).exists()
+        super(Attribute, self).save(*args, **kwargs)
+        if changed:
+            _forget_snapshots()
+
 
 @python_2_unicode_compatible
-class Business(models.Model):
+class Business(QuickClockInMixin, models.Model):
     name = models.CharField(max_length=255)
     short_name = models.CharField(max_length=255, blank=True)
     email = models.EmailField(blank=True)
@@ -123,7 +181,7 @@ class TrackableProjectManager(models.Manager):
 
 
 @python_2_unicode_compatible
-class Project(models.Model):
+class Project(QuickClockInMixin, models.Model):
     name = models.CharField(max_length=255)
     tracker_url = models.CharField(
         max_length=255, blank=True, null=False, default="")
@@ -164,6 +222,15 @@ class Project(models.Model):
     def billable(self):
         return self.type.billable
 
+    def save(self, *args, **kwargs):
+        # Time sheet snapshots total billable hours by project type, and
+        # show the project's name.
+        changed = self.pk and Project.objects.filter(pk=self.pk).exclude(
+            type=self.type_id, name=self.name).exists()
+        super(Project, self).save(*args, **kwargs)
+        if changed:
+            _forget_snapshots()
+
     def get_absolute_url(self):
         return reverse('view_project', args=(self.pk,))
 
@@ -185,6 +252,15 @@ class RelationshipType(models.Model):
         return self.name
 
 
+class ProjectRelationshipQuerySet(models.QuerySet):
+
+    def delete(self):
+        users = set(self.values_list('user', flat=True))
+        super(ProjectRelationshipQuerySet, self).delete()
+        forget_quick_clock_in(users)
+    delete.queryset_only = True
+
+
 @python_2_unicode_compatible
 class ProjectRelationship(models.Model):
     types = models.ManyToManyField(
@@ -192,6 +268,8 @@ class ProjectRelationship(models.Model):
     user = models.ForeignKey(User, related_name='project_relationships')
     project = models.ForeignKey(Project, related_name='project_relationships')
 
+    objects = ProjectRelationshipQuerySet.as_manager()
+
     class Meta:
         db_table = 'timepiece_projectrelationship'  # Using legacy table name.
         unique_together = ('user', 'project')
@@ -201,3 +279,11 @@ class ProjectRelationship(models.Model):
             project=self.project.name,
             user=self.user.get_name_or_username(),
         )
+
+    def save(self, *args, **kwargs):
+        super(ProjectRelationship, self).save(*args, **kwargs)
+        forget_quick_clock_in([self.user_id])
+
+    def delete(self, *args, **kwargs):
+        super(ProjectRelationship, self).delete(*args, **kwargs)
+        forget_quick_clock_in([self.user_id])
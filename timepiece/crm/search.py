@@ -0,0 +1,87 @@
+"""
+Ranked searches of users, projects and businesses for the quick search and
+the selectable lookups. The lookups page through rank()'s queryset; the
+quick search reads a few results of each kind with search().
+
+A search matches objects with any of the given fields containing the term,
+and ranks exact matches first, then prefix matches, then other matches. On
+PostgreSQL, the containment filter can be answered from the trigram indexes
+installed by the search_trigram_indexes command; otherwise the searched
+columns are scanned.
+If TIMEPIECE_SEARCH_CACHE names a cache, search()'s result lists are also kept
+in it briefly, so repeated keystrokes and popular terms don't query again.
+"""
+from functools import reduce
+import hashlib
+import operator
+
+import six
+
+from django.core.cache import caches
+from django.db.models import Case, IntegerField, Q, Value, When
+
+from timepiece import utils
+
+
+# How many results a search returns by default.
+SEARCH_LIMIT = 25
+
+# How long, in seconds, cached results are used for.
+SEARCH_CACHE_TIMEOUT = 60
+
+# The ranks of exact, prefix and other matches.
+EXACT, PREFIX, CONTAINS = 0, 1, 2
+
+
+def get_search_cache():
+    """Returns the cache used to share search results, if there is one."""
+    alias = utils.get_setting('TIMEPIECE_SEARCH_CACHE')
+    return caches[alias] if alias else None
+
+
+def get_search_key(name, queryset, fields, term, ordering, limit):
+    """
+    Returns the cache key of a search, which distinguishes querysets with
+    different filters which are searched under the same name.
+    """
+    search = [six.text_type(queryset.query), fields, ordering, term.lower()]
+    search = hashlib.md5(repr(search).encode('utf-8')).hexdigest()
+    return 'timepiece:search:{0}:{1}:{2}'.format(name, limit, search)
+
+
+def _any(fields, lookup, term):
+    return reduce(operator.or_, [Q(**{'{0}__{1}'.format(field, lookup): term})
+                                 for field in fields])
+
+
+def rank(queryset, fields, term, ordering=()):
+    """
+    Filters the queryset to objects with any of the fields containing the
+    term, annotated with their search_rank and ordered with the best matches
+    first. Matches of the same rank are ordered by the given fields.
+    """
+    term = term.strip()
+    if not term:
+        return queryset.order_by(*ordering)
+    search_rank = Case(
+        When(_any(fields, 'iexact', term), then=Value(EXACT)),
+        When(_any(fields, 'istartswith', term), then=Value(PREFIX)),
+        default=Value(CONTAINS), output_field=IntegerField())
+    queryset = queryset.filter(_any(fields, 'icontains', term))
+    return queryset.annotate(search_rank=search_rank).order_by(
+        'search_rank', *ordering)
+
+
+def search(name, queryset, fields, term, ordering=(), limit=SEARCH_LIMIT):
+    """
+    Returns a list of the best limit matches of the term (see rank()),
+    from the cache if possible. name identifies the queryset in the cache.
+    """
+    cache = get_search_cache()
+    key = get_search_key(name, queryset, fields, term, ordering, limit) if cache else None
+    results = cache.get(key) if cache else None
+    if results is None:
+        results = list(rank(queryset, fields, term, ordering)[:limit])
+        if cache:
+            cache.set(key, results, SEARCH_CACHE_TIMEOUT)
+    return results
@@ -3,13 +3,16 @@ from decimal import Decimal
 from dateutil.relativedelta import relativedelta
 
 from django.utils import timezone
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
 from timepiece import utils
 from timepiece.tests import factories
 from timepiece.tests.base import ViewTestMixin, LogTimeMixin
 
+from timepiece.entries.models import Entry
+
 from ..models import Project
+from ..timesheet import capture_project, get_project_totals
 
 
 class TestProjectTimesheet(ViewTestMixin, LogTimeMixin, TestCase):
@@ -144,6 +147,20 @@ class TestProjectTimesheet(ViewTestMixin, LogTimeMixin, TestCase):
         # Assure user's comments are not included.
         self.assertTrue('comments' not in headers)
 
+    @override_settings(TIMEPIECE_STREAM_CSV=True)
+    def test_project_csv_streaming(self):
+        self.login_user(self.superuser)
+        self.make_entries()
+        response = self._get(
+            url_name='view_project_timesheet_csv', url_args=(self.p1.pk,))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        contents = b''.join(response.streaming_content).decode('utf-8')
+        contents = contents.splitlines()
+        self.assertEqual(len(contents), 3)
+        self.assertEqual(contents[1].split(',')[-1], '1.00')
+        self.assertEqual(contents[-1].split(',')[-2:], ['Total:', '1.00'])
+
     def testRoundingConversions(self):
         """
         Verify that entries (which are in seconds) approximate a correct hourly value
@@ -168,3 +185,23 @@ class TestProjectTimesheet(ViewTestMixin, LogTimeMixin, TestCase):
         entries = response.context['entries']
         self.assertEqual(len(entries), 2)
         self.assertAlmostEqual(sum(Decimal(e['hours']) for e in entries), Decimal(0.016), places=2)
+
+    @override_settings(TIMEPIECE_TIMESHEET_SNAPSHOTS=True)
+    def testProjectTimesheetSnapshot(self):
+        """An approved month's totals are read from its snapshot."""
+        self.login_user(self.superuser)
+        self.make_entries()
+        data = {'year': 2011, 'month': 1}
+        response = self._get(data=data)
+        january = utils.add_timezone(datetime.datetime(2011, 1, 1))
+        february = january + relativedelta(months=1)
+        self.assertFalse(capture_project(self.p1, january))
+        Entry.no_join.update(status=Entry.APPROVED)
+        totals = get_project_totals(self.p1, january, february)
+        self.assertTrue(capture_project(self.p1, january))
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                get_project_totals(self.p1, january, february), totals)
+        snapshot_response = self._get(data=data)
+        for key in ('total', 'user_entries', 'activity_entries'):
+            self.assertEqual(snapshot_response.context[key], response.context[key])
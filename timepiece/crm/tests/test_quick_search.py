@@ -1,6 +1,11 @@
-from django.test import TestCase
+import json
+
+from django.test import RequestFactory, TestCase, override_settings
 
 from timepiece.tests import factories
+from timepiece.crm import search
+from timepiece.crm.lookups import QuickLookup, UserLookup
+from timepiece.crm.models import Project
 from timepiece.tests.base import ViewTestMixin
 
 
@@ -81,3 +86,71 @@ class TestQuickSearchView(ViewTestMixin, TestCase):
         self.assertEquals(response.status_code, 200)
         self.assertTemplateUsed(response, self.template_name)
         self.assertFalse(response.context['form'].is_valid())
+
+
+class TestQuickLookup(TestCase):
+
+    def setUp(self):
+        super(TestQuickLookup, self).setUp()
+        self.lookup = QuickLookup()
+
+    def test_ranking(self):
+        """Exact matches come first, then prefix matches, then the rest."""
+        other = factories.Project(name='Bramble')
+        prefix = factories.Business(name='Ambler')
+        exact = factories.User(first_name='Amble', last_name='Amble')
+        with self.assertNumQueries(3):
+            results = self.lookup.get_query(None, 'amble')
+        self.assertEqual([r.item for r in results], [exact, prefix, other])
+        self.assertEqual(self.lookup.get_item_id(results[1]),
+                         'business-{0}'.format(prefix.pk))
+
+    def test_limit(self):
+        """Each lookup only reads its best few results."""
+        for i in range(12):
+            factories.User(last_name='Walker{0}'.format(i))
+        users = UserLookup().search('walker', limit=5)
+        self.assertEqual([u.last_name for u in users],
+                         ['Walker0', 'Walker1', 'Walker10', 'Walker11', 'Walker2'])
+        self.assertEqual(len(self.lookup.get_query(None, 'walker')), 10)
+
+    def test_lookup_pages(self):
+        """Selectable lookups page through all of the ranked matches."""
+        for i in range(30):
+            factories.User(last_name='Walker{0:02d}'.format(i))
+        lookup = UserLookup()
+        request = RequestFactory().get('/', {'term': 'walker'})
+        results = json.loads(lookup.results(request).content.decode('utf-8'))
+        self.assertEqual(len(results['data']), 25)
+        self.assertEqual(results['meta']['next_page'], 2)
+        request = RequestFactory().get('/', {'term': 'walker', 'page': 2})
+        results = json.loads(lookup.results(request).content.decode('utf-8'))
+        self.assertTrue(results['data'][-1]['value'].endswith('Walker29'))
+        self.assertEqual(len(results['data']), 5)
+
+    @override_settings(
+        CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        TIMEPIECE_SEARCH_CACHE='default')
+    def test_cached(self):
+        """Repeated searches are answered from the cache."""
+        project = factories.Project(name='Orchard')
+        self.assertEqual(len(self.lookup.get_query(None, 'orch')), 1)
+        with self.assertNumQueries(0):
+            results = self.lookup.get_query(None, 'Orch')
+        self.assertEqual([r.item for r in results], [project])
+
+    @override_settings(
+        CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        TIMEPIECE_SEARCH_CACHE='default')
+    def test_cached_per_queryset(self):
+        """Searches of differently filtered querysets are cached apart."""
+        orchard = factories.Project(name='Orchard')
+        orchid = factories.Project(name='Orchid')
+        projects = Project.objects.all()
+        self.assertEqual(search.search('project', projects, ['name'], 'orch', ['name']),
+                         [orchard, orchid])
+        projects = projects.exclude(pk=orchard.pk)
+        self.assertEqual(search.search('project', projects, ['name'], 'orch', ['name']),
+                         [orchid])
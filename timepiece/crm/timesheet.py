@@ -0,0 +1,396 @@
+"""
+The entries and totals of a user's monthly time sheet.
+
+A Timesheet reads the month's entries, and those of the partial week before
+it, with a single query. It then builds everything the time sheet shows in
+one pass over those rows: the entry list, the daily and weekly totals, the
+project totals, the billable and paid leave summary and the number of
+entries in each status.
+
+When TIMEPIECE_TIMESHEET_SNAPSHOTS is enabled, the totals of user and project
+months whose entries are all approved or invoiced are captured in
+TimesheetSnapshots, and read from them instead of from the entries.
+
+change_timesheets() verifies or approves the time sheets of many users at
+once.
+"""
+from collections import Counter, namedtuple, OrderedDict
+from decimal import Decimal
+
+from dateutil.relativedelta import relativedelta
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from timepiece import utils
+from timepiece.entries.models import Entry, TimesheetSnapshot, lock_users
+
+
+# The fields read for each entry, in the order of a TimesheetRow.
+FIELDS = ('id', 'start_time', 'end_time', 'seconds_paused', 'comments',
+          'status', 'hours', 'project', 'project__name', 'project__type',
+          'project__type__label', 'project__type__billable', 'activity__name',
+          'activity__billable', 'location__name')
+
+TimesheetRow = namedtuple('TimesheetRow', [
+    'id', 'start_time', 'end_time', 'seconds_paused', 'comments', 'status',
+    'hours', 'project', 'project_name', 'project_type', 'project_type_label',
+    'project_billable', 'activity_name', 'activity_billable', 'location_name'])
+
+# The statuses of the entries of a month which can be captured.
+FINAL_STATUSES = (Entry.APPROVED, Entry.INVOICED)
+
+# The attributes of a Timesheet which are kept in its snapshot.
+SNAPSHOT_FIELDS = ('entries', 'grouped_totals', 'project_entries', 'summary',
+                   'status_counts', 'work_totals', 'leave_totals')
+
+# The status of the entries which each time sheet action changes, and the
+# status it changes them to.
+ACTIONS = OrderedDict((
+    ('verify', (Entry.UNVERIFIED, Entry.VERIFIED)),
+    ('approve', (Entry.VERIFIED, Entry.APPROVED)),
+))
+
+ACTIVE_ENTRY_ERROR = 'Has an active entry'
+UNVERIFIED_ERROR = 'Has unverified entries'
+NO_HOURS_ERROR = 'Has no hours to {0}'
+
+# The outcome of a time sheet action for one user: the number and hours of
+# the entries changed, or why none were.
+TimesheetChange = namedtuple('TimesheetChange', ['user', 'entries', 'hours', 'error'])
+
+
+def _add(totals, key, hours):
+    totals[key] = totals.get(key, Decimal('0')) + hours
+
+
+class Timesheet(object):
+    """
+    The time sheet of user for the month beginning at from_date and ending
+    before to_date. After run():
+
+    entries -- a dictionary for each of the month's entries, with the same
+        keys as Entry.objects.date_trunc('month', ...) gives them.
+    grouped_totals -- (week, week totals, days) for each week with hours,
+        or '' if the month has no entries. Days list (day, (day totals,
+        {project name: project totals})).
+    project_entries -- the month's hours by project name, most first.
+    summary -- the month's summary, like Entry.summary.
+    status_counts -- the number of the month's entries in each status.
+    work_totals, leave_totals -- the month's billable and non-billable work
+        hours by project type, and leave hours by project, for the payroll
+        report.
+    """
+
+    def __init__(self, user, from_date, to_date):
+        self.user = user
+        self.from_date = utils.add_timezone(from_date)
+        self.to_date = utils.add_timezone(to_date)
+        self.first_week = utils.get_week_start(self.from_date)
+
+    def get_queryset(self):
+        entries = Entry.no_join.filter(
+            user=self.user, end_time__gte=self.first_week,
+            end_time__lt=self.to_date)
+        return entries.order_by('start_time', 'id').values_list(*FIELDS)
+
+    def run(self):
+        """
+        Builds the time sheet from the month's snapshot if it has one, or
+        else from its entries.
+        """
+        data = None
+        if self.from_date + relativedelta(months=1) == self.to_date:
+            data = TimesheetSnapshot.objects.get_data(
+                self.from_date, user=self.user)
+        if data is None:
+            return self.build()
+        for field in SNAPSHOT_FIELDS:
+            setattr(self, field, data[field])
+        # JSON has no tuples or Counters, so restore them.
+        self.grouped_totals = [
+            (week, week_totals, [(day, tuple(totals)) for day, totals in days])
+            for week, week_totals, days in self.grouped_totals]
+        self.status_counts = Counter(self.status_counts)
+        return self
+
+    def build(self):
+        """Reads the entries and builds the time sheet from them."""
+        rows = [TimesheetRow(*row) for row in self.get_queryset()]
+        month = [row for row in rows if self.in_month(row)]
+        self.entries = [self.get_entry(row) for row in month]
+        self.grouped_totals = list(self.get_grouped_totals(
+            self.get_week_rows(rows))) if month else ''
+        self.project_entries = self.get_project_entries(month)
+        self.summary = self.get_summary(month)
+        self.status_counts = Counter(row.status for row in month)
+        return self
+
+    def capture(self):
+        """
+        Builds the time sheet from its entries and, if they are all approved
+        or invoiced, stores a snapshot of it. Returns whether it did.
+        """
+        self.build()
+        if not self.status_counts or set(self.status_counts) - set(FINAL_STATUSES):
+            return False
+        data = dict((field, getattr(self, field)) for field in SNAPSHOT_FIELDS)
+        TimesheetSnapshot.objects.store(self.from_date, data, user=self.user)
+        return True
+
+    def in_month(self, row):
+        return utils.add_timezone(row.end_time) >= self.from_date
+
+    def get_entry(self, row):
+        return {
+            'id': row.id,
+            'user': self.user.pk,
+            'user__first_name': self.user.first_name,
+            'user__last_name': self.user.last_name,
+            'date': row.end_time.replace(
+                day=1, hour=0, minute=0, second=0, microsecond=0),
+            'billable': row.project_billable and row.activity_billable,
+            'start_time': row.start_time,
+            'end_time': row.end_time,
+            'comments': row.comments,
+            'seconds_paused': row.seconds_paused,
+            'location__name': row.location_name,
+            'project__name': row.project_name,
+            'activity__name': row.activity_name,
+            'status': row.status,
+            'hours': row.hours,
+        }
+
+    def get_week_rows(self, rows):
+        """
+        Returns the rows to total by day and week. Those of the partial week
+        before the month are only included if the month has entries which
+        started in that week.
+        """
+        if self.first_week < self.from_date:
+            month_week = self.first_week + relativedelta(weeks=1)
+            if not any(self.from_date <= utils.add_timezone(row.start_time) <
+                       month_week for row in rows):
+                return [row for row in rows if self.in_month(row)]
+        return rows
+
+    def get_grouped_totals(self, rows):
+        """
+        Yields (week, week totals, days) for each week with hours, where
+        days lists (day, (day totals, {project name: project totals})).
+        """
+        days = OrderedDict()
+        for row in sorted(rows, key=lambda row: row.end_time):
+            billable = row.project_billable and row.activity_billable
+            totals = {
+                'billable': row.hours if billable else Decimal('0'),
+                'non_billable': Decimal('0') if billable else row.hours,
+                'total': row.hours,
+            }
+            projects = days.setdefault(row.end_time.date(), {})
+            project = projects.setdefault(
+                (row.project_name, row.project), self._empty())
+            for measure, hours in totals.items():
+                project[measure] += hours
+
+        weeks = OrderedDict()
+        for day, projects in days.items():
+            week = utils.get_week_start(day)
+            week_totals, week_days = weeks.setdefault(
+                week, (self._empty(), []))
+            day_totals = self._empty()
+            for project in projects.values():
+                for measure, hours in project.items():
+                    day_totals[measure] += hours
+                    week_totals[measure] += hours
+            week_days.append((day, (day_totals, OrderedDict(
+                (name, projects[name, pk]) for name, pk in sorted(projects)
+                if any(projects[name, pk].values())))))
+        for week, (week_totals, week_days) in weeks.items():
+            yield week, week_totals, week_days
+
+    def get_project_entries(self, rows):
+        totals = OrderedDict()
+        for row in rows:
+            _add(totals, row.project_name, row.hours)
+        return [{'project__name': name, 'sum': hours} for name, hours in
+                sorted(totals.items(), key=lambda item: -item[1])]
+
+    def get_summary(self, rows):
+        """Totals the rows as Entry.summary does, without another query."""
+        leave = dict((pk, name) for name, pk in utils.get_setting(
+            'TIMEPIECE_PAID_LEAVE_PROJECTS').items())
+        totals = {}
+        work, paid_leave = OrderedDict(), OrderedDict()
+        for row in rows:
+            if utils.add_timezone(row.end_time) <= self.from_date:
+                continue
+            _add(totals, 'total', row.hours)
+            if row.status == Entry.INVOICED:
+                _add(totals, 'invoiced', row.hours)
+            else:
+                _add(totals, 'uninvoiced', row.hours)
+            if row.project in leave:
+                _add(totals, 'paid_leave_' + leave[row.project], row.hours)
+                project = paid_leave.setdefault(row.project, {
+                    'project': row.project, 'project__name': row.project_name})
+                _add(project, 'total', row.hours)
+                continue
+            project_type = work.setdefault(row.project_type, {
+                'project__type': row.project_type,
+                'project__type__label': row.project_type_label,
+                'billable': Decimal('0'), 'non_billable': Decimal('0')})
+            if row.project_billable and row.activity_billable:
+                _add(totals, 'billable', row.hours)
+                _add(project_type, 'billable', row.hours)
+            else:
+                _add(totals, 'non_billable', row.hours)
+                _add(project_type, 'non_billable', row.hours)
+        self.work_totals = list(work.values())
+        self.leave_totals = list(paid_leave.values())
+        return Entry._summary_data(totals)
+
+    def _empty(self):
+        return OrderedDict((measure, Decimal('0')) for measure in
+                           ('billable', 'non_billable', 'total'))
+
+
+def get_project_totals(project, from_date, to_date):
+    """
+    Returns the total hours of the project's entries from from_date to
+    to_date, and their totals by user and by activity, most first. The
+    totals of a month are read from its snapshot if it has one.
+    """
+    from_date = utils.add_timezone(from_date)
+    to_date = utils.add_timezone(to_date)
+    data = None
+    if from_date + relativedelta(months=1) == to_date:
+        data = TimesheetSnapshot.objects.get_data(from_date, project=project)
+    if data is None:
+        data = _build_project_totals(project, from_date, to_date)[0]
+    return data
+
+
+def capture_project(project, from_date):
+    """
+    Stores a snapshot of the totals of the project's month if all of its
+    entries are approved or invoiced. Returns whether it did.
+    """
+    from_date = utils.add_timezone(from_date)
+    data, statuses = _build_project_totals(
+        project, from_date, from_date + relativedelta(months=1))
+    if not statuses or statuses - set(FINAL_STATUSES):
+        return False
+    TimesheetSnapshot.objects.store(from_date, data, project=project)
+    return True
+
+
+def _build_project_totals(project, from_date, to_date):
+    entries = Entry.no_join.filter(project=project).timespan(
+        from_date, to_date=to_date).order_by()
+    rows = entries.values('user__first_name', 'user__last_name',
+                          'activity__name', 'status')
+    users, activities = OrderedDict(), OrderedDict()
+    total = None
+    statuses = set()
+    for row in rows.annotate(sum=Sum('hours')):
+        user = (row['user__first_name'], row['user__last_name'])
+        _add(users, user, row['sum'])
+        _add(activities, row['activity__name'], row['sum'])
+        total = (total or Decimal('0')) + row['sum']
+        statuses.add(row['status'])
+
+    def _by_hours(totals):
+        return sorted(totals.items(), key=lambda item: -item[1])
+    return {
+        'total': total,
+        'user_entries': [
+            {'user__first_name': first_name, 'user__last_name': last_name,
+             'sum': hours} for (first_name, last_name), hours in _by_hours(users)],
+        'activity_entries': [
+            {'activity__name': name, 'sum': hours}
+            for name, hours in _by_hours(activities)],
+    }, statuses
+
+
+def capture_snapshots(entries):
+    """
+    Captures the snapshots of the user and project months of the given
+    entries which are now completely approved or invoiced.
+    """
+    if not utils.get_setting('TIMEPIECE_TIMESHEET_SNAPSHOTS'):
+        return
+    entries = entries.order_by().filter(end_time__isnull=False).extra(
+        select={'month': "DATE_TRUNC('month', end_time)"})
+    months = set(entries.values_list('user', 'project', 'month').distinct())
+    users = User.objects.in_bulk(set(user for user, project, month in months))
+    for user, month in sorted(set((user, month) for user, _, month in months)):
+        month = utils.add_timezone(month)
+        Timesheet(users[user], month, month + relativedelta(months=1)).capture()
+    for project, month in sorted(set((project, month) for _, project, month in months)):
+        capture_project(project, month)
+
+
+def change_timesheets(users, from_date, action, chunk_size=50):
+    """
+    Verifies or approves the time sheets of the given users for the month
+    beginning at from_date, as change_user_timesheet does for one user.
+
+    Users are handled chunk_size at a time, each chunk in its own
+    transaction. The users of a chunk are checked for active entries and
+    hours with one grouped query each, and the entries of those which pass
+    are changed with a single UPDATE. As on the time sheet, a month can
+    only be approved once all of its entries are verified, so users who
+    still have unverified entries are reported and left alone. Yields a
+    list of TimesheetChanges, in the order of the users, for each chunk.
+    """
+    from_status, to_status = ACTIONS[action]
+    from_date = utils.add_timezone(from_date)
+    to_date = from_date + relativedelta(months=1)
+    users = list(users)
+    for i in range(0, len(users), chunk_size):
+        yield _change_timesheets(users[i:i + chunk_size], from_date, to_date,
+                                 action, from_status, to_status)
+
+
+@transaction.atomic
+def _change_timesheets(users, from_date, to_date, action, from_status, to_status):
+    user_ids = sorted(user.pk for user in users)
+    # Serialize with other changes to these users' entries.
+    lock_users(user_ids)
+    active = set(Entry.no_join.filter(
+        user__in=user_ids, start_time__lt=to_date, end_time=None,
+        status=Entry.UNVERIFIED).order_by().values_list('user', flat=True))
+    unverified = set()
+    if action == 'approve':
+        unverified = set(Entry.no_join.filter(
+            user__in=user_ids, end_time__gte=from_date, end_time__lt=to_date,
+            status=Entry.UNVERIFIED).order_by().values_list('user', flat=True))
+    entries = Entry.no_join.filter(
+        user__in=user_ids, end_time__gte=from_date, end_time__lt=to_date,
+        status=from_status).order_by()
+    totals = dict(
+        (row['user'], (row['num_entries'], row['hours'])) for row in
+        entries.values('user').annotate(num_entries=Count('id'), hours=Sum('hours')))
+
+    results = []
+    changed = []
+    for user in users:
+        num_entries, hours = totals.get(user.pk, (0, None))
+        if user.pk in active:
+            results.append(TimesheetChange(user, 0, Decimal('0'), ACTIVE_ENTRY_ERROR))
+        elif user.pk in unverified:
+            results.append(TimesheetChange(user, 0, Decimal('0'), UNVERIFIED_ERROR))
+        elif not hours:
+            results.append(TimesheetChange(
+                user, 0, Decimal('0'), NO_HOURS_ERROR.format(action)))
+        else:
+            results.append(TimesheetChange(user, num_entries, hours, None))
+            changed.append(user.pk)
+    if changed:
+        entries.filter(user__in=changed).update(status=to_status)
+        if to_status == Entry.APPROVED:
+            capture_snapshots(Entry.no_join.filter(
+                user__in=changed, end_time__gte=from_date, end_time__lt=to_date))
+    return results
@@ -40,6 +40,9 @@ urlpatterns = [
     url(r'^user/(?P<user_id>\d+)/timesheet/(?P<action>verify|approve)/$',
         views.change_user_timesheet,
         name='change_user_timesheet'),
+    url(r'^user/timesheet/(?P<action>verify|approve)/$',
+        views.change_user_timesheets,
+        name='change_user_timesheets'),
 
     # Projects
     url(r'^project/$',
@@ -18,17 +18,18 @@ from django.views.generic import (
 from timepiece import utils
 from timepiece.forms import YearMonthForm, UserYearMonthForm
 from timepiece.templatetags.timepiece_tags import seconds_to_hours
-from timepiece.utils.csv import CSVViewMixin
+from timepiece.utils.csv import CSVViewMixin, iterate_in_chunks
 from timepiece.utils.search import SearchListView
 from timepiece.utils.views import cbv_decorator, format_totals
 
 from timepiece.crm.forms import (
-    CreateEditBusinessForm, CreateEditProjectForm, EditUserSettingsForm,
+    BulkTimesheetForm, CreateEditBusinessForm, CreateEditProjectForm, EditUserSettingsForm,
     EditProjectRelationshipForm, SelectProjectForm, EditUserForm,
     CreateUserForm, SelectUserForm, ProjectSearchForm, QuickSearchForm)
 from timepiece.crm.models import Business, Project, ProjectRelationship
-from timepiece.crm.utils import grouped_totals
-from timepiece.entries.models import Entry
+from timepiece.crm.timesheet import (
+    ACTIONS, Timesheet, capture_snapshots, change_timesheets, get_project_totals)
+from timepiece.entries.models import Entry, TimesheetPeriod
 
 
 @cbv_decorator(login_required)
@@ -56,9 +57,12 @@ def reject_user_timesheet(request, user_id):
             status=Entry.VERIFIED, user=user, start_time__gte=from_date,
             end_time__lte=to_date)
         if request.POST.get('yes'):
-            if entries.exists():
-                count = entries.count()
-                Entry.no_join.filter(pk__in=entries).update(status=Entry.UNVERIFIED)
+            # Approved and invoiced months have no verified entries left.
+            count = 0
+            status = TimesheetPeriod.objects.get_status(user, from_date)
+            if status not in TimesheetPeriod.LOCKED:
+                count = entries.update(status=Entry.UNVERIFIED)
+            if count:
                 msg = 'You have rejected %d previously verified entries.' \
                     % count
             else:
@@ -111,41 +115,17 @@ def view_user_timesheet(request, user_id, active_tab):
         from_date = utils.get_month_start()
         to_date = from_date + relativedelta(months=1)
 
-    entries_qs = Entry.objects.filter(user=user)
-    month_qs = entries_qs.timespan(from_date, span='month')
-    extra_values = ('start_time', 'end_time', 'comments', 'seconds_paused',
-                    'id', 'location__name', 'project__name', 'activity__name',
-                    'status')
-    month_entries = month_qs.date_trunc('month', extra_values).order_by('start_time')
-    # For grouped entries, back date up to the start of the week.
-    first_week = utils.get_week_start(from_date)
-    month_week = first_week + relativedelta(weeks=1)
-    grouped_qs = entries_qs.timespan(first_week, to_date=to_date)
-    intersection = grouped_qs.filter(
-        start_time__lt=month_week, start_time__gte=from_date)
-    # If the month of the first week starts in the previous
-    # month and we dont have entries in that previous ISO
-    # week, then update the first week to start at the first
-    # of the actual month
-    if not intersection and first_week.month < from_date.month:
-        grouped_qs = entries_qs.timespan(from_date, to_date=to_date)
-    totals = grouped_totals(grouped_qs) if month_entries else ''
-    project_entries = month_qs.order_by().values(
-        'project__name').annotate(sum=Sum('hours')).order_by('-sum')
-    summary = Entry.summary(user, from_date, to_date)
+    timesheet = Timesheet(user, from_date, to_date).run()
+    statuses = timesheet.status_counts
+    total_statuses = sum(statuses.values())
+    unverified_count = statuses[Entry.UNVERIFIED]
+    verified_count = statuses[Entry.VERIFIED]
+    approved_count = statuses[Entry.APPROVED]
 
     show_approve = show_verify = False
-    can_change = request.user.has_perm('entries.change_entry')
-    can_approve = request.user.has_perm('entries.approve_timesheet')
-    if can_change or can_approve or user == request.user:
-        statuses = list(month_qs.values_list('status', flat=True))
-        total_statuses = len(statuses)
-        unverified_count = statuses.count(Entry.UNVERIFIED)
-        verified_count = statuses.count(Entry.VERIFIED)
-        approved_count = statuses.count(Entry.APPROVED)
-    if can_change or user == request.user:
+    if request.user.has_perm('entries.change_entry') or user == request.user:
         show_verify = unverified_count != 0
-    if can_approve:
+    if request.user.has_perm('entries.approve_timesheet'):
         show_approve = all([
             verified_count + approved_count == total_statuses,
             verified_count > 0,
@@ -160,10 +140,10 @@ def view_user_timesheet(request, user_id, active_tab):
         'show_verify': show_verify,
         'show_approve': show_approve,
         'timesheet_user': user,
-        'entries': month_entries,
-        'grouped_totals': totals,
-        'project_entries': project_entries,
-        'summary': summary,
+        'entries': timesheet.entries,
+        'grouped_totals': timesheet.grouped_totals,
+        'project_entries': timesheet.project_entries,
+        'summary': timesheet.summary,
     })
 
 
@@ -201,6 +181,10 @@ def change_user_timesheet(request, user_id, action):
         'verify': Entry.UNVERIFIED,
         'approve': Entry.VERIFIED,
     }
+    update_status = {
+        'verify': Entry.VERIFIED,
+        'approve': Entry.APPROVED,
+    }
     entries = entries.filter(status=filter_status[action])
 
     return_url = reverse('view_user_timesheet', args=(user_id,))
@@ -208,6 +192,13 @@ def change_user_timesheet(request, user_id, action):
         'year': from_date.year,
         'month': from_date.month,
     })
+    no_hours_msg = 'You cannot verify/approve a timesheet with no hours'
+    # A month which is already past the action has no entries to change.
+    statuses = list(TimesheetPeriod.STATUSES)
+    status = TimesheetPeriod.objects.get_status(user, from_date)
+    if statuses.index(status) >= statuses.index(update_status[action]):
+        messages.error(request, no_hours_msg)
+        return redirect(return_url)
     if active_entries:
         msg = 'You cannot verify/approve this timesheet while the user {0} ' \
             'has an active entry. Please have them close any active ' \
@@ -215,17 +206,15 @@ def change_user_timesheet(request, user_id, action):
         messages.error(request, msg)
         return redirect(return_url)
     if request.POST.get('do_action') == 'Yes':
-        update_status = {
-            'verify': 'verified',
-            'approve': 'approved',
-        }
-        Entry.no_join.filter(pk__in=entries).update(status=update_status[action])
+        entries.update(status=update_status[action])
+        if action == 'approve':
+            capture_snapshots(Entry.no_join.filter(
+                user=user_id, end_time__gte=from_date, end_time__lt=to_date))
         messages.info(request, 'Your entries have been %s' % update_status[action])
         return redirect(return_url)
     hours = entries.all().aggregate(s=Sum('hours'))['s']
     if not hours:
-        msg = 'You cannot verify/approve a timesheet with no hours'
-        messages.error(request, msg)
+        messages.error(request, no_hours_msg)
         return redirect(return_url)
     return render(request, 'timepiece/user/timesheet/change.html', {
         'action': action,
@@ -237,6 +226,25 @@ def change_user_timesheet(request, user_id, action):
     })
 
 
+@permission_required('entries.view_entry_summary')
+def change_user_timesheets(request, action):
+    """Verifies or approves the time sheets of many users for a month."""
+    form = BulkTimesheetForm(request.POST or None)
+    results = []
+    if form.is_valid():
+        from_date, to_date = form.save()
+        for chunk in change_timesheets(form.get_users(), from_date, action):
+            results.extend(chunk)
+        changed = [result for result in results if not result.error]
+        messages.info(request, '{0} of {1} time sheets have been {2}.'.format(
+            len(changed), len(results), ACTIONS[action][1]))
+    return render(request, 'timepiece/user/timesheet/bulk_change.html', {
+        'action': action,
+        'form': form,
+        'results': results,
+    })
+
+
 # Project timesheets
 
 
@@ -276,20 +284,16 @@ class ProjectTimesheet(DetailView):
                         'activity__name', 'status')
 
         month_entries = entries_qs.date_trunc('month', extra_values).order_by('start_time')
-        if month_entries:
-            format_totals(month_entries, "hours")
+        month_entries = self.format_entries(month_entries)
 
-        total = entries_qs.aggregate(hours=Sum('hours'))['hours']
+        totals = get_project_totals(project, from_date, to_date)
+        total = totals['total']
         if total:
             total = "{0:.2f}".format(total)
-        user_entries = entries_qs.order_by().values('user__first_name', 'user__last_name')
-        user_entries = user_entries.annotate(sum=Sum('hours')).order_by('-sum')
-        if user_entries:
-            format_totals(user_entries)
-        activity_entries = entries_qs.order_by().values('activity__name')
-        activity_entries = activity_entries.annotate(sum=Sum('hours')).order_by('-sum')
-        if activity_entries:
-            format_totals(activity_entries)
+        user_entries = totals['user_entries']
+        format_totals(user_entries)
+        activity_entries = totals['activity_entries']
+        format_totals(activity_entries)
 
         context.update({
             'project': project,
@@ -303,6 +307,11 @@ class ProjectTimesheet(DetailView):
         })
         return context
 
+    def format_entries(self, entries):
+        if entries:
+            format_totals(entries, "hours")
+        return entries
+
 
 class ProjectTimesheetCSV(CSVViewMixin, ProjectTimesheet):
 
@@ -311,9 +320,12 @@ class ProjectTimesheetCSV(CSVViewMixin, ProjectTimesheet):
         to_date_str = context['to_date'].strftime('%m-%d-%Y')
         return 'Project_timesheet {0} {1}'.format(project, to_date_str)
 
+    def format_entries(self, entries):
+        # Entries are read in chunks and formatted as they are written.
+        return entries
+
     def convert_context_to_csv(self, context):
-        rows = []
-        rows.append([
+        yield [
             'Date',
             'User',
             'Activity',
@@ -322,9 +334,11 @@ class ProjectTimesheetCSV(CSVViewMixin, ProjectTimesheet):
             'Time Out',
             'Breaks',
             'Hours',
-        ])
-        for entry in context['entries']:
-            data = [
+        ]
+        entries = iterate_in_chunks(context['entries'], ('start_time', 'id'))
+        for entry in entries:
+            hours = entry['hours']
+            yield [
                 entry['start_time'].strftime('%x'),
                 entry['user__first_name'] + ' ' + entry['user__last_name'],
                 entry['activity__name'],
@@ -332,12 +346,10 @@ class ProjectTimesheetCSV(CSVViewMixin, ProjectTimesheet):
                 entry['start_time'].strftime('%X'),
                 entry['end_time'].strftime('%X'),
                 seconds_to_hours(entry['seconds_paused']),
-                entry['hours'],
+                "{0:.2f}".format(hours) if hours else hours,
             ]
-            rows.append(data)
         total = context['total']
-        rows.append(('', '', '', '', '', '', 'Total:', total))
-        return rows
+        yield ('', '', '', '', '', '', 'Total:', total)
 
 
 # Businesses
@@ -8,3 +8,17 @@ class TimepieceDefaults(object):
     TIMEPIECE_ACCOUNTING_EMAILS = []
 
     TIMEPIECE_EMAILS_USE_HTTPS = True
+
+    TIMEPIECE_ENTRY_OVERLAP_CONSTRAINT = False
+
+    TIMEPIECE_USE_ENTRY_ROLLUPS = False
+
+    TIMEPIECE_TIMESHEET_SNAPSHOTS = False
+
+    TIMEPIECE_ACTIVE_ENTRY_CACHE = None
+
+    TIMEPIECE_QUICK_CLOCK_IN_CACHE = None
+
+    TIMEPIECE_SEARCH_CACHE = None
+
+    TIMEPIECE_STREAM_CSV = False
@@ -2,13 +2,13 @@ import datetime
 from dateutil.relativedelta import relativedelta
 
 from django import forms
-from django.db.models import Q
+from django.contrib.auth.models import User
 
 from selectable import forms as selectable
 
 from timepiece import utils
 from timepiece.crm.models import Project, ProjectRelationship
-from timepiece.entries.models import Entry, Location, ProjectHours
+from timepiece.entries.models import Entry, Location, ProjectHours, TimesheetPeriod
 from timepiece.entries.lookups import ActivityLookup
 from timepiece.forms import (
     INPUT_FORMATS, TimepieceSplitDateTimeField, TimepieceDateInput)
@@ -145,7 +145,8 @@ class AddUpdateEntryForm(forms.ModelForm):
     def clean(self):
         """
         If we're not editing the active entry, ensure that this entry doesn't
-        conflict with or come after the active entry.
+        conflict with or come after the active entry. Entries can't be added
+        to months whose time sheets have been approved or invoiced.
         """
         active = utils.get_active_entry(self.user)
         start_time = self.cleaned_data.get('start_time', None)
@@ -163,17 +164,15 @@ class AddUpdateEntryForm(forms.ModelForm):
                         start_time=active.start_time.strftime('%H:%M:%S'),
                     ))
 
-        month_start = utils.get_month_start(start_time)
-        next_month = month_start + relativedelta(months=1)
-        entries = self.instance.user.timepiece_entries.filter(
-            Q(status=Entry.APPROVED) | Q(status=Entry.INVOICED),
-            start_time__gte=month_start,
-            end_time__lt=next_month
-        )
         entry = self.instance
-
         if not self.acting_user.is_superuser:
-            if (entries.exists() and not entry.id or entry.id and entry.status == Entry.INVOICED):
+            if entry.id:
+                locked = entry.status == Entry.INVOICED
+            else:
+                # Periods are keyed by the month in which entries end.
+                locked = TimesheetPeriod.objects.is_locked(
+                    entry.user, end_time or start_time or utils.get_month_start())
+            if locked:
                 message = 'You cannot add/edit entries after a timesheet has been ' \
                     'approved or invoiced. Please correct the start and end times.'
                 raise forms.ValidationError(message)
@@ -196,6 +195,40 @@ class ProjectHoursForm(forms.ModelForm):
         return ph
 
 
+class ProjectHoursCopyForm(forms.Form):
+    week_update = forms.DateField(
+        label='First week', input_formats=INPUT_FORMATS)
+    weeks = forms.IntegerField(
+        label='Number of weeks', min_value=1, max_value=52, required=False)
+    source_week = forms.DateField(
+        label='Copy from', input_formats=INPUT_FORMATS, required=False,
+        help_text='Defaults to the week before the first week.')
+    projects = forms.ModelMultipleChoiceField(
+        Project.objects.all(), required=False)
+    users = forms.ModelMultipleChoiceField(
+        User.objects.all(), required=False)
+
+    def clean(self):
+        data = super(ProjectHoursCopyForm, self).clean()
+        if data.get('week_update'):
+            first = utils.get_week_start(data['week_update']).date()
+            data['targets'] = [first + relativedelta(weeks=i)
+                               for i in range(data.get('weeks') or 1)]
+            source = data.get('source_week') or first - relativedelta(weeks=1)
+            data['source_week'] = utils.get_week_start(source).date()
+            if data['source_week'] in data['targets']:
+                raise forms.ValidationError(
+                    'Hours cannot be copied into the week they are copied from.')
+        return data
+
+    def save(self):
+        """Copies the hours, and returns the number of hours created."""
+        data = self.cleaned_data
+        return ProjectHours.objects.copy_week(
+            data['source_week'], data['targets'],
+            projects=data['projects'] or None, users=data['users'] or None)
+
+
 class ProjectHoursSearchForm(forms.Form):
     week_start = forms.DateField(
         label='Week of', required=False,
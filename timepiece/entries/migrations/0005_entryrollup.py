@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('crm', '0003_auto_20151119_0906'),
+        ('entries', '0004_entry_overlap_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EntryRollup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('day', models.DateField()),
+                ('status', models.CharField(max_length=24, choices=[('unverified', 'Unverified'), ('verified', 'Verified'), ('approved', 'Approved'), ('invoiced', 'Invoiced'), ('not-invoiced', 'Not Invoiced')])),
+                ('hours', models.DecimalField(default=0, max_digits=15, decimal_places=5)),
+                ('activity', models.ForeignKey(related_name='entry_rollups', to='entries.Activity')),
+                ('project', models.ForeignKey(related_name='entry_rollups', to='crm.Project')),
+                ('user', models.ForeignKey(related_name='timepiece_entry_rollups', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'timepiece_entryrollup',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='entryrollup',
+            unique_together=set([('user', 'project', 'activity', 'day', 'status')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='entryrollup',
+            index_together=set([('day', 'user')]),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('crm', '0003_auto_20151119_0906'),
+        ('entries', '0005_entryrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimesheetSnapshot',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('month', models.DateField()),
+                ('key', models.CharField(max_length=32)),
+                ('data', models.TextField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('project', models.ForeignKey(related_name='snapshots', blank=True, to='crm.Project', null=True)),
+                ('user', models.ForeignKey(related_name='timepiece_snapshots', blank=True, to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+            options={
+                'db_table': 'timepiece_timesheetsnapshot',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='timesheetsnapshot',
+            index_together=set([('user', 'month'), ('project', 'month')]),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+# The status of a month which each entry status allows, the order in which a
+# month's status advances, and the entry statuses which lock a month.
+ENTRY_STATUSES = {
+    'unverified': 'open',
+    'verified': 'verified',
+    'approved': 'approved',
+    'invoiced': 'invoiced',
+    'not-invoiced': 'invoiced',
+}
+ORDER = ['open', 'verified', 'approved', 'invoiced']
+LOCKED = ('approved', 'invoiced')
+
+
+def build_periods(apps, schema_editor):
+    Entry = apps.get_model('entries', 'Entry')
+    TimesheetPeriod = apps.get_model('entries', 'TimesheetPeriod')
+    entries = Entry.objects.filter(end_time__isnull=False).order_by()
+    entries = entries.extra(select={'month': "DATE_TRUNC('month', end_time)"})
+    statuses, locked = {}, set()
+    for user, month, status in entries.values_list('user', 'month', 'status').distinct():
+        key = (user, month.date().replace(day=1))
+        status = ENTRY_STATUSES[status]
+        statuses[key] = min(statuses.get(key, status), status, key=ORDER.index)
+        if status in LOCKED:
+            locked.add(key)
+    TimesheetPeriod.objects.bulk_create([
+        TimesheetPeriod(user_id=user, month=month, status=status,
+                        locked=(user, month) in locked)
+        for (user, month), status in statuses.items()], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('entries', '0006_timesheetsnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimesheetPeriod',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('month', models.DateField()),
+                ('status', models.CharField(default='open', max_length=24, choices=[('open', 'Open'), ('verified', 'Verified'), ('approved', 'Approved'), ('invoiced', 'Invoiced')])),
+                ('locked', models.BooleanField(default=False)),
+                ('user', models.ForeignKey(related_name='timepiece_periods', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'timepiece_timesheetperiod',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='timesheetperiod',
+            unique_together=set([('user', 'month')]),
+        ),
+        migrations.RunPython(build_periods, migrations.RunPython.noop),
+    ]
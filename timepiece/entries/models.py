@@ -1,18 +1,65 @@
 from collections import OrderedDict
+import datetime
 from decimal import Decimal
+import hashlib
+import json
 
+from dateutil import parser as dateutil_parser
 from dateutil.relativedelta import relativedelta
 
 from django.contrib.auth.models import User
 from django.core import validators
-from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models import F, Q, Sum, Max, Min
+from django.core.exceptions import FieldError, ValidationError
+from django.db import connection, connections, models, transaction, IntegrityError
+from django.db.models import F, Q, Sum, Max, Min, Case, Value, When
 from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 
 from timepiece import utils
-from timepiece.crm.models import Project
+from timepiece.crm.models import Project, ProjectRelationship
+
+
+# Name of the optional Postgres exclusion constraint which prevents a user's
+# closed entries from overlapping. See TIMEPIECE_ENTRY_OVERLAP_CONSTRAINT, and
+# the entry_overlap_constraint management command which installs it.
+OVERLAP_CONSTRAINT = 'timepiece_entry_no_overlap'
+OVERLAP_RANGE_SQL = "tstzrange(start_time, end_time, '[]')"
+OVERLAP_CONSTRAINT_SQL = [
+    'CREATE EXTENSION IF NOT EXISTS btree_gist',
+    'ALTER TABLE timepiece_entry ADD CONSTRAINT {0} EXCLUDE USING gist '
+    '(user_id WITH =, {1} WITH &&) WHERE (end_time IS NOT NULL)'.format(
+        OVERLAP_CONSTRAINT, OVERLAP_RANGE_SQL),
+]
+
+# Whether each database has the overlap constraint, once it has been looked up.
+_overlap_constraints = {}
+
+
+def has_overlap_constraint(refresh=False):
+    """
+    Whether the overlap constraint is installed in the database. This is
+    only looked up once per process, unless refresh is given.
+    """
+    if refresh or connection.alias not in _overlap_constraints:
+        exists = False
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT 1 FROM pg_constraint WHERE conname = %s',
+                    [OVERLAP_CONSTRAINT])
+                exists = cursor.fetchone() is not None
+        _overlap_constraints[connection.alias] = exists
+    return _overlap_constraints[connection.alias]
+
+
+def uses_overlap_constraint():
+    """
+    Whether overlapping entries are prevented by the database: the setting
+    is enabled and the constraint has been installed.
+    """
+    return (connection.vendor == 'postgresql' and
+            utils.get_setting('TIMEPIECE_ENTRY_OVERLAP_CONSTRAINT') and
+            has_overlap_constraint())
 
 
 @python_2_unicode_compatible
@@ -37,6 +84,15 @@ class Activity(models.Model):
         ordering = ('name',)
         verbose_name_plural = 'activities'
 
+    def save(self, *args, **kwargs):
+        # Time sheet snapshots total billable hours by activity, and show
+        # its name.
+        changed = self.pk and Activity.objects.filter(pk=self.pk).exclude(
+            billable=self.billable, name=self.name).exists()
+        super(Activity, self).save(*args, **kwargs)
+        if changed:
+            TimesheetSnapshot.objects.forget_all()
+
 
 @python_2_unicode_compatible
 class ActivityGroup(models.Model):
@@ -62,9 +118,123 @@ class Location(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        # Time sheet snapshots show the location of each entry.
+        changed = self.pk and Location.objects.filter(pk=self.pk).exclude(
+            name=self.name).exists()
+        super(Location, self).save(*args, **kwargs)
+        if changed:
+            TimesheetSnapshot.objects.forget_all()
+
+
+# Entry lookups which can be answered from EntryRollup rows. Lookups on
+# end_time are translated to lookups on the rollup's day.
+ROLLUP_LOOKUPS = ('user', 'project', 'activity', 'status', 'billable')
+
+# Entry fields whose changes require the affected rollups to be rebuilt.
+ROLLUP_FIELDS = ('user', 'project', 'activity', 'status', 'end_time', 'hours')
+
+# Entry fields whose changes require the affected TimesheetPeriods to be
+# recomputed.
+PERIOD_FIELDS = ('user', 'status', 'end_time')
+
+
+# Key space of the advisory locks taken by lock_users().
+USER_LOCK_NAMESPACE = 1349
+
+
+def lock_users(users):
+    """
+    Takes a transaction-level lock on each of the given users' ids, in
+    order, so that concurrent refreshes of the rows derived from their
+    entries don't interleave. Unlike a row lock on the users themselves, it
+    doesn't block other writes to them, such as logging in.
+    """
+    users = sorted(users)
+    if not users:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT pg_advisory_xact_lock(%s, id) '
+            'FROM unnest(%s) AS id ORDER BY id',
+            [USER_LOCK_NAMESPACE, users])
+
+
+class RollupUnavailable(Exception):
+    """The lookup can not be answered from EntryRollup rows."""
+    pass
+
+
+def _rollup_day(value):
+    """Returns the date of a date, or of a datetime at midnight."""
+    if isinstance(value, datetime.datetime):
+        if value.time() != datetime.time():
+            raise RollupUnavailable('{0} is not a day boundary'.format(value))
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    raise RollupUnavailable('{0!r} is not a date'.format(value))
+
+
+def _rollup_lookup(key, value, negated=False, strict=True):
+    parts = key.split('__')
+    if parts[0] == 'end_time':
+        lookup = parts[1] if len(parts) > 1 else 'exact'
+        if lookup == 'isnull' and value is False and not negated:
+            return ('pk__isnull', False)  # Rollups only count closed entries.
+        if lookup in ('gte', 'lt') and not negated:
+            return ('day__' + lookup, _rollup_day(value))
+        raise RollupUnavailable('Unsupported end_time lookup: {0}'.format(key))
+    if parts[0] in ROLLUP_LOOKUPS or not strict:
+        return (key, value)
+    raise RollupUnavailable('Unsupported lookup: {0}'.format(key))
+
+
+def rollup_q(node, negated=False, strict=True):
+    """
+    Translates a Q object or lookup on Entry to one on EntryRollup. Unless
+    strict, lookups which are not on end_time are passed through unchanged.
+    """
+    if not isinstance(node, Q):
+        return _rollup_lookup(node[0], node[1], negated, strict)
+    q = Q()
+    q.connector = node.connector
+    q.negated = node.negated
+    q.children = [rollup_q(child, negated != node.negated, strict)
+                  for child in node.children]
+    return q
+
+
+def _bounds_end_time(negate, args, kwargs):
+    """
+    Whether a filter() call restricts entries to a range of end times, and
+    therefore to closed entries only.
+    """
+    if negate:
+        return False
+    keys = list(kwargs)
+    for q in args:
+        if isinstance(q, Q) and not q.negated and (
+                q.connector == Q.AND or len(q.children) == 1):
+            keys.extend(child[0] for child in q.children if not isinstance(child, Q))
+    return any(key in ('end_time__gte', 'end_time__lt') for key in keys)
+
 
 class EntryQuerySet(models.query.QuerySet):
     """QuerySet extension to provide filtering by billable status"""
+    # The filter() and exclude() calls made so far, so that they can be
+    # replayed against EntryRollup.
+    _lookups = ()
+
+    def _clone(self, *args, **kwargs):
+        clone = super(EntryQuerySet, self)._clone(*args, **kwargs)
+        clone._lookups = self._lookups
+        return clone
+
+    def _filter_or_exclude(self, negate, *args, **kwargs):
+        clone = super(EntryQuerySet, self)._filter_or_exclude(negate, *args, **kwargs)
+        clone._lookups = self._lookups + ((negate, args, kwargs),)
+        return clone
 
     def date_trunc(self, key='month', extra_values=None):
         select = {
@@ -77,7 +247,13 @@ class EntryQuerySet(models.query.QuerySet):
             'user', 'date', 'user__first_name', 'user__last_name', 'billable',
         )
         extra_values = extra_values or ()
-        qs = self.extra(select=select[key])
+        qs = self.get_rollups(extra_values)
+        if qs is not None:
+            qs = qs.extra(select={
+                'date': "DATE_TRUNC('{0}', day::timestamp)".format(key),
+            })
+        else:
+            qs = self.extra(select=select[key])
         qs = qs.values(*basic_values + extra_values)
         qs = qs.annotate(hours=Sum('hours')).order_by(
             'user__last_name',
@@ -86,6 +262,138 @@ class EntryQuerySet(models.query.QuerySet):
             'date')
         return qs
 
+    def get_rollups(self, values=()):
+        """
+        Returns the EntryRollup rows equivalent to this queryset, or None if
+        rollups are disabled or the filters or values require the entries
+        themselves.
+
+        Rollups can be used when every filter is on the user, project,
+        activity or status, or on end_time at day boundaries, and at least
+        one filter restricts the range of end times.
+        """
+        if not utils.get_setting('TIMEPIECE_USE_ENTRY_ROLLUPS'):
+            return None
+        query = self.query
+        if query.extra or query.distinct or query.low_mark or query.high_mark is not None:
+            return None
+        if any(value.split('__')[0] not in ROLLUP_LOOKUPS for value in values):
+            return None
+        if not any(_bounds_end_time(*lookup) for lookup in self._lookups):
+            return None
+        rollups = EntryRollup.objects.all()
+        try:
+            for negate, args, kwargs in self._lookups:
+                args = [rollup_q(q) for q in args]
+                kwargs = dict(_rollup_lookup(k, v) for k, v in kwargs.items())
+                method = rollups.exclude if negate else rollups.filter
+                rollups = method(*args, **kwargs)
+        except RollupUnavailable:
+            return None
+        return rollups
+
+    def _get_rollup_scope(self):
+        """
+        Returns the users and the range of days whose rollups may include
+        these entries.
+        """
+        entries = self.order_by().filter(end_time__isnull=False)
+        span = entries.aggregate(start=Min('end_time'), end=Max('end_time'))
+        if span['start'] is None:
+            return None
+        users = set(entries.values_list('user', flat=True).distinct())
+        return users, span['start'].date(), span['end'].date()
+
+    def _get_cached_users(self, **kwargs):
+        """
+        Returns the users whose shared active entries and quick clock in
+        projects must be discarded after these entries change, if either is
+        cached at all.
+        """
+        if not (utils.get_active_entry_cache() or
+                utils.get_quick_clock_in_cache()):
+            return []
+        users = set(self.order_by().values_list('user', flat=True).distinct())
+        if isinstance(kwargs.get('user'), (int, User)):
+            users.add(getattr(kwargs['user'], 'pk', kwargs['user']))
+        return users
+
+    def _get_snapshot_scope(self, **kwargs):
+        """
+        Returns the users, projects and range of days whose timesheet
+        snapshots may include these entries, before and after they are
+        updated with kwargs, or None if they have no closed entries.
+        """
+        entries = self.order_by().filter(end_time__isnull=False)
+        rows = list(entries.values_list('user', 'project').annotate(
+            start=Min('end_time'), end=Max('end_time')))
+        users = set(row[0] for row in rows)
+        projects = set(row[1] for row in rows)
+        days = [day.date() for row in rows for day in row[2:]]
+        for field, keys in (('user', users), ('project', projects)):
+            if isinstance(kwargs.get(field), (int, models.Model)):
+                keys.add(getattr(kwargs[field], 'pk', kwargs[field]))
+        if isinstance(kwargs.get('end_time'), datetime.datetime):
+            days.append(kwargs['end_time'].date())
+        if not days:
+            return None
+        return users, projects, min(days), max(days)
+
+    def update(self, **kwargs):
+        """
+        Updates the entries, then rebuilds their rollups if necessary and
+        discards their users' shared active entries, quick clock in projects
+        and timesheet snapshots.
+        """
+        cached_users = self._get_cached_users(**kwargs)
+        snapshots = self._get_snapshot_scope(**kwargs)
+        rows = self._update_with_rollups(**kwargs)
+        utils.forget_active_entries(cached_users)
+        utils.forget_quick_clock_in(cached_users)
+        if snapshots:
+            TimesheetSnapshot.objects.forget(*snapshots)
+        return rows
+
+    def _update_with_rollups(self, **kwargs):
+        if not any(field in kwargs for field in ROLLUP_FIELDS):
+            return super(EntryQuerySet, self).update(**kwargs)
+        with transaction.atomic():
+            scope = self._get_rollup_scope()
+            rows = super(EntryQuerySet, self).update(**kwargs)
+            if scope:
+                users, start, end = scope
+                if isinstance(kwargs.get('user'), (int, User)):
+                    users.add(getattr(kwargs['user'], 'pk', kwargs['user']))
+                if isinstance(kwargs.get('end_time'), datetime.datetime):
+                    start = min(start, kwargs['end_time'].date())
+                    end = max(end, kwargs['end_time'].date())
+                lock_users(users)
+                EntryRollup.objects.refresh(users, start, end, lock=False)
+                if any(field in kwargs for field in PERIOD_FIELDS):
+                    TimesheetPeriod.objects.refresh(users, start, end, lock=False)
+        return rows
+
+    def delete(self):
+        """
+        Deletes the entries, then rebuilds their rollups and discards their
+        users' shared active entries, quick clock in projects and timesheet
+        snapshots.
+        """
+        cached_users = self._get_cached_users()
+        snapshots = self._get_snapshot_scope()
+        with transaction.atomic():
+            scope = self._get_rollup_scope()
+            super(EntryQuerySet, self).delete()
+            if scope:
+                lock_users(scope[0])
+                EntryRollup.objects.refresh(*scope, lock=False)
+                TimesheetPeriod.objects.refresh(*scope, lock=False)
+        utils.forget_active_entries(cached_users)
+        utils.forget_quick_clock_in(cached_users)
+        if snapshots:
+            TimesheetSnapshot.objects.forget(*snapshots)
+    delete.queryset_only = True
+
     def timespan(self, from_date, to_date=None, span=None, current=False):
         """
         Takes a beginning date a filters entries. An optional to_date can be
@@ -193,12 +501,13 @@ class Entry(models.Model):
 
     objects = EntryManager()
     worked = EntryWorkedManager()
-    no_join = models.Manager()
+    no_join = EntryQuerySet.as_manager()
 
     class Meta:
         db_table = 'timepiece_entry'  # Using legacy table name
         ordering = ('-start_time',)
         verbose_name_plural = 'entries'
+        index_together = (('user', 'start_time', 'end_time'),)
         permissions = (
             ('can_clock_in', 'Can use Pendulum to clock in'),
             ('can_pause', 'Can pause and unpause log entries'),
@@ -243,18 +552,21 @@ class Entry(models.Model):
 
     def is_overlapping(self):
         if self.start_time and self.end_time:
-            entries = self.user.timepiece_entries.filter(
-                Q(end_time__range=(self.start_time, self.end_time)) |
-                Q(start_time__range=(self.start_time, self.end_time)) |
-                Q(start_time__lte=self.start_time, end_time__gte=self.end_time)
-            )
-
-            totals = entries.aggregate(max=Max('end_time'), min=Min('start_time'))
-
-            totals['total'] = 0
-            for entry in entries:
-                totals['total'] = totals['total'] + entry.get_total_seconds()
+            entries = list(Entry.no_join.filter(
+                Q(end_time__gte=self.start_time) |
+                Q(end_time__isnull=True, start_time__gte=self.start_time),
+                user=self.user_id,
+                start_time__lte=self.end_time,
+            ))
+            end_times = [entry.end_time for entry in entries if entry.end_time]
+            if not end_times:
+                return False
 
+            totals = {
+                'max': max(end_times),
+                'min': min(entry.start_time for entry in entries),
+                'total': sum(entry.get_total_seconds() for entry in entries),
+            }
             totals['diff'] = totals['max'] - totals['min']
             totals['diff'] = totals['diff'].seconds + \
                 totals['diff'].days * 86400
@@ -266,51 +578,67 @@ class Entry(models.Model):
         else:
             return None
 
+    def get_overlapping_entries(self, start, end):
+        """
+        Returns this user's other closed entries which conflict with the
+        given time span (inclusive of both ends).
+
+        When the overlap constraint is installed this is a single probe of
+        its GiST index; otherwise it is a range scan of the (user,
+        start_time, end_time) index.
+        """
+        entries = Entry.no_join.filter(user=self.user_id, end_time__isnull=False)
+        # An entry can not conflict with itself so remove it from the list
+        if self.pk:
+            entries = entries.exclude(pk=self.pk)
+        if uses_overlap_constraint():
+            entries = entries.extra(
+                where=[OVERLAP_RANGE_SQL + " && tstzrange(%s, %s, '[]')"],
+                params=[start, end])
+        else:
+            entries = entries.filter(start_time__lte=end, end_time__gte=start)
+        return entries.select_related('project__business', 'activity')
+
+    def get_overlap_error(self, entry, start, end):
+        """Returns the ValidationError describing a conflict with entry."""
+        entry_data = {
+            'project': entry.project,
+            'activity': entry.activity,
+            'start_time': entry.start_time,
+            'end_time': entry.end_time
+        }
+        if entry.start_time.date() == start.date() and entry.end_time.date() == end.date():
+            entry_data['start_time'] = entry.start_time.strftime(
+                '%H:%M:%S')
+            entry_data['end_time'] = entry.end_time.strftime(
+                '%H:%M:%S')
+            return ValidationError('Start time overlaps with '
+                                   '{activity} on {project} from {start_time} to '
+                                   '{end_time}.'.format(**entry_data))
+        else:
+            entry_data['start_time'] = entry.start_time.strftime(
+                '%H:%M:%S on %m\%d\%Y')
+            entry_data['end_time'] = entry.end_time.strftime(
+                '%H:%M:%S on %m\%d\%Y')
+            return ValidationError(
+                'Start time overlaps with {activity} on {project} '
+                'from {start_time} to {end_time}.'.format(**entry_data))
+
+    def get_time_span(self):
+        """Current entries have no end_time, so they span one second."""
+        end = self.end_time or self.start_time + relativedelta(seconds=1)
+        return self.start_time, end
+
     def clean(self):
         if not self.user_id:
             raise ValidationError('An unexpected error has occured')
         if not self.start_time:
             raise ValidationError('Please enter a valid start time')
-        start = self.start_time
+        start, end = self.get_time_span()
 
-        if self.end_time:
-            end = self.end_time
-        # Current entries have no end_time
-        else:
-            end = start + relativedelta(seconds=1)
-
-        entries = self.user.timepiece_entries.filter(
-            Q(end_time__range=(start, end)) |
-            Q(start_time__range=(start, end)) |
-            Q(start_time__lte=start, end_time__gte=end))
-        # An entry can not conflict with itself so remove it from the list
-        if self.id:
-            entries = entries.exclude(pk=self.id)
-        for entry in entries:
-            entry_data = {
-                'project': entry.project,
-                'activity': entry.activity,
-                'start_time': entry.start_time,
-                'end_time': entry.end_time
-            }
-            # Conflicting saved entries
-            if entry.end_time:
-                if entry.start_time.date() == start.date() and entry.end_time.date() == end.date():
-                    entry_data['start_time'] = entry.start_time.strftime(
-                        '%H:%M:%S')
-                    entry_data['end_time'] = entry.end_time.strftime(
-                        '%H:%M:%S')
-                    raise ValidationError('Start time overlaps with '
-                                          '{activity} on {project} from {start_time} to '
-                                          '{end_time}.'.format(**entry_data))
-                else:
-                    entry_data['start_time'] = entry.start_time.strftime(
-                        '%H:%M:%S on %m\%d\%Y')
-                    entry_data['end_time'] = entry.end_time.strftime(
-                        '%H:%M:%S on %m\%d\%Y')
-                    raise ValidationError(
-                        'Start time overlaps with {activity} on {project} '
-                        'from {start_time} to {end_time}.'.format(**entry_data))
+        # Conflicting saved entries
+        for entry in self.get_overlapping_entries(start, end)[:1]:
+            raise self.get_overlap_error(entry, start, end)
         try:
             act_group = self.project.activity_group
             if act_group:
@@ -354,9 +682,146 @@ class Entry(models.Model):
 
         return True
 
+    # The user and end time, project and status this entry was loaded or
+    # last saved with, and the values of its ROLLUP_FIELDS, so that the
+    # rollups, snapshots and periods it was counted in can be refreshed when
+    # they change. Unsaved entries were not counted anywhere.
+    _rollup_key = (None, None)
+    _rollup_values = None
+    _project_key = None
+    _status_key = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        entry = super(Entry, cls).from_db(db, field_names, values)
+        # Deferred fields are not loaded just for this.
+        entry._rollup_key = (entry.__dict__.get('user_id'), entry.__dict__.get('end_time'))
+        entry._project_key = entry.__dict__.get('project_id')
+        entry._status_key = entry.__dict__.get('status')
+        entry._rollup_values = entry.get_rollup_values()
+        return entry
+
+    def get_rollup_values(self):
+        """Returns the values of the fields which the rollups are built from."""
+        return tuple(self.__dict__.get(self._meta.get_field(field).attname)
+                     for field in ROLLUP_FIELDS)
+
     def save(self, *args, **kwargs):
         self.hours = Decimal('%.5f' % round(self.total_hours, 5))
-        super(Entry, self).save(*args, **kwargs)
+        with transaction.atomic():
+            if not uses_overlap_constraint():
+                super(Entry, self).save(*args, **kwargs)
+            else:
+                self._save_checking_overlap(*args, **kwargs)
+            self.forget_cached()
+            self.forget_snapshots()
+            lock_users(self.get_refreshed_users())
+            self.refresh_periods(lock=False)
+            self.refresh_rollups(lock=False)
+
+    def _save_checking_overlap(self, *args, **kwargs):
+        try:
+            # Use a savepoint so that the transaction is still usable for
+            # looking up the conflicting entry after a violation.
+            with transaction.atomic():
+                super(Entry, self).save(*args, **kwargs)
+        except IntegrityError as e:
+            if OVERLAP_CONSTRAINT not in str(e):
+                raise
+            # Another request saved a conflicting entry after clean() ran.
+            start, end = self.get_time_span()
+            for entry in self.get_overlapping_entries(start, end)[:1]:
+                raise self.get_overlap_error(entry, start, end)
+            raise
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            super(Entry, self).delete(*args, **kwargs)
+            self.forget_cached()
+            self.forget_snapshots()
+            lock_users(self.get_refreshed_users())
+            self.refresh_periods(lock=False)
+            self.refresh_rollups(lock=False)
+
+    def forget_cached(self):
+        """
+        Discards the active entry and quick clock in projects remembered for
+        this entry's user, and for its previous user if it was moved (see
+        utils.get_active_entry).
+        """
+        users = set([getattr(self, '_user_cache', None) or self.user_id])
+        if self._rollup_key[0] not in (None, self.user_id):
+            users.add(self._rollup_key[0])
+        utils.forget_active_entries(users)
+        utils.forget_quick_clock_in(users)
+
+    def forget_snapshots(self):
+        """
+        Deletes the snapshots of the months this entry was and is in, for its
+        previous and current user and project.
+        """
+        keys = set([self._rollup_key + (self._project_key,)])
+        if self.pk:
+            keys.add((self.user_id, self.end_time, self.project_id))
+        keys = [key for key in keys if key[1]]
+        if keys:
+            days = [end_time.date() for user_id, end_time, project_id in keys]
+            TimesheetSnapshot.objects.forget(
+                set(key[0] for key in keys), set(key[2] for key in keys),
+                min(days), max(days))
+        self._project_key = self.project_id if self.pk else None
+
+    def get_refreshed_users(self):
+        """
+        Returns the previous and current users of this entry whose rollups,
+        and possibly months, are refreshed after it is saved or deleted, so
+        that they can be locked once for both refreshes. The PERIOD_FIELDS
+        are all ROLLUP_FIELDS, so months are only refreshed with rollups.
+        """
+        if self.pk and self.get_rollup_values() == self._rollup_values:
+            return set()
+        keys = [self._rollup_key]
+        if self.pk:
+            keys.append((self.user_id, self.end_time))
+        return set(user_id for user_id, end_time in keys if user_id and end_time)
+
+    def refresh_periods(self, lock=True):
+        """
+        Recomputes the status of the months this entry was and is in, if it
+        was created or deleted, or its user, end time or status changed.
+        """
+        key = (self.user_id, self.end_time) if self.pk else (None, None)
+        if self.pk and key == self._rollup_key and self.status == self._status_key:
+            return
+        months = {}
+        for user_id, end_time in set([self._rollup_key, key]):
+            if user_id and end_time:
+                months.setdefault(user_id, set()).add(_month(end_time))
+        for user_id, user_months in sorted(months.items()):
+            TimesheetPeriod.objects.refresh(
+                [user_id], min(user_months), max(user_months), lock=lock)
+        self._status_key = self.status
+
+    def refresh_rollups(self, lock=True):
+        """
+        Rebuilds the rollups for the days this entry was and is on, if it was
+        created or deleted, or any of its ROLLUP_FIELDS changed.
+        """
+        values = self.get_rollup_values() if self.pk else None
+        if self.pk and values == self._rollup_values:
+            return
+        keys = set([self._rollup_key])
+        if self.pk:
+            keys.add((self.user_id, self.end_time))
+        days = {}
+        for user_id, end_time in keys:
+            if user_id and end_time:
+                days.setdefault(user_id, set()).add(end_time.date())
+        for user_id, user_days in sorted(days.items()):
+            EntryRollup.objects.refresh(
+                [user_id], min(user_days), max(user_days), lock=lock)
+        self._rollup_key = (self.user_id, self.end_time) if self.pk else (None, None)
+        self._rollup_values = values
 
     def get_total_seconds(self):
         """
@@ -484,42 +949,529 @@ class Entry(models.Model):
         be added to the summary separately using the dictionary key set in
         TIMEPIECE_PAID_LEAVE_PROJECTS.
         """
-        projects = utils.get_setting('TIMEPIECE_PAID_LEAVE_PROJECTS')
         entries = user.timepiece_entries.filter(
             end_time__gt=date, end_time__lt=end_date)
-        data = {
-            'billable': Decimal('0'), 'non_billable': Decimal('0'),
-            'invoiced': Decimal('0'), 'uninvoiced': Decimal('0'),
-            'total': Decimal('0')
-            }
-        invoiced = entries.filter(
-            status=Entry.INVOICED).aggregate(i=Sum('hours'))['i']
-        uninvoiced = entries.exclude(
-            status=Entry.INVOICED).aggregate(uninv=Sum('hours'))['uninv']
-        total = entries.aggregate(s=Sum('hours'))['s']
-        if invoiced:
-            data['invoiced'] = invoiced
-        if uninvoiced:
-            data['uninvoiced'] = uninvoiced
-        if total:
-            data['total'] = total
-        billable = entries.exclude(project__in=projects.values())
-        billable = billable.values(
-            'billable',
-        ).annotate(s=Sum('hours'))
-        for row in billable:
-            if row['billable']:
-                data['billable'] += row['s']
-            else:
-                data['non_billable'] += row['s']
-        data['total_worked'] = data['billable'] + data['non_billable']
-        data['paid_leave'] = {}
+        totals = entries.order_by().aggregate(**Entry._summary_aggregates())
+        return Entry._summary_data(totals)
+
+    @staticmethod
+    def summaries(users, date, end_date):
+        """
+        Returns a dictionary of the summary (see Entry.summary) for each of
+        the given users, keyed by user pk, computed with a single query.
+        """
+        user_ids = [getattr(user, 'pk', user) for user in users]
+        entries = Entry.no_join.filter(
+            user__in=user_ids, end_time__gt=date, end_time__lt=end_date)
+        entries = entries.order_by().values('user')
+        rows = entries.annotate(**Entry._summary_aggregates())
+        totals = dict((row['user'], row) for row in rows)
+        return OrderedDict(
+            (pk, Entry._summary_data(totals.get(pk, {}))) for pk in user_ids)
+
+    @staticmethod
+    def _summary_aggregates():
+        """
+        Conditional sums of hours for each part of a summary, so that they
+        can all be computed by one query.
+        """
+        def sum_hours(condition):
+            return Sum(Case(When(condition, then='hours'),
+                            output_field=models.DecimalField()))
+
+        projects = utils.get_setting('TIMEPIECE_PAID_LEAVE_PROJECTS')
+        billableQ = Q(project__type__billable=True, activity__billable=True)
+        nonbillableQ = Q(project__type__billable=False) | Q(activity__billable=False)
+        if projects:
+            workQ = ~Q(project__in=projects.values())
+            billableQ &= workQ
+            nonbillableQ &= workQ
+        aggregates = {
+            'invoiced': sum_hours(Q(status=Entry.INVOICED)),
+            'uninvoiced': sum_hours(~Q(status=Entry.INVOICED)),
+            'total': Sum('hours'),
+            'billable': sum_hours(billableQ),
+            'non_billable': sum_hours(nonbillableQ),
+        }
         for name, pk in projects.items():
-            qs = entries.filter(project=projects[name])
-            data['paid_leave'][name] = qs.aggregate(s=Sum('hours'))['s']
+            aggregates['paid_leave_' + name] = sum_hours(Q(project=pk))
+        return aggregates
+
+    @staticmethod
+    def _summary_data(totals):
+        """Builds a summary from the totals of _summary_aggregates()."""
+        projects = utils.get_setting('TIMEPIECE_PAID_LEAVE_PROJECTS')
+        data = dict(
+            (key, totals.get(key) or Decimal('0')) for key in
+            ('billable', 'non_billable', 'invoiced', 'uninvoiced', 'total'))
+        data['total_worked'] = data['billable'] + data['non_billable']
+        data['paid_leave'] = dict(
+            (name, totals.get('paid_leave_' + name)) for name in projects)
         return data
 
 
+class EntryRollupQuerySet(models.query.QuerySet):
+    """
+    Accepts the same end_time filters as EntryQuerySet (at day boundaries),
+    so that filters written for entries also apply to their rollups.
+    """
+
+    def _filter_or_exclude(self, negate, *args, **kwargs):
+        try:
+            args = [rollup_q(q, strict=False) for q in args]
+            kwargs = dict(_rollup_lookup(k, v, strict=False) for k, v in kwargs.items())
+        except RollupUnavailable as e:
+            raise FieldError(str(e))
+        return super(EntryRollupQuerySet, self)._filter_or_exclude(negate, *args, **kwargs)
+
+
+class EntryRollupManager(models.Manager.from_queryset(EntryRollupQuerySet)):
+
+    def get_queryset(self):
+        # Like an entry, a rollup is billable if both its project and activity
+        # are billable. This is looked up rather than stored so that rollups
+        # don't have to be rebuilt when either flag changes.
+        qs = super(EntryRollupManager, self).get_queryset()
+        billable = F('project__type__billable')._combine(
+            F('activity__billable'), 'AND', False)
+        return qs.annotate(billable=billable)
+
+    def build(self, entries):
+        """Yields unsaved rollups which total the given entries by day."""
+        entries = entries.filter(end_time__isnull=False).order_by()
+        entries = entries.extra(select={'day': "DATE_TRUNC('day', end_time)"})
+        entries = entries.values('user', 'project', 'activity', 'day', 'status')
+        for row in entries.annotate(s=Sum('hours')).iterator():
+            yield self.model(
+                user_id=row['user'], project_id=row['project'],
+                activity_id=row['activity'], day=row['day'].date(),
+                status=row['status'], hours=row['s'])
+
+    @transaction.atomic
+    def refresh(self, users, start, end, lock=True):
+        """
+        Rebuilds the rollups of the given users' entries which end on days
+        from start to end, inclusive. Unless lock is False, because the
+        caller already holds them, the users are locked first (see
+        lock_users()).
+        """
+        if lock:
+            lock_users(users)
+        self.filter(user__in=users, day__gte=start, day__lte=end).delete()
+        entries = Entry.objects.filter(
+            user__in=users, end_time__gte=start,
+            end_time__lt=end + relativedelta(days=1))
+        self.bulk_create(self.build(entries), batch_size=1000)
+
+    @transaction.atomic
+    def rebuild(self):
+        """Rebuilds all rollups from scratch. Returns the number created."""
+        self.all().delete()
+        count = 0
+        batch = []
+        for rollup in self.build(Entry.objects.all()):
+            batch.append(rollup)
+            if len(batch) == 1000:
+                self.bulk_create(batch)
+                count += len(batch)
+                batch = []
+        self.bulk_create(batch)
+        return count + len(batch)
+
+
+@python_2_unicode_compatible
+class EntryRollup(models.Model):
+    """
+    Total hours of a user's closed entries which ended on a single day,
+    for a single project, activity, and status.
+
+    These rows are kept up to date when entries are saved, deleted or
+    updated through the Entry querysets, and can be rebuilt with the
+    rebuild_rollups management command. They only hold what those writes
+    change: whether hours are billable or paid leave is looked up from the
+    project, activity and settings when they are read.
+    """
+    user = models.ForeignKey(User, related_name='timepiece_entry_rollups')
+    project = models.ForeignKey('crm.Project', related_name='entry_rollups')
+    activity = models.ForeignKey(Activity, related_name='entry_rollups')
+    day = models.DateField()
+    status = models.CharField(max_length=24, choices=Entry.STATUSES.items())
+    hours = models.DecimalField(max_digits=15, decimal_places=5, default=0)
+
+    objects = EntryRollupManager()
+
+    class Meta:
+        db_table = 'timepiece_entryrollup'
+        unique_together = ('user', 'project', 'activity', 'day', 'status')
+        index_together = (('day', 'user'),)
+
+    def __str__(self):
+        return '{0} hours for {1} on {2}'.format(self.hours, self.user, self.day)
+
+
+def _month(value):
+    """Returns the first day of the month of a date or datetime."""
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    return value.replace(day=1)
+
+
+class SnapshotEncoder(json.JSONEncoder):
+    """Encodes the Decimals, datetimes and dates of a snapshot's data."""
+
+    def default(self, value):
+        if isinstance(value, Decimal):
+            return {'__decimal__': str(value)}
+        if isinstance(value, datetime.datetime):
+            return {'__datetime__': value.isoformat()}
+        if isinstance(value, datetime.date):
+            return {'__date__': value.isoformat()}
+        return super(SnapshotEncoder, self).default(value)
+
+
+def _decode_snapshot(pairs):
+    data = OrderedDict(pairs)
+    if len(data) == 1:
+        key, value = list(data.items())[0]
+        if key == '__decimal__':
+            return Decimal(value)
+        if key == '__datetime__':
+            return dateutil_parser.parse(value)
+        if key == '__date__':
+            return dateutil_parser.parse(value).date()
+    return data
+
+
+def _snapshot_key():
+    """
+    Returns a digest of the settings which snapshots depend on, so that
+    snapshots captured with other paid leave projects are not read.
+    """
+    leave = utils.get_setting('TIMEPIECE_PAID_LEAVE_PROJECTS')
+    content = json.dumps(leave, sort_keys=True).encode('utf-8')
+    return hashlib.md5(content).hexdigest()
+
+
+class TimesheetSnapshotManager(models.Manager):
+
+    def get_data(self, month, user=None, project=None):
+        """
+        Returns the data of the user's or project's snapshot for the month
+        of the given date, or None if there isn't one.
+        """
+        if not utils.get_setting('TIMEPIECE_TIMESHEET_SNAPSHOTS'):
+            return None
+        snapshots = self.filter(user=user, project=project,
+                                month=_month(month), key=_snapshot_key())
+        for snapshot in snapshots[:1]:
+            return snapshot.get_data()
+        return None
+
+    def get_user_data(self, month):
+        """
+        Returns a dictionary of the data of every user's snapshot for the
+        month of the given date, keyed by user, with the users selected.
+        """
+        if not utils.get_setting('TIMEPIECE_TIMESHEET_SNAPSHOTS'):
+            return OrderedDict()
+        snapshots = self.filter(project=None, month=_month(month),
+                                key=_snapshot_key())
+        snapshots = snapshots.select_related('user').order_by('user')
+        return OrderedDict(
+            (snapshot.user, snapshot.get_data()) for snapshot in snapshots)
+
+    @transaction.atomic
+    def store(self, month, data, user=None, project=None):
+        """Replaces the user's or project's snapshot for the month."""
+        month = _month(month)
+        self.filter(user=user, project=project, month=month).delete()
+        return self.create(
+            user_id=getattr(user, 'pk', user),
+            project_id=getattr(project, 'pk', project), month=month,
+            key=_snapshot_key(), data=json.dumps(data, cls=SnapshotEncoder))
+
+    def forget(self, users, projects, start, end):
+        """
+        Deletes the snapshots of months which may include entries of the
+        given users or projects that end from start to end, inclusive. A
+        user's time sheet also shows the week before its month, so user
+        snapshots of the month after a week's end are deleted too.
+
+        Snapshots are deleted even while TIMEPIECE_TIMESHEET_SNAPSHOTS is
+        disabled, so that none are stale when it is enabled again.
+        """
+        months = Q(month__gte=_month(start))
+        usersQ = Q(user__in=users, month__lte=end + relativedelta(days=6))
+        projectsQ = Q(project__in=projects, month__lte=end)
+        self.filter(months, usersQ | projectsQ).delete()
+
+    def forget_all(self):
+        """
+        Deletes every snapshot, when something all of them may depend on,
+        such as whether an activity or project type is billable, or the name
+        of a project or user, changes.
+        """
+        self.all().delete()
+
+
+@python_2_unicode_compatible
+class TimesheetSnapshot(models.Model):
+    """
+    The totals of a user's or a project's month, captured once all of the
+    month's entries are approved or invoiced, so that the time sheets and
+    the payroll report needn't total them again.
+
+    Snapshots are deleted when any of the month's entries are saved,
+    deleted or updated through the Entry querysets, when an activity or
+    project type becomes billable or non-billable or a project's type
+    changes, and when the name of a user, project, project type, activity or
+    location they show changes. The key of the paid leave projects they were captured with must
+    match the current one. They are only used when
+    TIMEPIECE_TIMESHEET_SNAPSHOTS is enabled.
+    """
+    user = models.ForeignKey(User, related_name='timepiece_snapshots',
+                             blank=True, null=True)
+    project = models.ForeignKey('crm.Project', related_name='snapshots',
+                                blank=True, null=True)
+    month = models.DateField()
+    key = models.CharField(max_length=32)
+    data = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = TimesheetSnapshotManager()
+
+    class Meta:
+        db_table = 'timepiece_timesheetsnapshot'
+        index_together = (('user', 'month'), ('project', 'month'))
+
+    def __str__(self):
+        return 'Snapshot of {0} for {1:%B %Y}'.format(
+            self.user or self.project, self.month)
+
+    def get_data(self):
+        return json.loads(self.data, object_pairs_hook=_decode_snapshot)
+
+
+class TimesheetPeriodManager(models.Manager):
+
+    def get_status(self, user, date):
+        """
+        Returns the status of the user's time sheet for the month of the
+        given date, with a single lookup of its (user, month) key.
+        """
+        periods = self.filter(user=user, month=_month(date))
+        for status in periods.values_list('status', flat=True)[:1]:
+            return status
+        return self.model.OPEN
+
+    def is_locked(self, user, date):
+        """
+        Whether any of the user's entries for the month of the given date
+        have been approved or invoiced, with a single lookup of its (user,
+        month) key.
+        """
+        periods = self.filter(user=user, month=_month(date))
+        return periods.filter(locked=True).exists()
+
+    @transaction.atomic
+    def refresh(self, users, start, end, lock=True):
+        """
+        Recomputes the status of the given users' months from the month of
+        start to the month of end, inclusive, from their entries. Unless lock
+        is False, the users are locked first, like EntryRollupManager.refresh.
+        """
+        first, last = _month(start), _month(end)
+        if lock:
+            lock_users(users)
+        entries = Entry.no_join.filter(
+            user__in=users, end_time__gte=first,
+            end_time__lt=last + relativedelta(months=1)).order_by()
+        entries = entries.extra(select={'month': "DATE_TRUNC('month', end_time)"})
+        self.filter(user__in=users, month__gte=first, month__lte=last).delete()
+        self.bulk_create(self.build(
+            entries.values_list('user', 'month', 'status').distinct()))
+
+    def build(self, rows):
+        """
+        Yields unsaved periods for (user, month, entry status) rows. A
+        month's status is the least advanced status of any of its entries,
+        and it is locked once any of them are approved or invoiced.
+        """
+        order = list(self.model.STATUSES)
+        statuses, locked = {}, set()
+        for user, month, status in rows:
+            key = (user, _month(month))
+            status = self.model.ENTRY_STATUSES[status]
+            statuses[key] = min(statuses.get(key, status), status, key=order.index)
+            if status in self.model.LOCKED:
+                locked.add(key)
+        for (user, month), status in sorted(statuses.items()):
+            yield self.model(user_id=user, month=month, status=status,
+                             locked=(user, month) in locked)
+
+
+@python_2_unicode_compatible
+class TimesheetPeriod(models.Model):
+    """
+    The status of a user's time sheet for a month: open while any of its
+    entries are unverified, then verified, approved and finally invoiced
+    once all of them are. A month is locked, so that entries can no longer
+    be added to it, as soon as any of its entries are approved or invoiced.
+
+    These rows are kept up to date when entries are saved, deleted or
+    updated through the Entry querysets, so that the status of a month can
+    be checked without reading its entries.
+    """
+    OPEN = 'open'
+    VERIFIED = Entry.VERIFIED
+    APPROVED = Entry.APPROVED
+    INVOICED = Entry.INVOICED
+    STATUSES = OrderedDict((
+        (OPEN, 'Open'),
+        (VERIFIED, 'Verified'),
+        (APPROVED, 'Approved'),
+        (INVOICED, 'Invoiced'),
+    ))
+    # The statuses of entries which keep more from being added to the month.
+    LOCKED = (APPROVED, INVOICED)
+    # The status of a month which each entry status allows.
+    ENTRY_STATUSES = {
+        Entry.UNVERIFIED: OPEN,
+        Entry.VERIFIED: VERIFIED,
+        Entry.APPROVED: APPROVED,
+        Entry.INVOICED: INVOICED,
+        Entry.NOT_INVOICED: INVOICED,
+    }
+
+    user = models.ForeignKey(User, related_name='timepiece_periods')
+    month = models.DateField()
+    status = models.CharField(max_length=24, choices=STATUSES.items(),
+                              default=OPEN)
+    locked = models.BooleanField(default=False)
+
+    objects = TimesheetPeriodManager()
+
+    class Meta:
+        db_table = 'timepiece_timesheetperiod'
+        unique_together = ('user', 'month')
+
+    def __str__(self):
+        return '{0} for {1:%B %Y}: {2}'.format(
+            self.user, self.month, self.get_status_display())
+
+
+class ProjectHoursManager(models.Manager):
+
+    @transaction.atomic
+    def assign(self, week_start, hours):
+        """
+        Sets the hours for which users are scheduled on projects in the week
+        of week_start. hours maps (user pk, project pk) pairs to a number of
+        hours, or to zero or None to remove the user from the project's
+        schedule. Changed hours are unpublished, and users are added to the
+        projects they are scheduled on. Returns the saved project hours.
+
+        Whatever the number of changes, this takes a query to find the
+        current hours, one each to delete, update, create and read back
+        hours, and two to add users to projects.
+        """
+        week_start = utils.get_week_start(week_start).date()
+        pairs = set(hours)
+        users = set(user for user, project in pairs)
+        projects = set(project for user, project in pairs)
+        week = self.filter(week_start=week_start, user__in=users,
+                           project__in=projects)
+        current = dict(((user, project), pk) for user, project, pk in
+                       week.values_list('user', 'project', 'pk'))
+
+        removed = [current[pair] for pair in pairs
+                   if not hours[pair] and pair in current]
+        if removed:
+            self.filter(pk__in=removed).delete()
+
+        updated = [(current[pair], Decimal(hours[pair])) for pair in pairs
+                   if hours[pair] and pair in current]
+        if updated:
+            self.filter(pk__in=[pk for pk, value in updated]).update(
+                hours=Case(*[When(pk=pk, then=Value(value))
+                             for pk, value in updated],
+                           output_field=models.DecimalField()),
+                published=False)
+
+        self.bulk_create([
+            self.model(week_start=week_start, user_id=user, project_id=project,
+                       hours=Decimal(hours[user, project]))
+            for user, project in pairs
+            if hours[user, project] and (user, project) not in current])
+
+        scheduled = set(pair for pair in pairs if hours[pair])
+        self.add_relationships(scheduled)
+        return [ph for ph in week if (ph.user_id, ph.project_id) in scheduled]
+
+    @transaction.atomic
+    def copy_week(self, source, targets, projects=None, users=None):
+        """
+        Copies the hours scheduled in the week of source into each week of
+        targets, replacing the hours there, and returns the number of hours
+        created. If projects or users are given, only their hours are copied
+        and replaced. Nothing is replaced if there are no hours to copy. The
+        copies are unpublished, and users are added to the projects they are
+        scheduled on.
+
+        Each target week is filled with a single INSERT ... SELECT, so the
+        hours are never loaded.
+        """
+        source = utils.get_week_start(source).date()
+        targets = set(utils.get_week_start(week).date() for week in targets)
+        targets = sorted(targets - set([source]))
+        filters, where, params = {}, [], []
+        for field, values in (('project', projects), ('user', users)):
+            if values is not None:
+                values = [getattr(value, 'pk', value) for value in values]
+                filters[field + '__in'] = values
+                where.append('{0} IN ({1})'.format(
+                    field + '_id', ', '.join(['%s'] * len(values)) or 'NULL'))
+                params.extend(values)
+
+        hours = self.filter(week_start=source, **filters).order_by()
+        pairs = list(hours.values_list('user', 'project').distinct())
+        if not pairs:
+            return 0
+        self.filter(week_start__in=targets, **filters).delete()
+        self.add_relationships(pairs)
+
+        sql = (
+            'INSERT INTO {0} (week_start, project_id, user_id, hours, published) '
+            'SELECT %s, project_id, user_id, hours, %s FROM {0} '
+            'WHERE {1}'.format(
+                connections[self.db].ops.quote_name(self.model._meta.db_table),
+                ' AND '.join(['week_start = %s'] + where)))
+        count = 0
+        with connections[self.db].cursor() as cursor:
+            for target in targets:
+                cursor.execute(sql, [target, False, source] + params)
+                count += cursor.rowcount
+        return count
+
+    def add_relationships(self, pairs):
+        """
+        Adds users to projects, given (user pk, project pk) pairs, unless
+        they are already on them, so that they can track time there.
+        """
+        pairs = set(pairs)
+        if not pairs:
+            return
+        users = set(user for user, project in pairs)
+        projects = set(project for user, project in pairs)
+        current = ProjectRelationship.objects.filter(
+            user__in=users, project__in=projects)
+        pairs -= set(current.values_list('user', 'project'))
+        ProjectRelationship.objects.bulk_create([
+            ProjectRelationship(user_id=user, project_id=project)
+            for user, project in pairs])
+        utils.forget_quick_clock_in(set(user for user, project in pairs))
+
+
 @python_2_unicode_compatible
 class ProjectHours(models.Model):
     week_start = models.DateField(verbose_name='start of week')
@@ -530,6 +1482,8 @@ class ProjectHours(models.Model):
         validators=[validators.MinValueValidator(Decimal("0.00001"))])
     published = models.BooleanField(default=False)
 
+    objects = ProjectHoursManager()
+
     def __str__(self):
         return "{0} on {1} for Week of {2}".format(
             self.user.get_name_or_username(),
@@ -1,4 +1,5 @@
 import datetime
+from decimal import Decimal
 import json
 
 from dateutil.relativedelta import relativedelta
@@ -6,7 +7,9 @@ from six.moves.urllib.parse import urlencode
 
 from django.contrib.auth.models import Permission
 from django.core.urlresolvers import reverse
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.test.client import RequestFactory
 
 from timepiece import utils
@@ -146,6 +149,45 @@ class DashboardViewTestCase(ViewTestMixin, TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.context['others_active_entries']), 0)
 
+    def test_daily_entries(self):
+        """Each day lists its entries with their total hours."""
+        monday = datetime.datetime(2012, 11, 5, 8)
+        tuesday = datetime.datetime(2012, 11, 6, 8)
+        self._create_entry(monday, monday + relativedelta(hours=2))
+        self._create_entry(monday + relativedelta(hours=3),
+                           monday + relativedelta(hours=4, minutes=30))
+        self._create_entry(tuesday, tuesday + relativedelta(hours=1))
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        daily_entries = response.context['daily_entries']
+        self.assertEqual([(d['day'], len(d['entries']), d['hours'])
+                          for d in daily_entries], [
+            (tuesday.date(), 1, Decimal('1.00000')),
+            (monday.date(), 2, Decimal('3.50000')),
+        ])
+
+    def test_query_count(self):
+        """The number of queries doesn't grow with the week's entries."""
+        self._create_active_entry()
+        self._create_entry(datetime.datetime(2012, 11, 5, 8),
+                           datetime.datetime(2012, 11, 5, 12))
+        self._create_others_entries()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url)
+        for day in range(5, 10):
+            project = factories.Project()
+            factories.ProjectHours(user=self.user, project=project,
+                                   week_start=self.this_week, hours=4)
+            start_time = datetime.datetime(2012, 11, day, 13)
+            factories.Entry(user=self.user, project=project,
+                            start_time=start_time,
+                            end_time=start_time + relativedelta(hours=3))
+        self._create_others_entries()
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(self.url)
+        self.assertEqual(len(response.context['project_progress']), 6)
+        self.assertEqual(len(response.context['daily_entries']), 5)
+
     def test_clock_in_form_activity_lookup(self):
         """Create an ActivityGroup that includes the Activity, and associate it with the project.
         Add a second Activity that is not included.  Ensure that the ActivityLookup disallows
@@ -212,11 +254,11 @@ class ProcessProgressTestCase(TestCase):
         }
         return factories.ProjectHours(**data)
 
-    def _get_progress(self):
+    def _get_progress(self, active_entry=None):
         entries = Entry.objects.all()
         assignments = ProjectHours.objects.all()
         view = Dashboard()
-        return view.process_progress(entries, assignments)
+        return view.process_progress(entries, assignments, active_entry)
 
     def _check_progress(self, progress, project, assigned, worked):
         self.assertEqual(progress['project'], project)
@@ -257,6 +299,18 @@ class ProcessProgressTestCase(TestCase):
         self.assertEqual(len(progress), 1)
         self._check_progress(progress[0], self.project, assigned_hours, 0)
 
+    def test_active_entry(self):
+        """The active entry's hours so far are added to its project."""
+        start_time = datetime.datetime(2012, 11, 7, 8, 0)
+        end_time = datetime.datetime(2012, 11, 7, 12, 0)
+        self._create_entry(start_time, end_time)
+        active_entry = self._create_entry(end_time)
+        active_entry.pause_time = end_time + relativedelta(hours=2)
+
+        progress = self._get_progress(active_entry)
+        self.assertEqual(len(progress), 1)
+        self._check_progress(progress[0], self.project, 0, 6)
+
     def test_ordering(self):
         """Progress list should be ordered by project name."""
         projects = [
@@ -0,0 +1,191 @@
+import datetime
+from decimal import Decimal
+
+from six import StringIO
+
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Q
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from timepiece.tests import factories
+
+from timepiece.entries.models import Entry, EntryRollup
+
+
+class EntryRollupTestCase(TestCase):
+
+    def setUp(self):
+        super(EntryRollupTestCase, self).setUp()
+        self.user = factories.User()
+        self.project = factories.BillableProject()
+        self.activity = factories.Activity(billable=True)
+        self.day = datetime.datetime(2016, 3, 2)
+
+    def log_time(self, hours, day=None, **kwargs):
+        start = (day or self.day) + datetime.timedelta(hours=8)
+        data = {
+            'user': self.user,
+            'project': self.project,
+            'activity': self.activity,
+            'start_time': start,
+            'end_time': start + datetime.timedelta(hours=hours),
+        }
+        data.update(kwargs)
+        return factories.Entry(**data)
+
+    def get_rollups(self):
+        return list(EntryRollup.objects.order_by('day', 'status').values_list(
+            'day', 'status', 'billable', 'hours'))
+
+    def test_save(self):
+        """Saving entries keeps the daily totals up to date."""
+        self.log_time(2)
+        entry = self.log_time(3, day=self.day + datetime.timedelta(hours=6))
+        self.assertEqual(self.get_rollups(), [
+            (self.day.date(), Entry.UNVERIFIED, True, Decimal('5.00000')),
+        ])
+        entry.end_time = entry.start_time + datetime.timedelta(hours=1)
+        entry.save()
+        self.assertEqual(self.get_rollups(), [
+            (self.day.date(), Entry.UNVERIFIED, True, Decimal('3.00000')),
+        ])
+
+    def test_save_rebuilds_once(self):
+        """
+        Rollups are only rebuilt when a field they are built from changes,
+        and a day is only rebuilt once.
+        """
+        def rollup_queries(entry):
+            with CaptureQueriesContext(connection) as queries:
+                entry.save()
+            return [query for query in queries.captured_queries
+                    if 'timepiece_entryrollup' in query['sql']]
+
+        entry = Entry.objects.get(pk=self.log_time(2).pk)
+        entry.comments = 'Changed'
+        self.assertEqual(rollup_queries(entry), [])
+        entry.end_time -= datetime.timedelta(hours=1)
+        # One DELETE and one INSERT.
+        self.assertEqual(len(rollup_queries(entry)), 2)
+        self.assertEqual(self.get_rollups(), [
+            (self.day.date(), Entry.UNVERIFIED, True, Decimal('1.00000')),
+        ])
+
+    def test_move_entry(self):
+        """An entry moved to another day is removed from the old total."""
+        entry = self.log_time(2)
+        entry.start_time += datetime.timedelta(days=1)
+        entry.end_time += datetime.timedelta(days=1)
+        entry.save()
+        tomorrow = self.day.date() + datetime.timedelta(days=1)
+        self.assertEqual(self.get_rollups(), [
+            (tomorrow, Entry.UNVERIFIED, True, Decimal('2.00000')),
+        ])
+
+    def test_open_entry(self):
+        """Active entries are not counted."""
+        self.log_time(2, end_time=None)
+        self.assertEqual(self.get_rollups(), [])
+
+    def test_delete(self):
+        entry = self.log_time(2)
+        self.log_time(1, day=self.day + datetime.timedelta(hours=3))
+        entry.delete()
+        self.assertEqual(self.get_rollups(), [
+            (self.day.date(), Entry.UNVERIFIED, True, Decimal('1.00000')),
+        ])
+        Entry.no_join.filter(user=self.user).delete()
+        self.assertEqual(self.get_rollups(), [])
+
+    def test_queryset_update(self):
+        """Status changes through queryset updates are rolled up."""
+        self.log_time(2)
+        self.log_time(1, day=self.day + datetime.timedelta(days=1))
+        Entry.no_join.filter(user=self.user).update(status=Entry.APPROVED)
+        self.assertEqual(self.get_rollups(), [
+            (self.day.date(), Entry.APPROVED, True, Decimal('2.00000')),
+            (self.day.date() + datetime.timedelta(days=1), Entry.APPROVED,
+             True, Decimal('1.00000')),
+        ])
+
+    def test_rebuild_rollups(self):
+        self.log_time(2)
+        EntryRollup.objects.all().delete()
+        out = StringIO()
+        call_command('rebuild_rollups', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Rebuilt 1 entry rollups.')
+        self.assertEqual(self.get_rollups(), [
+            (self.day.date(), Entry.UNVERIFIED, True, Decimal('2.00000')),
+        ])
+
+    @override_settings(TIMEPIECE_USE_ENTRY_ROLLUPS=True)
+    def test_date_trunc(self):
+        """date_trunc reads from the rollups when the filters allow it."""
+        self.log_time(2)
+        self.log_time(3, day=self.day + datetime.timedelta(days=1))
+        self.log_time(4, day=self.day + datetime.timedelta(days=40))
+        month_start = datetime.datetime(2016, 3, 1)
+        entries = Entry.objects.filter(
+            end_time__gte=month_start, end_time__lt=datetime.datetime(2016, 4, 1),
+            project__type__billable=True)
+        self.assertIsNotNone(entries.get_rollups(('project__name',)))
+        totals = entries.date_trunc('month', ('project__name',))
+        self.assertEqual(totals.model, EntryRollup)
+        self.assertEqual([(t['date'], t['hours']) for t in totals],
+                         [(month_start, Decimal('5.00000'))])
+
+    @override_settings(TIMEPIECE_USE_ENTRY_ROLLUPS=True)
+    def test_date_trunc_fallback(self):
+        """Filters which rollups can't answer use the entries instead."""
+        self.log_time(2)
+        entries = Entry.objects.filter(
+            end_time__gte=self.day + datetime.timedelta(hours=9))
+        self.assertIsNone(entries.get_rollups())
+        totals = entries.date_trunc('day', ('pk',))
+        self.assertEqual(totals.model, Entry)
+        self.assertEqual([t['hours'] for t in totals], [Decimal('2.00000')])
+
+    def test_billable_follows_activity(self):
+        """Rollups don't have to be rebuilt when billable flags change."""
+        self.log_time(2)
+        self.activity.billable = False
+        self.activity.save()
+        self.assertEqual(self.get_rollups(), [
+            (self.day.date(), Entry.UNVERIFIED, False, Decimal('2.00000')),
+        ])
+        self.activity.billable = True
+        self.activity.save()
+        self.project.type.billable = False
+        self.project.type.save()
+        self.assertEqual(self.get_rollups(), [
+            (self.day.date(), Entry.UNVERIFIED, False, Decimal('2.00000')),
+        ])
+
+    def test_moved_entry_loaded_from_db(self):
+        """An entry loaded from the database is removed from its old user's total."""
+        self.log_time(2)
+        other = factories.User()
+        entry = Entry.objects.get()
+        entry.user = other
+        entry.save()
+        self.assertEqual(list(EntryRollup.objects.values_list('user', 'hours')),
+                         [(other.pk, Decimal('2.00000'))])
+
+    @override_settings(TIMEPIECE_USE_ENTRY_ROLLUPS=True)
+    def test_replay_lookups(self):
+        """Q objects and excludes are replayed against the rollups."""
+        other = factories.Activity(billable=False)
+        self.log_time(2)
+        self.log_time(3, day=self.day + datetime.timedelta(days=1), activity=other)
+        self.log_time(4, day=self.day + datetime.timedelta(days=2),
+                      status=Entry.APPROVED)
+        entries = Entry.objects.filter(
+            Q(activity=self.activity) | Q(activity=other),
+            end_time__gte=self.day, end_time__lt=self.day + datetime.timedelta(days=3),
+        ).exclude(status=Entry.APPROVED)
+        for billable, hours in ((True, Decimal('2.00000')), (False, Decimal('3.00000'))):
+            totals = entries.filter(billable=billable).date_trunc('month')
+            self.assertEqual(totals.model, EntryRollup)
+            self.assertEqual([t['hours'] for t in totals], [hours])
@@ -6,7 +6,9 @@ from decimal import Decimal
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from timepiece import utils
 from timepiece.tests import factories
@@ -493,6 +495,113 @@ class ProjectHoursEditTestCase(ProjectHoursTestCase):
 
         self.assertEquals(ProjectHours.objects.count(), 0)
 
+    def test_reference_version(self):
+        """Projects and users are only sent when they have changed."""
+        self.login_user(self.manager)
+        response = self.client.get(self.ajax_url)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEquals(len(data['all_projects']), 2)
+        version = data['reference_version']
+
+        response = self.client.get(self.ajax_url, data={'reference': version})
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertFalse('all_projects' in data)
+        self.assertFalse('all_users' in data)
+        self.assertEquals(data['reference_version'], version)
+
+        factories.Project()
+        response = self.client.get(self.ajax_url, data={'reference': version})
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEquals(len(data['all_projects']), 3)
+        self.assertNotEquals(data['reference_version'], version)
+
+    def test_etag(self):
+        """Unchanged data is not sent again."""
+        self.login_user(self.manager)
+        self.create_project_hours()
+        response = self.client.get(self.ajax_url)
+        etag = response['ETag']
+        response = self.client.get(self.ajax_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+
+        ProjectHours.objects.filter(user=self.user).update(hours=30)
+        response = self.client.get(self.ajax_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertNotEquals(response['ETag'], etag)
+
+    def _post_bulk(self, changes):
+        data = {
+            'week_start': self.week_start.strftime('%Y-%m-%d'),
+            'changes': changes,
+        }
+        return self.client.post(reverse('ajax_schedule_bulk'),
+                                data=json.dumps(data),
+                                content_type='application/json')
+
+    def test_bulk_save(self):
+        """A batch of changes is saved with a fixed number of queries."""
+        self.login_user(self.manager)
+        self.create_project_hours()
+        newbie = factories.User()
+        changes = [
+            {'user': self.user.pk, 'project': self.tracked_project.pk,
+             'hours': 20},
+            {'user': self.manager.pk, 'project': self.tracked_project.pk,
+             'hours': 0},
+            {'user': newbie.pk, 'project': self.tracked_project.pk,
+             'hours': 8},
+            {'user': newbie.pk, 'project': self.untracked_project.pk,
+             'hours': 4},
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            response = self._post_bulk(changes)
+        self.assertEquals(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEquals(len(data['project_hours']), 3)
+
+        week = ProjectHours.objects.filter(week_start=self.week_start)
+        hours = dict(((ph.user_id, ph.project_id), (ph.hours, ph.published))
+                     for ph in week)
+        self.assertEquals(hours, {
+            (self.user.pk, self.tracked_project.pk): (Decimal('20'), False),
+            (newbie.pk, self.tracked_project.pk): (Decimal('8'), False),
+            (newbie.pk, self.untracked_project.pk): (Decimal('4'), False),
+        })
+        self.assertIn(newbie, self.tracked_project.users.all())
+        self.assertIn(newbie, self.untracked_project.users.all())
+        self.assertEquals(ProjectHours.objects.filter(
+            week_start=self.next_week).count(), 2)
+
+        changes = [
+            {'user': newbie.pk, 'project': self.tracked_project.pk,
+             'hours': 6},
+            {'user': newbie.pk, 'project': self.untracked_project.pk,
+             'hours': 0},
+        ]
+        changes.extend({'user': factories.User().pk, 'hours': 2,
+                        'project': self.tracked_project.pk} for i in range(5))
+        with self.assertNumQueries(len(queries)):
+            response = self._post_bulk(changes)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(ProjectHours.objects.filter(
+            week_start=self.week_start).count(), 7)
+
+    def test_bulk_save_unsuccessful(self):
+        """Nothing is saved if any change is invalid."""
+        self.login_user(self.manager)
+        response = self._post_bulk([
+            {'user': self.user.pk, 'project': self.tracked_project.pk,
+             'hours': 20},
+            {'user': self.user.pk, 'project': 12345, 'hours': 5},
+        ])
+        self.assertEquals(response.status_code, 500)
+        response = self._post_bulk([
+            {'user': self.user.pk, 'project': self.tracked_project.pk,
+             'hours': -5},
+        ])
+        self.assertEquals(response.status_code, 500)
+        self.assertEquals(ProjectHours.objects.count(), 0)
+
     def test_duplicate_successful(self):
         """
         You can copy hours from the previous week to the currently
@@ -572,6 +681,66 @@ class ProjectHoursEditTestCase(ProjectHoursTestCase):
             published=False).count(), 4)
         self.assertEquals(this_week_qs, next_week_qs)
 
+    def test_duplicate_range(self):
+        """
+        Hours can be copied from any week into several weeks, for only some
+        users, and the users are added to the projects.
+        """
+        self.login_user(self.manager)
+        self.create_project_hours()
+
+        response = self.client.post(self.ajax_url, data={
+            'week_update': self.next_week.strftime('%Y-%m-%d'),
+            'source_week': self.week_start.strftime('%Y-%m-%d'),
+            'weeks': 3,
+            'users': [self.user.pk],
+            'duplicate': 'duplicate'
+        }, follow=True)
+        self.assertEquals(response.status_code, 200)
+
+        hours = ProjectHours.objects.filter(week_start__gt=self.week_start)
+        hours = hours.order_by('week_start', 'user__pk')
+        self.assertEquals(
+            [(ph.week_start, ph.user, ph.hours) for ph in hours], [
+                (self.next_week.date(), self.user, Decimal('25')),
+                (self.next_week.date(), self.manager, Decimal('2')),
+                (self.future.date(), self.user, Decimal('25')),
+                (self.future.date() + relativedelta(days=7), self.user,
+                 Decimal('25')),
+            ])
+        self.assertIn(self.user, self.tracked_project.users.all())
+        self.assertNotIn(self.manager, self.tracked_project.users.all())
+
+    def test_duplicate_into_source(self):
+        """Hours can't be copied into the week they're copied from."""
+        self.login_user(self.manager)
+        self.create_project_hours()
+
+        response = self.client.post(self.ajax_url, data={
+            'week_update': self.week_start.strftime('%Y-%m-%d'),
+            'source_week': self.next_week.strftime('%Y-%m-%d'),
+            'weeks': 2,
+            'duplicate': 'duplicate'
+        }, follow=True)
+        messages = response.context['messages']
+        self.assertEquals(
+            messages._loaded_messages[0].message,
+            'Hours cannot be copied into the week they are copied from.')
+        self.assertEquals(ProjectHours.objects.count(), 4)
+
+    def test_copy_week_queries(self):
+        """Copying doesn't read or write the hours one at a time."""
+        self.create_project_hours()
+        with CaptureQueriesContext(connection) as queries:
+            ProjectHours.objects.copy_week(self.week_start, [self.future])
+        for i in range(10):
+            factories.ProjectHours(week_start=self.week_start,
+                                   project=self.untracked_project)
+        with self.assertNumQueries(len(queries)):
+            count = ProjectHours.objects.copy_week(
+                self.week_start, [self.future])
+        self.assertEquals(count, 12)
+
     def test_no_hours_to_copy(self):
         """
         You should be notified if there are no hours to copy
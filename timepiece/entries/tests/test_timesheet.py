@@ -1,6 +1,7 @@
 import datetime
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
+import mock
 import random
 from time import sleep
 
@@ -8,17 +9,22 @@ from six.moves.urllib.parse import urlencode
 
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
+from django.db import connection
 from django.utils import timezone
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
 from timepiece import utils
 from timepiece.tests.base import ViewTestMixin, LogTimeMixin
 from timepiece.tests import factories
 
-from timepiece.crm.utils import grouped_totals
-from timepiece.entries.models import Activity, Entry
+from timepiece.crm.timesheet import Timesheet
+from timepiece.entries import models as entry_models
+from timepiece.entries.models import Activity, Entry, TimesheetPeriod, TimesheetSnapshot
 from timepiece.entries.forms import ClockInForm
+from timepiece.reports.engine import Report
 
 
 class EditableTest(TestCase):
@@ -1003,6 +1009,35 @@ class CheckOverlap(ViewTestMixin, LogTimeMixin, TestCase):
         user_total_overlaps = self.use_checkoverlap(self.get_entries())
         self.assertEqual(user_total_overlaps, 1)
 
+    def testCleanOverlap(self):
+        """clean() rejects an entry which conflicts with a saved one"""
+        entry = factories.Entry.build(
+            user=self.user, project=self.project, activity=self.devl_activity,
+            start_time=self.start_inside, end_time=self.end_after)
+        self.assertRaisesRegexp(ValidationError, 'Start time overlaps',
+                                entry.clean)
+
+    def testCleanNoOverlap(self):
+        entry = factories.Entry.build(
+            user=self.user, project=self.project, activity=self.devl_activity,
+            start_time=self.end_after, end_time=self.end_after + relativedelta(hours=1))
+        self.assertTrue(entry.clean())
+
+    @override_settings(TIMEPIECE_ENTRY_OVERLAP_CONSTRAINT=True)
+    def testCleanOverlapRangeQuery(self):
+        """The range-based overlap query finds the same conflicts"""
+        with mock.patch.dict(entry_models._overlap_constraints,
+                             {connection.alias: True}):
+            self.assertTrue(entry_models.uses_overlap_constraint())
+            self.testCleanOverlap()
+            self.testCleanNoOverlap()
+
+    @override_settings(TIMEPIECE_ENTRY_OVERLAP_CONSTRAINT=True)
+    def testOverlapConstraintMissing(self):
+        """The setting has no effect until the constraint is installed"""
+        self.assertFalse(entry_models.has_overlap_constraint(refresh=True))
+        self.assertFalse(entry_models.uses_overlap_constraint())
+
 
 class CreateEditEntry(ViewTestMixin, TestCase):
 
@@ -1103,6 +1138,20 @@ class CreateEditEntry(ViewTestMixin, TestCase):
         self.assertContains(
             response, 'The entry has been created successfully', count=1)
 
+    def testCreateConcurrentOverlap(self):
+        """
+        An overlap found by the database when saving is shown on the form,
+        and nothing is saved
+        """
+        error = ValidationError('Start time overlaps with another entry.')
+        num_entries = Entry.no_join.count()
+        with mock.patch.object(Entry, 'save', side_effect=error):
+            response = self.client.post(self.create_url, self.default_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['form'].non_field_errors(),
+                         ['Start time overlaps with another entry.'])
+        self.assertEqual(Entry.no_join.count(), num_entries)
+
     def testEditClosed(self):
         """
         Test the ability to edit a closed entry, using valid values
@@ -1813,9 +1862,7 @@ class TestTotals(ViewTestMixin, LogTimeMixin, TestCase):
         date = utils.add_timezone(datetime.datetime(2011, 1, 19))
         from_date = utils.get_month_start(date)
         to_date = from_date + relativedelta(months=1)
-        first_week = utils.get_week_start(from_date)
-        entries = Entry.objects.timespan(first_week, to_date=to_date)
-        totals = grouped_totals(entries)
+        totals = Timesheet(self.user, from_date, to_date).run().grouped_totals
         for week, week_totals, days in totals:
             # Jan. 3rd is a monday. Each week should be on a monday
             if week.month == 1:
@@ -1842,6 +1889,193 @@ class TestTotals(ViewTestMixin, LogTimeMixin, TestCase):
                         self.assertEqual(totals['billable'], 1)
                         self.assertEqual(totals['total'], 1)
 
+    def _log_summary_entries(self, user):
+        day = utils.add_timezone(datetime.datetime(2011, 1, 4, 8))
+        self.log_time(project=self.p1, start=day, delta=(2, 0), user=user,
+                      status=Entry.INVOICED)
+        self.log_time(project=self.p2, start=day + relativedelta(hours=2),
+                      delta=(1, 0), user=user)
+        self.log_time(project=self.p4, start=day + relativedelta(hours=3),
+                      delta=(1, 0), user=user, activity=self.sick_activity)
+        self.log_time(project=self.p3, start=day + relativedelta(days=1),
+                      delta=(3, 0), user=user)
+
+    def testSummary(self):
+        """Entry.summary computes every total with a single query."""
+        self._log_summary_entries(self.user)
+        start = utils.add_timezone(datetime.datetime(2011, 1, 1))
+        end = start + relativedelta(months=1)
+        leave = {'sick': self.p3.pk}
+        with self.settings(TIMEPIECE_PAID_LEAVE_PROJECTS=leave):
+            with self.assertNumQueries(1):
+                summary = Entry.summary(self.user, start, end)
+        self.assertEqual(summary['invoiced'], Decimal('2'))
+        self.assertEqual(summary['uninvoiced'], Decimal('5'))
+        self.assertEqual(summary['total'], Decimal('7'))
+        self.assertEqual(summary['billable'], Decimal('2'))
+        self.assertEqual(summary['non_billable'], Decimal('2'))
+        self.assertEqual(summary['total_worked'], Decimal('4'))
+        self.assertEqual(summary['paid_leave'], {'sick': Decimal('3')})
+
+    def testSummaries(self):
+        """Entry.summaries returns a summary for each user from one query."""
+        self._log_summary_entries(self.user)
+        self._log_summary_entries(self.user2)
+        idle = factories.User()
+        start = utils.add_timezone(datetime.datetime(2011, 1, 1))
+        end = start + relativedelta(months=1)
+        users = [self.user, self.user2, idle]
+        with self.assertNumQueries(1):
+            summaries = Entry.summaries(users, start, end)
+        self.assertEqual(list(summaries), [u.pk for u in users])
+        for user in (self.user, self.user2):
+            self.assertEqual(summaries[user.pk],
+                             Entry.summary(user, start, end))
+        self.assertEqual(summaries[idle.pk]['total'], Decimal('0'))
+        self.assertEqual(summaries[idle.pk]['total_worked'], Decimal('0'))
+
+    def testTimesheet(self):
+        """A Timesheet builds the same totals as the queries it replaces."""
+        self._log_summary_entries(self.user)
+        for day in (datetime.datetime(2010, 12, 28), datetime.datetime(2011, 1, 2),
+                    datetime.datetime(2011, 1, 17), datetime.datetime(2011, 2, 1)):
+            self.log_time(project=self.p1, start=utils.add_timezone(day),
+                          delta=(1, 0), status=Entry.APPROVED)
+        start = utils.add_timezone(datetime.datetime(2011, 1, 1))
+        end = start + relativedelta(months=1)
+        leave = {'sick': self.p3.pk}
+        with self.settings(TIMEPIECE_PAID_LEAVE_PROJECTS=leave):
+            with self.assertNumQueries(1):
+                timesheet = Timesheet(self.user, start, end).run()
+            summary = Entry.summary(self.user, start, end)
+        self.assertEqual(timesheet.summary, summary)
+        entries = Entry.objects.filter(user=self.user)
+        first_week = utils.get_week_start(start)
+        entries = entries.timespan(first_week, to_date=end)
+        measures = ('billable', 'non_billable', 'total')
+        weekly = Report(grain='week', measures=measures, entries=entries).run()
+        self.assertEqual(
+            [(week.date(), week_totals)
+             for week, week_totals, days in timesheet.grouped_totals],
+            list(zip(weekly.columns, weekly.totals)))
+        daily = Report(grain='day', measures=measures, entries=entries).run()
+        self.assertEqual(
+            [(day, day_totals) for week, week_totals, days in timesheet.grouped_totals
+             for day, (day_totals, projects) in days],
+            list(zip(daily.columns, daily.totals)))
+        self.assertEqual(len(timesheet.entries), 6)
+        self.assertEqual(timesheet.project_entries, [
+            {'project__name': '1', 'sum': Decimal('7')},
+            {'project__name': '2', 'sum': Decimal('1')},
+            {'project__name': '4', 'sum': Decimal('1')},
+        ])
+        self.assertEqual(timesheet.status_counts, {
+            Entry.INVOICED: 1, Entry.UNVERIFIED: 3, Entry.APPROVED: 2})
+
+    @override_settings(TIMEPIECE_TIMESHEET_SNAPSHOTS=True)
+    def testTimesheetSnapshot(self):
+        """
+        An approved month is captured, read back with one query, and
+        forgotten when any of its entries change.
+        """
+        self._log_summary_entries(self.user)
+        start = utils.add_timezone(datetime.datetime(2011, 1, 1))
+        end = start + relativedelta(months=1)
+        self.assertFalse(Timesheet(self.user, start, end).capture())
+        Entry.no_join.filter(status=Entry.UNVERIFIED).update(status=Entry.APPROVED)
+        self.assertTrue(Timesheet(self.user, start, end).capture())
+        built = Timesheet(self.user, start, end).build()
+        with self.assertNumQueries(1):
+            timesheet = Timesheet(self.user, start, end).run()
+        for field in ('entries', 'grouped_totals', 'project_entries', 'summary',
+                      'status_counts', 'work_totals', 'leave_totals'):
+            self.assertEqual(getattr(timesheet, field), getattr(built, field))
+        entry = Entry.objects.filter(user=self.user).first()
+        entry.comments = 'Changed'
+        entry.save()
+        self.assertFalse(TimesheetSnapshot.objects.exists())
+
+    def testSnapshotsForgotten(self):
+        """
+        Snapshots are forgotten while the setting is disabled, when billable
+        flags change, and aren't read with other paid leave projects.
+        """
+        self._log_summary_entries(self.user)
+        Entry.no_join.update(status=Entry.APPROVED)
+        start = utils.add_timezone(datetime.datetime(2011, 1, 1))
+        end = start + relativedelta(months=1)
+
+        def capture():
+            with self.settings(TIMEPIECE_TIMESHEET_SNAPSHOTS=True):
+                self.assertTrue(Timesheet(self.user, start, end).capture())
+
+        capture()
+        Entry.objects.filter(user=self.user).first().save()
+        self.assertFalse(TimesheetSnapshot.objects.exists())
+        capture()
+        activity = Activity.objects.first()
+        activity.save()
+        self.assertTrue(TimesheetSnapshot.objects.exists())
+        activity.billable = not activity.billable
+        activity.save()
+        self.assertFalse(TimesheetSnapshot.objects.exists())
+        capture()
+        self.p1.type.billable = not self.p1.type.billable
+        self.p1.type.save()
+        self.assertFalse(TimesheetSnapshot.objects.exists())
+        capture()
+        self.p1.type = self.p2.type
+        self.p1.save()
+        self.assertFalse(TimesheetSnapshot.objects.exists())
+        capture()
+        with self.settings(TIMEPIECE_TIMESHEET_SNAPSHOTS=True):
+            self.assertIsNotNone(TimesheetSnapshot.objects.get_data(
+                start, user=self.user))
+            with self.settings(TIMEPIECE_PAID_LEAVE_PROJECTS={'sick': self.p3.pk}):
+                self.assertIsNone(TimesheetSnapshot.objects.get_data(
+                    start, user=self.user))
+
+    def testSnapshotsForgottenOnRename(self):
+        """Snapshots are forgotten when a name they show changes."""
+        self._log_summary_entries(self.user)
+        Entry.no_join.update(status=Entry.APPROVED)
+        start = utils.add_timezone(datetime.datetime(2011, 1, 1))
+        end = start + relativedelta(months=1)
+        entry = Entry.objects.filter(user=self.user).first()
+        location = entry.location
+        for obj, field in ((self.user, 'first_name'), (self.user, 'last_name'),
+                           (self.p1, 'name'), (self.p1.type, 'label'),
+                           (entry.activity, 'name'), (location, 'name')):
+            with self.settings(TIMEPIECE_TIMESHEET_SNAPSHOTS=True):
+                self.assertTrue(Timesheet(self.user, start, end).capture())
+            obj.save()
+            self.assertTrue(TimesheetSnapshot.objects.exists())
+            setattr(obj, field, getattr(obj, field) + ' renamed')
+            obj.save()
+            self.assertFalse(TimesheetSnapshot.objects.exists(), (obj, field))
+        with self.settings(TIMEPIECE_TIMESHEET_SNAPSHOTS=True):
+            self.assertTrue(Timesheet(self.user, start, end).capture())
+        self.user.last_login = timezone.now()
+        with self.assertNumQueries(1):
+            self.user.save(update_fields=['last_login'])
+        self.assertTrue(TimesheetSnapshot.objects.exists())
+
+    @override_settings(TIMEPIECE_TIMESHEET_SNAPSHOTS=True)
+    def testApproveCapturesSnapshot(self):
+        """Approving a time sheet captures its month."""
+        self._log_summary_entries(self.user)
+        Entry.no_join.update(status=Entry.VERIFIED)
+        self.login_user(self.superuser)
+        url = reverse('change_user_timesheet', args=(self.user.pk, 'approve'))
+        self.client.post(url + '?from_date=2011-01-01', {'do_action': 'Yes'})
+        snapshots = TimesheetSnapshot.objects.filter(user=self.user)
+        self.assertEqual([snapshot.month for snapshot in snapshots],
+                         [datetime.date(2011, 1, 1)])
+        self.assertEqual(TimesheetSnapshot.objects.filter(
+            project__isnull=False).count(), 4)
+        Entry.no_join.filter(project=self.p2).update(status=Entry.VERIFIED)
+        self.assertEqual(TimesheetSnapshot.objects.count(), 3)
+
 
 class HourlySummaryTest(ViewTestMixin, TestCase):
 
@@ -1927,6 +2161,20 @@ class HourlySummaryTest(ViewTestMixin, TestCase):
         msg = 'Week of {0}'.format(start_date.strftime('%b %d, %Y')).replace(" 0", " ")
         self.assertContains(response, msg)
 
+    def test_query_count(self):
+        """The time sheet's queries don't depend on the number of entries."""
+        self.create_month_entries()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url)
+        for project in (self.project, self.project2):
+            factories.Entry(
+                user=self.user, project=project,
+                start_time=self.month + relativedelta(days=2),
+                end_time=self.month + relativedelta(days=2, hours=1))
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(self.url)
+        self.assertEqual(len(response.context['entries']), 6)
+
     def test_contains_only_current_entries(self):
         """
         Only entries from the current month should be displayed
@@ -2131,3 +2379,189 @@ class MonthlyRejectTestCase(ViewTestMixin, TestCase):
 
         entries = Entry.no_join.filter(status=Entry.UNVERIFIED)
         self.assertEquals(entries.count(), 0)
+
+
+class TimesheetPeriodTestCase(ViewTestMixin, TestCase):
+
+    def setUp(self):
+        super(TimesheetPeriodTestCase, self).setUp()
+        self.user = factories.User()
+        self.month = datetime.date(2016, 3, 1)
+        self.day = datetime.datetime(2016, 3, 2, 8)
+
+    def log_time(self, day=None, **kwargs):
+        start = day or self.day
+        data = {
+            'user': self.user,
+            'start_time': start,
+            'end_time': start + relativedelta(hours=1),
+        }
+        data.update(kwargs)
+        return factories.Entry(**data)
+
+    def get_status(self, month=None):
+        return TimesheetPeriod.objects.get_status(self.user, month or self.month)
+
+    def test_no_entries(self):
+        """A month without entries is open."""
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_status(), TimesheetPeriod.OPEN)
+        self.assertFalse(TimesheetPeriod.objects.is_locked(self.user, self.day))
+
+    def test_least_advanced_status(self):
+        """A month's status is that of its least advanced entry."""
+        entry = self.log_time(status=Entry.INVOICED)
+        self.assertEqual(self.get_status(), TimesheetPeriod.INVOICED)
+        self.log_time(day=self.day + relativedelta(days=1), status=Entry.APPROVED)
+        self.assertEqual(self.get_status(), TimesheetPeriod.APPROVED)
+        self.assertTrue(TimesheetPeriod.objects.is_locked(self.user, self.day))
+        entry.status = Entry.UNVERIFIED
+        entry.save()
+        self.assertEqual(self.get_status(), TimesheetPeriod.OPEN)
+
+    def test_locked(self):
+        """A month is locked as soon as any of its entries are approved."""
+        self.log_time()
+        self.assertFalse(TimesheetPeriod.objects.is_locked(self.user, self.day))
+        entry = self.log_time(day=self.day + relativedelta(days=1),
+                              status=Entry.APPROVED)
+        self.assertTrue(TimesheetPeriod.objects.is_locked(self.user, self.day))
+        entry.status = Entry.VERIFIED
+        entry.save()
+        self.assertFalse(TimesheetPeriod.objects.is_locked(self.user, self.day))
+
+    def test_active_entry(self):
+        """Active entries are not counted until they are closed."""
+        self.log_time(status=Entry.APPROVED)
+        entry = self.log_time(day=self.day + relativedelta(days=1), end_time=None)
+        self.assertEqual(self.get_status(), TimesheetPeriod.APPROVED)
+        entry.end_time = entry.start_time + relativedelta(hours=1)
+        entry.save()
+        self.assertEqual(self.get_status(), TimesheetPeriod.OPEN)
+
+    def test_move_entry(self):
+        """An entry moved to another month leaves the old month's status."""
+        self.log_time(status=Entry.APPROVED)
+        entry = self.log_time(day=self.day + relativedelta(days=1))
+        entry.start_time += relativedelta(months=1)
+        entry.end_time += relativedelta(months=1)
+        entry.save()
+        self.assertEqual(self.get_status(), TimesheetPeriod.APPROVED)
+        next_month = self.month + relativedelta(months=1)
+        self.assertEqual(self.get_status(next_month), TimesheetPeriod.OPEN)
+
+    def test_save_refreshes_once(self):
+        """
+        An entry moved within its month refreshes the month and deletes its
+        snapshots once, and its user is locked once for both the month and
+        its rollups.
+        """
+        def refresh_queries(entry):
+            with CaptureQueriesContext(connection) as queries:
+                entry.save()
+            sqls = [query['sql'] for query in queries.captured_queries]
+            return (len([sql for sql in sqls if 'DELETE FROM "timepiece_timesheetperiod"' in sql]),
+                    len([sql for sql in sqls if 'pg_advisory_xact_lock' in sql]),
+                    len([sql for sql in sqls if 'timepiece_timesheetsnapshot' in sql]))
+
+        entry = Entry.objects.get(pk=self.log_time().pk)
+        entry.comments = 'Changed'
+        self.assertEqual(refresh_queries(entry), (0, 0, 1))
+        entry.start_time += relativedelta(days=1)
+        entry.end_time += relativedelta(days=1)
+        self.assertEqual(refresh_queries(entry), (1, 1, 1))
+        self.assertEqual(self.get_status(), TimesheetPeriod.OPEN)
+
+    def test_queryset_update(self):
+        """Status changes through queryset updates are kept."""
+        self.log_time()
+        self.log_time(day=self.day + relativedelta(days=1))
+        entries = Entry.no_join.filter(user=self.user)
+        entries.update(status=Entry.VERIFIED)
+        self.assertEqual(self.get_status(), TimesheetPeriod.VERIFIED)
+        entries.update(status=Entry.APPROVED)
+        self.assertEqual(self.get_status(), TimesheetPeriod.APPROVED)
+        entries.update(comments='Reviewed')
+        self.assertEqual(self.get_status(), TimesheetPeriod.APPROVED)
+
+    def test_delete(self):
+        self.log_time(status=Entry.APPROVED)
+        entry = self.log_time(day=self.day + relativedelta(days=1))
+        entry.delete()
+        self.assertEqual(self.get_status(), TimesheetPeriod.APPROVED)
+        Entry.no_join.filter(user=self.user).delete()
+        self.assertFalse(TimesheetPeriod.objects.filter(user=self.user).exists())
+
+    def test_approve_approved_month(self):
+        """An approved month is turned away without reading its entries."""
+        self.log_time(status=Entry.APPROVED)
+        self.login_user(factories.Superuser())
+        url = reverse('change_user_timesheet', args=(self.user.pk, 'approve'))
+        url += '?' + urlencode({'from_date': self.month.strftime('%Y-%m-%d')})
+        response = self.client.get(url, follow=True)
+        self.assertEqual(
+            [str(message) for message in response.context['messages']],
+            ['You cannot verify/approve a timesheet with no hours'])
+
+
+class BulkTimesheetTestCase(ViewTestMixin, TestCase):
+
+    def setUp(self):
+        super(BulkTimesheetTestCase, self).setUp()
+        self.group = factories.Group()
+        self.day = datetime.datetime(2016, 3, 2, 8)
+        self.data = {'month': 3, 'year': 2016, 'group': self.group.pk}
+        self.url = reverse('change_user_timesheets', args=('verify',))
+        self.login_user(factories.Superuser())
+
+    def add_user(self, hours=True):
+        user = factories.User()
+        user.groups.add(self.group)
+        if hours:
+            for days in (0, 1):
+                start = self.day + relativedelta(days=days)
+                factories.Entry(user=user, start_time=start,
+                                end_time=start + relativedelta(hours=2))
+        return user
+
+    def test_permission(self):
+        self.login_user(factories.User())
+        response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Entry.no_join.filter(status=Entry.VERIFIED).exists())
+
+    def test_verify_group(self):
+        """Each member's result is reported."""
+        users = [self.add_user(), self.add_user(hours=False)]
+        response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, 200)
+        results = dict((result.user, result) for result in response.context['results'])
+        self.assertEqual(results[users[0]].entries, 2)
+        self.assertEqual(results[users[0]].hours, Decimal('4.00000'))
+        self.assertEqual(results[users[1]].error, 'Has no hours to verify')
+        self.assertEqual(
+            set(Entry.no_join.values_list('status', flat=True)), set([Entry.VERIFIED]))
+        self.assertEqual(
+            TimesheetPeriod.objects.get_status(users[0], self.day), TimesheetPeriod.VERIFIED)
+
+    def test_query_count(self):
+        """The number of queries doesn't grow with the number of users."""
+        self.add_user()
+        self.add_user(hours=False)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(self.url, self.data)
+        Entry.no_join.update(status=Entry.UNVERIFIED)
+        for i in range(3):
+            self.add_user()
+        with self.assertNumQueries(len(queries)):
+            self.client.post(self.url, self.data)
+        self.assertEqual(Entry.no_join.filter(status=Entry.VERIFIED).count(), 8)
+
+    def test_locks_users(self):
+        """Members are locked like other entry changes, not as user rows."""
+        self.add_user()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(self.url, self.data)
+        sqls = [query['sql'] for query in queries.captured_queries]
+        self.assertTrue(any('pg_advisory_xact_lock' in sql for sql in sqls))
+        self.assertFalse(any('FOR UPDATE' in sql for sql in sqls))
@@ -43,6 +43,9 @@ urlpatterns = [
     url(r'^schedule/ajax/$',
         views.ScheduleAjaxView.as_view(),
         name='ajax_schedule'),
+    url(r'^schedule/ajax/bulk/$',
+        views.ScheduleBulkView.as_view(),
+        name='ajax_schedule_bulk'),
     url(r'^schedule/ajax/(?P<assignment_id>\d+)/$',
         views.ScheduleDetailView.as_view(),
         name='ajax_schedule_detail'),
@@ -1,7 +1,7 @@
-from copy import deepcopy
 import datetime
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
+import hashlib
 from itertools import groupby
 import json
 
@@ -13,11 +13,13 @@ from django.contrib.auth.models import User, Permission
 from django.contrib.contenttypes.models import ContentType
 from django.core import exceptions
 from django.core.urlresolvers import reverse
-from django.db import transaction
-from django.db.models import Q
-from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.db import connections, transaction
+from django.db.models import Q, Sum
+from django.http import (
+    HttpResponse, HttpResponseNotModified, HttpResponseRedirect, Http404)
 from django.shortcuts import redirect, render
 from django.utils.decorators import method_decorator
+from django.utils.http import parse_etags, quote_etag
 from django.views.generic import TemplateView, View
 
 from timepiece import utils
@@ -27,8 +29,8 @@ from timepiece.utils.views import cbv_decorator
 
 from timepiece.crm.models import Project, UserProfile
 from timepiece.entries.forms import (
-    ClockInForm, ClockOutForm, AddUpdateEntryForm, ProjectHoursForm,
-    ProjectHoursSearchForm)
+    ClockInForm, ClockOutForm, AddUpdateEntryForm, ProjectHoursCopyForm,
+    ProjectHoursForm, ProjectHoursSearchForm)
 from timepiece.entries.models import Entry, ProjectHours
 
 
@@ -71,10 +73,15 @@ class Dashboard(TemplateView):
         # Process this week's entries to determine assignment progress.
         week_entries = Entry.objects.filter(user=self.user)
         week_entries = week_entries.timespan(week_start, span='week', current=True)
-        week_entries = week_entries.select_related('project')
+        week_entries = week_entries.select_related('project__business')
+        week_totals = Entry.no_join.filter(user=self.user)
+        week_totals = week_totals.timespan(week_start, span='week')
         assignments = ProjectHours.objects.filter(
             user=self.user, week_start=week_start.date())
-        project_progress = self.process_progress(week_entries, assignments)
+        project_progress = self.process_progress(
+            week_totals, assignments, active_entry)
+        daily_entries = self.process_daily_entries(
+            week_entries, week_totals, active_entry)
 
         # Total hours that the user is expected to clock this week.
         total_assigned = self.get_hours_per_week(self.user)
@@ -83,7 +90,8 @@ class Dashboard(TemplateView):
         # Others' active entries.
         others_active_entries = Entry.objects.filter(end_time__isnull=True)
         others_active_entries = others_active_entries.exclude(user=self.user)
-        others_active_entries = others_active_entries.select_related('user', 'project', 'activity')
+        others_active_entries = others_active_entries.select_related(
+            'user', 'project__business', 'activity')
 
         return {
             'active_tab': self.active_tab,
@@ -95,44 +103,87 @@ class Dashboard(TemplateView):
             'total_worked': total_worked,
             'project_progress': project_progress,
             'week_entries': week_entries,
+            'daily_entries': daily_entries,
             'others_active_entries': others_active_entries,
         }
 
-    def process_progress(self, entries, assignments):
+    def get_active_hours(self, active_entry):
+        """Returns the hours of the active entry so far, as they'd be saved."""
+        return Decimal('%.5f' % round(active_entry.total_hours, 5))
+
+    def process_progress(self, entries, assignments, active_entry=None):
         """
         Returns a list of progress summary data (pk, name, hours worked, and
         hours assigned) for each project either worked or assigned.
         The list is ordered by project name.
+
+        The hours of finished entries are totaled by the database; only the
+        active entry, if given, is timed here.
         """
-        # Determine all projects either worked or assigned.
-        project_q = Q(id__in=assignments.values_list('project__id', flat=True))
-        project_q |= Q(id__in=entries.values_list('project__id', flat=True))
-        projects = Project.objects.filter(project_q).select_related('business')
+        entries = entries.filter(end_time__isnull=False).order_by()
+        worked = dict(entries.values_list('project').annotate(Sum('hours')))
+        assigned = dict(assignments.order_by().values_list('project', 'hours'))
+        if active_entry is not None:
+            pk = active_entry.project_id
+            worked[pk] = (worked.get(pk) or Decimal('0.00')) + \
+                self.get_active_hours(active_entry)
 
-        # Hours per project.
-        project_data = {}
-        for project in projects:
-            try:
-                assigned = assignments.get(project__id=project.pk).hours
-            except ProjectHours.DoesNotExist:
-                assigned = Decimal('0.00')
-            project_data[project.pk] = {
-                'project': project,
-                'assigned': assigned,
-                'worked': Decimal('0.00'),
-            }
-
-        for entry in entries:
-            pk = entry.project_id
-            hours = Decimal('%.5f' % (entry.get_total_seconds() / 3600.0))
-            project_data[pk]['worked'] += hours
+        # Determine all projects either worked or assigned.
+        projects = Project.objects.filter(pk__in=set(worked) | set(assigned))
+        projects = projects.select_related('business')
+        project_data = [{
+            'project': project,
+            'assigned': assigned.get(project.pk, Decimal('0.00')),
+            'worked': worked.get(project.pk) or Decimal('0.00'),
+        } for project in projects]
 
         # Sort by maximum of worked or assigned hours (highest first).
         key = lambda x: x['project'].name.lower()
-        project_progress = sorted(project_data.values(), key=key)
+        project_progress = sorted(project_data, key=key)
 
         return project_progress
 
+    def process_daily_entries(self, entries, totals, active_entry=None):
+        """
+        Groups entries (ordered by start time) by the day they started, and
+        returns a list of dictionaries with each day, its entries and its
+        total hours. The hours of finished entries are totaled by the
+        database, from the totals queryset.
+        """
+        qn = connections[totals.db].ops.quote_name
+        day = 'DATE({0}.{1})'.format(qn(Entry._meta.db_table), qn('start_time'))
+        totals = totals.filter(end_time__isnull=False).order_by()
+        totals = totals.extra(select={'day': day}).values_list('day')
+        hours = dict(totals.annotate(Sum('hours')))
+        if active_entry is not None:
+            start = active_entry.start_time.date()
+            hours[start] = (hours.get(start) or Decimal('0.00')) + \
+                self.get_active_hours(active_entry)
+
+        daily_entries = []
+        for start, day_entries in groupby(entries, lambda e: e.start_time.date()):
+            daily_entries.append({
+                'day': start,
+                'entries': list(day_entries),
+                'hours': hours.get(start) or Decimal('0.00'),
+            })
+        return daily_entries
+
+
+def save_entry_form(form):
+    """
+    Saves a valid entry form and returns the entry. If another request saved
+    a conflicting entry after the form was validated, the overlap constraint
+    rejects this one: nothing is saved, the error is added to the form and
+    None is returned.
+    """
+    try:
+        with transaction.atomic():
+            return form.save()
+    except exceptions.ValidationError as e:
+        form.add_error(None, e)
+        return None
+
 
 @permission_required('entries.can_clock_in')
 @transaction.atomic
@@ -146,8 +197,8 @@ def clock_in(request):
     initial = dict([(k, v) for k, v in request.GET.items()])
     data = request.POST or None
     form = ClockInForm(data, initial=initial, user=user, active=active_entry)
-    if form.is_valid():
-        entry = form.save()
+    entry = save_entry_form(form) if form.is_valid() else None
+    if entry:
         message = 'You have clocked into {0} on {1}.'.format(
             entry.activity.name, entry.project)
         messages.info(request, message)
@@ -168,8 +219,7 @@ def clock_out(request):
         return HttpResponseRedirect(reverse('dashboard'))
     if request.POST:
         form = ClockOutForm(request.POST, instance=entry)
-        if form.is_valid():
-            entry = form.save()
+        if form.is_valid() and save_entry_form(form):
             message = 'You have clocked out of {0} on {1}.'.format(
                 entry.activity.name, entry.project)
             messages.info(request, message)
@@ -226,8 +276,7 @@ def create_edit_entry(request, entry_id=None):
                                   instance=entry,
                                   user=entry_user,
                                   acting_user=request.user)
-        if form.is_valid():
-            entry = form.save()
+        if form.is_valid() and save_entry_form(form):
             if entry_id:
                 message = 'The entry has been updated successfully.'
             else:
@@ -471,6 +520,30 @@ class ScheduleAjaxView(ScheduleMixin, View):
 
         return ph
 
+    def get_reference_data(self):
+        """
+        Returns the projects and the users that can clock in, which are used
+        for autocompletion, along with a version which changes whenever they
+        do.
+        """
+        perm = Permission.objects.filter(
+            content_type=ContentType.objects.get_for_model(Entry),
+            codename='can_clock_in'
+        )
+        all_projects = Project.objects.values('id', 'name').order_by('name', 'id')
+        user_q = Q(groups__permissions=perm) | Q(user_permissions=perm)
+        user_q |= Q(is_superuser=True)
+        all_users = User.objects.filter(user_q).distinct() \
+            .values('id', 'first_name', 'last_name') \
+            .order_by('first_name', 'last_name', 'id')
+
+        data = {
+            'all_projects': list(all_projects),
+            'all_users': list(all_users),
+        }
+        content = json.dumps(data, sort_keys=True).encode('utf-8')
+        return data, hashlib.md5(content).hexdigest()
+
     def get(self, request, *args, **kwargs):
         """
         Returns the data as a JSON object made up of the following key/value
@@ -479,11 +552,12 @@ class ScheduleAjaxView(ScheduleMixin, View):
             projects: the projects that have hours for the week
             all_projects: all of the projects; used for autocomplete
             all_users: all users that can clock in; used for completion
+            reference_version: the version of all_projects and all_users
+
+        all_projects and all_users are left out if the reference parameter
+        gives their current version. The response has an ETag, and requests
+        whose If-None-Match header matches it get an empty 304 response.
         """
-        perm = Permission.objects.filter(
-            content_type=ContentType.objects.get_for_model(Entry),
-            codename='can_clock_in'
-        )
         project_hours = self.get_hours_for_week()
         project_hours = project_hours.values(
             'id', 'user', 'user__first_name', 'user__last_name',
@@ -494,58 +568,48 @@ class ScheduleAjaxView(ScheduleMixin, View):
         inner_qs = project_hours.values_list('project', flat=True)
         projects = Project.objects.filter(pk__in=inner_qs).values() \
             .order_by('name')
-        all_projects = Project.objects.values('id', 'name')
-        user_q = Q(groups__permissions=perm) | Q(user_permissions=perm)
-        user_q |= Q(is_superuser=True)
-        all_users = User.objects.filter(user_q) \
-            .values('id', 'first_name', 'last_name')
+        reference, version = self.get_reference_data()
 
         data = {
             'project_hours': list(project_hours),
             'projects': list(projects),
-            'all_projects': list(all_projects),
-            'all_users': list(all_users),
+            'reference_version': version,
             'ajax_url': reverse('ajax_schedule'),
+            'bulk_url': reverse('ajax_schedule_bulk'),
         }
-        return HttpResponse(json.dumps(data, cls=DecimalEncoder),
-                            content_type='application/json')
+        if request.GET.get('reference') != version:
+            data.update(reference)
+        content = json.dumps(data, cls=DecimalEncoder, sort_keys=True)
+        etag = hashlib.md5(content.encode('utf-8')).hexdigest()
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(content, content_type='application/json')
+        response['ETag'] = quote_etag(etag)
+        return response
 
     def duplicate_entries(self, duplicate, week_update):
-        def duplicate_builder(queryset, new_date):
-            for instance in queryset:
-                duplicate = deepcopy(instance)
-                duplicate.id = None
-                duplicate.published = False
-                duplicate.week_start = new_date
-                yield duplicate
-
-        def duplicate_helper(queryset, new_date):
-            try:
-                ProjectHours.objects.bulk_create(
-                    duplicate_builder(queryset, new_date)
-                )
-            except AttributeError:
-                for entry in duplicate_builder(queryset, new_date):
-                    entry.save()
-            msg = 'Project hours were copied'
-            messages.info(self.request, msg)
-
-        this_week = datetime.datetime.strptime(week_update, DATE_FORM_FORMAT).date()
-        prev_week = this_week - relativedelta(days=7)
-        prev_week_qs = self.get_hours_for_week(prev_week)
-        this_week_qs = self.get_hours_for_week(this_week)
-
+        """
+        Copies the hours of a source week (the week before week_update by
+        default) into week_update and, if the weeks parameter is given, the
+        weeks after it, optionally only for some projects or users. See
+        ProjectHoursCopyForm.
+        """
+        form = ProjectHoursCopyForm(self.request.POST)
         param = {
             'week_start': week_update
         }
         url = '?'.join((reverse('edit_schedule'), urlencode(param),))
 
-        if not prev_week_qs.exists():
+        if not form.is_valid():
+            errors = [e for field in form.errors.values() for e in field]
+            messages.error(self.request, ' '.join(errors))
+        elif not form.save():
             msg = 'There are no hours to copy'
             messages.warning(self.request, msg)
         else:
-            this_week_qs.delete()
-            duplicate_helper(prev_week_qs, this_week)
+            msg = 'Project hours were copied'
+            messages.info(self.request, msg)
         return HttpResponseRedirect(url)
 
     def update_week(self, week_start):
@@ -587,6 +651,54 @@ class ScheduleAjaxView(ScheduleMixin, View):
         return self.update_week(week_start)
 
 
+@cbv_decorator(permission_required('entries.add_projecthours'))
+class ScheduleBulkView(View):
+
+    def post(self, request, *args, **kwargs):
+        """
+        Saves a batch of changes to the schedule in one transaction. The
+        request body is a JSON object with the following keys:
+            week_start: the start of the week for the hours, as yyyy-mm-dd
+            changes: a list of objects with the user pk, the project pk and
+                the hours for each changed cell; zero hours removes the cell
+
+        Returns a JSON object whose project_hours lists the saved hours.
+        """
+        msg = 'The request must contain a week_start and a list of changes ' \
+            'with values for user, project, and hours'
+        try:
+            data = json.loads(request.body.decode('utf-8'))
+            week_start = datetime.datetime.strptime(
+                data['week_start'], DATE_FORM_FORMAT).date()
+            hours = {}
+            for change in data['changes']:
+                pair = (int(change['user']), int(change['project']))
+                hours[pair] = Decimal(str(change['hours'] or 0))
+        except (ValueError, KeyError, TypeError, ArithmeticError):
+            return HttpResponse(msg, status=500)
+        if any(value < 0 or value >= 10 ** 6 for value in hours.values()):
+            return HttpResponse(msg, status=500)
+
+        users = set(user for user, project in hours)
+        projects = set(project for user, project in hours)
+        if (User.objects.filter(pk__in=users).count() != len(users) or
+                Project.objects.filter(pk__in=projects).count() != len(projects)):
+            return HttpResponse(msg, status=500)
+
+        saved = ProjectHours.objects.assign(week_start, hours)
+        data = {
+            'project_hours': [{
+                'id': ph.pk,
+                'user': ph.user_id,
+                'project': ph.project_id,
+                'hours': ph.hours,
+                'published': ph.published,
+            } for ph in saved],
+        }
+        return HttpResponse(json.dumps(data, cls=DecimalEncoder),
+                            content_type='application/json')
+
+
 @cbv_decorator(permission_required('entries.add_projecthours'))
 class ScheduleDetailView(ScheduleMixin, View):
 
@@ -0,0 +1,169 @@
+from collections import OrderedDict
+import datetime
+from decimal import Decimal
+from optparse import make_option
+from timeit import default_timer
+
+from dateutil.relativedelta import relativedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from timepiece import utils
+from timepiece.crm.models import Attribute, Business, Project
+from timepiece.entries.models import Activity, Entry, EntryRollup, Location
+from timepiece.reports.engine import Report
+from timepiece.reports.utils import get_payroll_totals
+
+
+class Command(BaseCommand):
+    """
+    Management command to time reports against generated entries. The
+    entries are created in a transaction which is rolled back afterwards.
+    Use ./manage.py benchmark_reports --help for more details
+    """
+    args = '[<report>] [<report>] ...'
+    help = ("Time reports against a generated set of entries, and show how "
+            "many rows and queries each version of a report reads.\n"
+            "Reports: hourly, payroll. Use --help for options.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('-u', '--users',
+                    dest='users',
+                    type='int',
+                    default=None,
+                    help='Generate entries for n users (by default, the '
+                         'most any of the reports is benchmarked at)'),
+        make_option('-d', '--days',
+                    dest='days',
+                    type='int',
+                    default=365,
+                    help='Generate an entry for each weekday of the last n days'),
+    )
+    # The number of users each report is benchmarked at by default.
+    reports = OrderedDict([('hourly', 200), ('payroll', 1000)])
+    username_prefix = 'timepiece benchmark '
+
+    def handle(self, *args, **kwargs):
+        reports = args or self.reports
+        unknown = [report for report in reports if report not in self.reports]
+        if unknown:
+            raise CommandError('Unknown report(s): %s' % ', '.join(unknown))
+        num_users = kwargs['users']
+        if num_users is None:
+            num_users = max(self.reports[report] for report in reports)
+        with transaction.atomic():
+            start, end = self.make_entries(num_users, kwargs['days'])
+            for report in reports:
+                benchmarks = getattr(self, 'benchmark_' + report)(start, end)
+                for label, func in benchmarks:
+                    with CaptureQueriesContext(connection) as queries:
+                        began = default_timer()
+                        rows = func()
+                        elapsed = default_timer() - began
+                    self.stdout.write('%s, %s: %d rows, %d queries in %.3fs' % (
+                        report, label, rows, len(queries), elapsed))
+            transaction.set_rollback(True)
+
+    def make_entries(self, num_users, num_days):
+        """
+        Creates an 8-hour entry for each user on each weekday of the last
+        num_days days, and returns the (start, end) of that range.
+        """
+        end = utils.add_timezone(datetime.datetime.combine(
+            datetime.date.today(), datetime.time()))
+        start = end - relativedelta(days=num_days)
+
+        location, _ = Location.objects.get_or_create(
+            slug='benchmark', defaults={'name': 'Benchmark'})
+        activities = [
+            Activity.objects.get_or_create(code='bnch', defaults={
+                'name': 'Benchmark', 'billable': True})[0],
+            Activity.objects.get_or_create(code='bnch2', defaults={
+                'name': 'Benchmark (non-billable)', 'billable': False})[0],
+        ]
+        business = Business.objects.create(name='Benchmark')
+        status = Attribute.objects.create(
+            type=Attribute.PROJECT_STATUS, label='Benchmark')
+        types = [Attribute.objects.create(
+            type=Attribute.PROJECT_TYPE, label='Benchmark %d' % i,
+            billable=bool(i % 2)) for i in range(4)]
+
+        # Generated usernames can't clash with real ones, which can't
+        # contain spaces, so only the generated users are read back.
+        usernames = ['%s%d' % (self.username_prefix, i) for i in range(num_users)]
+        User.objects.bulk_create([
+            User(username=username, first_name='User', last_name='%d' % i)
+            for i, username in enumerate(usernames)])
+        users = list(User.objects.filter(username__in=usernames).order_by('pk'))
+        user_ids = [user.pk for user in users]
+        projects = [Project.objects.create(
+            name='Benchmark %d' % i, business=business, point_person=users[0],
+            type=types[i % len(types)], status=status, description='')
+            for i in range(20)]
+
+        batch = []
+        day = start
+        while day < end:
+            if day.weekday() < 5:
+                for i, user in enumerate(users):
+                    start_time = day + relativedelta(hours=9)
+                    batch.append(Entry(
+                        user=user, project=projects[(i + day.day) % len(projects)],
+                        activity=activities[i % len(activities)],
+                        location=location, start_time=start_time,
+                        end_time=start_time + relativedelta(hours=8),
+                        hours=Decimal('8.00000'), status=Entry.APPROVED))
+            if len(batch) >= 1000:
+                Entry.no_join.bulk_create(batch)
+                batch = []
+            day += relativedelta(days=1)
+        Entry.no_join.bulk_create(batch)
+        EntryRollup.objects.refresh(user_ids, start.date(), end.date())
+        return start, end
+
+    def benchmark_hourly(self, start, end):
+        entryQ = Q(end_time__gte=start, end_time__lt=end)
+
+        def hourly():
+            """The hourly report's pivot, and both of the tables built from it."""
+            pivot = Report(rows=('user', 'project_type', 'project'),
+                           grain='week', filters=[entryQ], start=start,
+                           end=end - relativedelta(days=1)).run()
+            pivot.rollup(('user',)).table('total', total_column=True)
+            pivot.rollup(('project_type', 'project')).table(
+                'total', total_column=True)
+            return pivot.num_results
+
+        def from_entries():
+            with override_settings(TIMEPIECE_USE_ENTRY_ROLLUPS=False):
+                return hourly()
+
+        def from_rollups():
+            with override_settings(TIMEPIECE_USE_ENTRY_ROLLUPS=True):
+                return hourly()
+
+        return [('entries', from_entries), ('rollups', from_rollups)]
+
+    def benchmark_payroll(self, start, end):
+        from_date = utils.get_month_start(end - relativedelta(months=1))
+        to_date = from_date + relativedelta(months=1)
+        leave_ids = utils.get_setting('TIMEPIECE_PAID_LEAVE_PROJECTS').values()
+        monthQ = Q(end_time__gt=from_date, end_time__lt=to_date)
+        workQ = ~Q(project__in=leave_ids)
+        statusQ = Q(status=Entry.INVOICED) | Q(status=Entry.APPROVED)
+
+        def monthly():
+            """The monthly summary: one pass over its work and leave totals."""
+            work = Report(rows=('user', 'project_type'),
+                          measures=('billable', 'non_billable'),
+                          filters=[monthQ, statusQ, workQ]).run()
+            leave = Report(rows=('user', 'project'),
+                           filters=[monthQ, ~workQ]).run()
+            labels, rows = get_payroll_totals(work, leave)
+            return work.num_results + leave.num_results
+
+        return [('monthly', monthly)]
@@ -0,0 +1,100 @@
+import datetime
+from optparse import make_option
+from timeit import default_timer
+
+from dateutil.relativedelta import relativedelta
+
+from django.contrib.auth.models import Group, User
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from timepiece import utils
+from timepiece.crm.timesheet import ACTIONS, change_timesheets
+
+
+class Command(BaseCommand):
+    """
+    Management command to verify or approve the time sheets of many users
+    for a month.
+    Use ./manage.py change_timesheets --help for more details
+    """
+    args = '<verify|approve>'
+    help = ("Verify or approve the time sheets of the given users, or of the "
+            "members of a group, for a month, and report the result for each "
+            "user.\nUse --help for options.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--month',
+                    dest='month',
+                    default=None,
+                    help='Month of the time sheets, as YYYY-MM '
+                         '(last month by default)'),
+        make_option('-u', '--users',
+                    dest='users',
+                    default=None,
+                    help='Comma-separated usernames of the users'),
+        make_option('-g', '--group',
+                    dest='group',
+                    default=None,
+                    help='Name of a group whose members to include'),
+        make_option('-c', '--chunk-size',
+                    dest='chunk_size',
+                    type='int',
+                    default=50,
+                    help='Change the time sheets of n users in each transaction'),
+    )
+
+    def handle(self, *args, **kwargs):
+        verbosity = kwargs.get('verbosity', 1)
+        if len(args) != 1 or args[0] not in ACTIONS:
+            raise CommandError('Give the action to take: verify or approve.')
+        action = args[0]
+        from_date = self.parse_month(kwargs['month'])
+        users = self.find_users(kwargs['users'], kwargs['group'])
+
+        num_changed = num_users = 0
+        began = default_timer()
+        for results in change_timesheets(users, from_date, action,
+                                         chunk_size=kwargs['chunk_size']):
+            for result in results:
+                num_users += 1
+                num_changed += not result.error
+                if verbosity >= 1:
+                    self.stdout.write('%s: %s' % (
+                        result.user.get_name_or_username(),
+                        result.error or '%d entries, %.2f hours' % (
+                            result.entries, result.hours)))
+        elapsed = default_timer() - began
+        if verbosity >= 1:
+            self.stdout.write('%s %d of %d time sheets for %s in %.3fs' % (
+                ACTIONS[action][1].capitalize(), num_changed, num_users,
+                from_date.strftime('%B %Y'), elapsed))
+
+    def parse_month(self, value):
+        if not value:
+            return utils.get_month_start() - relativedelta(months=1)
+        try:
+            return datetime.datetime.strptime(value, '%Y-%m')
+        except ValueError:
+            raise CommandError('Invalid month: %s' % value)
+
+    def find_users(self, usernames, group):
+        if not usernames and not group:
+            raise CommandError('Give some users with --users or a group with --group.')
+        query = Q()
+        if usernames:
+            usernames = [name.strip() for name in usernames.split(',') if name.strip()]
+            found = set(User.objects.filter(username__in=usernames)
+                                    .values_list('username', flat=True))
+            missing = [name for name in usernames if name not in found]
+            if missing:
+                raise CommandError('No user was found with the username %s' %
+                                   ', '.join(missing))
+            query |= Q(username__in=usernames)
+        if group:
+            try:
+                query |= Q(groups=Group.objects.get(name=group))
+            except Group.DoesNotExist:
+                raise CommandError('No group was found with the name %s' % group)
+        return User.objects.filter(query).distinct().order_by(
+            'last_name', 'first_name', 'pk')
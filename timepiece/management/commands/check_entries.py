@@ -1,10 +1,17 @@
+from collections import namedtuple
 from functools import reduce
+import heapq
+from itertools import groupby
+import json
+import multiprocessing
+from operator import attrgetter
 from optparse import make_option
 
 from dateutil.relativedelta import relativedelta
 
 from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
 from django.db.models import Q
 from django.utils import timezone
 
@@ -12,6 +19,85 @@ from timepiece import utils
 from timepiece.entries.models import Entry
 
 
+# Only the columns needed to detect and report an overlap are fetched, as
+# tuples, rather than full Entry instances.
+EntryRow = namedtuple('EntryRow', [
+    'id', 'user_id', 'first_name', 'last_name', 'start_time', 'end_time',
+    'seconds_paused', 'project_name', 'business_name', 'business_short_name',
+])
+
+
+def _seconds(delta):
+    return delta.seconds + delta.days * 86400
+
+
+def _total_seconds(row):
+    """Equivalent of Entry.get_total_seconds() for a closed entry row."""
+    return _seconds(row.end_time - row.start_time) - row.seconds_paused
+
+
+def rows_overlap(row_a, row_b):
+    """
+    Return True if the two closed entry rows overlap, allowing for time that
+    was paused within either entry (see Entry.check_overlap).
+
+    Unlike Entry.check_overlap, which only compared the ends of the entries
+    with strict inequalities, entries which share a start or end time, such
+    as identical entries, overlap. Entries which only touch do not.
+    """
+    if not (row_a.start_time < row_b.end_time and row_b.start_time < row_a.end_time):
+        return False
+    max_end = max(row_a.end_time, row_b.end_time)
+    min_start = min(row_a.start_time, row_b.start_time)
+    total = _total_seconds(row_a) + _total_seconds(row_b) - 1
+    return total >= _seconds(max_end - min_start)
+
+
+def find_overlaps(rows):
+    """
+    Yield each pair of overlapping entry rows.
+
+    The rows must be sorted by start_time. This is an interval sweep: a heap
+    of the entries still open at the current start time is kept (ordered by
+    end time), so each entry is only compared against the entries it could
+    actually intersect.
+    """
+    active = []
+    for index, row in enumerate(rows):
+        while active and active[0][0] <= row.start_time:
+            heapq.heappop(active)
+        for end_time, _, other in active:
+            if rows_overlap(other, row):
+                yield other, row
+        heapq.heappush(active, (row.end_time, index, row))
+
+
+def stream_entries(start=None, user_ids=None):
+    """
+    Yield a list of closed entry rows for each user, sorted by start_time.
+    All users' entries are read in a single streamed query.
+    """
+    entries = Entry.no_join.filter(end_time__isnull=False)
+    if start is not None:
+        entries = entries.filter(start_time__gte=start)
+    if user_ids is not None:
+        entries = entries.filter(user__in=user_ids)
+    entries = entries.order_by('user', 'start_time').values_list(
+        'id', 'user', 'user__first_name', 'user__last_name', 'start_time',
+        'end_time', 'seconds_paused', 'project__name',
+        'project__business__name', 'project__business__short_name')
+    rows = (EntryRow(*values) for values in entries.iterator())
+    for user_id, user_rows in groupby(rows, attrgetter('user_id')):
+        yield list(user_rows)
+
+
+def _check_users(task):
+    """Process pool worker: find the overlaps for a chunk of users."""
+    start, user_ids = task
+    return [(entries[0], list(find_overlaps(entries)))
+            for entries in stream_entries(start, user_ids)]
+
+
 class Command(BaseCommand):
     """
     Management command to check entries for overlapping times.
@@ -21,6 +107,8 @@ class Command(BaseCommand):
     args = '[<first or last name>] [<first or last name>] ...'
     help = ("Check the database for time entries that overlap.\n"
             "Use --help for options.")
+    # Collects per-user results when --json is given.
+    report = None
 
     option_list = BaseCommand.option_list + (
         make_option('--thisweek',
@@ -48,6 +136,16 @@ class Command(BaseCommand):
                     type='int',
                     default=0,
                     help='Show entries for the last n days only'),
+        make_option('-w', '--workers',
+                    dest='workers',
+                    type='int',
+                    default=1,
+                    help='Spread users across a pool of n processes'),
+        make_option('--json',
+                    action='store_true',
+                    dest='json',
+                    default=False,
+                    help='Write a JSON report instead of plain text'),
     )
 
     def usage(self, subcommand):
@@ -59,11 +157,21 @@ class Command(BaseCommand):
         verbosity = kwargs.get('verbosity', 1)
         start = self.find_start(**kwargs)
         users = self.find_users(*args)
+        self.report = [] if kwargs.get('json', False) else None
         self.show_init(start, *args, **kwargs)
 
-        all_entries = self.find_entries(users, start, *args, **kwargs)
-        all_overlaps = self.check_all(all_entries, *args, **kwargs)
-        if verbosity >= 1:
+        if kwargs.get('workers', 1) > 1:
+            all_overlaps = self.check_parallel(users, start, *args, **kwargs)
+        else:
+            all_entries = self.find_entries(users, start, *args, **kwargs)
+            all_overlaps = self.check_all(all_entries, *args, **kwargs)
+        if self.report is not None:
+            self.stdout.write(json.dumps({
+                'start': None if kwargs.get('all', False) else start.isoformat(),
+                'total': all_overlaps,
+                'users': self.report,
+            }))
+        elif verbosity >= 1:
             self.stdout.write('Total overlapping entries: %d' % all_overlaps)
 
     def check_all(self, all_entries, *args, **kwargs):
@@ -71,43 +179,51 @@ class Command(BaseCommand):
         Go through lists of entries, find overlaps among each, return the total
         """
         all_overlaps = 0
-        while True:
-            try:
-                user_entries = all_entries.next()
-            except StopIteration:
-                return all_overlaps
-            else:
-                user_total_overlaps = self.check_entry(
-                    user_entries, *args, **kwargs)
-                all_overlaps += user_total_overlaps
+        for user_entries in all_entries:
+            all_overlaps += self.check_entry(user_entries, *args, **kwargs)
+        return all_overlaps
+
+    def check_parallel(self, users, start, *args, **kwargs):
+        """
+        Split the users into chunks and find overlaps for each chunk in a
+        separate process. Returns the total number of overlaps.
+        """
+        workers = kwargs['workers']
+        if kwargs.get('all', False):
+            start = None
+        user_ids = list(users.order_by('pk').values_list('pk', flat=True))
+        num_chunks = workers * 4
+        tasks = [(start, user_ids[i::num_chunks]) for i in range(num_chunks)]
+        tasks = [task for task in tasks if task[1]]
+
+        # Forked workers must not share the parent's database connection.
+        for connection in connections.all():
+            connection.close()
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_check_users, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        all_overlaps = 0
+        # Report the users in the same order as check_all does.
+        results = sorted((r for chunk in results for r in chunk),
+                         key=lambda r: r[0].user_id)
+        for first_entry, overlaps in results:
+            all_overlaps += self.show_user_overlaps(
+                first_entry, overlaps, *args, **kwargs)
+        return all_overlaps
 
     def check_entry(self, entries, *args, **kwargs):
         """
-        With a list of entries, check each entry against every other
+        With a list of entry rows for a single user, sorted by start time,
+        find and report the overlapping pairs
         """
-        verbosity = kwargs.get('verbosity', 1)
-        user_total_overlaps = 0
-        user = ''
-        for index_a, entry_a in enumerate(entries):
-            # Show the name the first time through
-            if index_a == 0:
-                if args and verbosity >= 1 or verbosity >= 2:
-                    self.show_name(entry_a.user)
-                    user = entry_a.user
-            for index_b in range(index_a, len(entries)):
-                entry_b = entries[index_b]
-                if entry_a.check_overlap(entry_b):
-                    user_total_overlaps += 1
-                    self.show_overlap(entry_a, entry_b, verbosity=verbosity)
-        if user_total_overlaps and user and verbosity >= 1:
-            overlap_data = {
-                'first': user.first_name,
-                'last': user.last_name,
-                'total': user_total_overlaps,
-            }
-            self.stdout.write('Total overlapping entries for user ' +
-                              '%(first)s %(last)s: %(total)d' % overlap_data)
-        return user_total_overlaps
+        if not entries:
+            return 0
+        overlaps = list(find_overlaps(entries))
+        return self.show_user_overlaps(entries[0], overlaps, *args, **kwargs)
 
     def find_start(self, **kwargs):
         """
@@ -156,23 +272,21 @@ class Command(BaseCommand):
 
     def find_entries(self, users, start, *args, **kwargs):
         """
-        Find all entries for all users, from a given starting point.
+        Find all closed entries for all users, from a given starting point,
+        as one list of rows per user.
         If no starting point is provided, all entries are returned.
         """
         forever = kwargs.get('all', False)
-        for user in users:
-            if forever:
-                entries = Entry.objects.filter(user=user).order_by('start_time')
-            else:
-                entries = Entry.objects.filter(
-                    user=user, start_time__gte=start).order_by(
-                    'start_time')
-            yield entries
+        # Without names, every user is checked, so there's no need to filter.
+        user_ids = users.values('pk') if args else None
+        return stream_entries(None if forever else start, user_ids)
 
     # output methods
     def show_init(self, start, *args, **kwargs):
         forever = kwargs.get('all', False)
         verbosity = kwargs.get('verbosity', 1)
+        if kwargs.get('json', False):
+            return
         if forever:
             if verbosity >= 1:
                 self.stdout.write(
@@ -185,19 +299,55 @@ class Command(BaseCommand):
     def show_name(self, user):
         self.stdout.write('Checking %s %s...' % (user.first_name, user.last_name))
 
-    def show_overlap(self, entry_a, entry_b=None, **kwargs):
-        def make_output_data(entry):
-            return{
-                'first_name': entry.user.first_name,
-                'last_name': entry.user.last_name,
-                'entry': entry.id,
-                'start': entry.start_time,
-                'end': entry.end_time,
-                'project': entry.project
+    def show_user_overlaps(self, first_entry, overlaps, *args, **kwargs):
+        """
+        Report the overlapping pairs found for a single user, and return the
+        number of overlaps.
+        """
+        verbosity = kwargs.get('verbosity', 1)
+        user_total_overlaps = len(overlaps)
+        if self.report is not None:
+            if overlaps:
+                self.report.append({
+                    'user': first_entry.user_id,
+                    'first_name': first_entry.first_name,
+                    'last_name': first_entry.last_name,
+                    'total': user_total_overlaps,
+                    'overlaps': [[self.make_output_data(entry_a, iso=True),
+                                  self.make_output_data(entry_b, iso=True)]
+                                 for entry_a, entry_b in overlaps],
+                })
+            return user_total_overlaps
+        show_name = args and verbosity >= 1 or verbosity >= 2
+        if show_name:
+            self.show_name(first_entry)
+        for entry_a, entry_b in overlaps:
+            self.show_overlap(entry_a, entry_b, verbosity=verbosity)
+        if user_total_overlaps and show_name:
+            overlap_data = {
+                'first': first_entry.first_name,
+                'last': first_entry.last_name,
+                'total': user_total_overlaps,
             }
-        data_a = make_output_data(entry_a)
+            self.stdout.write('Total overlapping entries for user ' +
+                              '%(first)s %(last)s: %(total)d' % overlap_data)
+        return user_total_overlaps
+
+    def make_output_data(self, entry, iso=False):
+        business = entry.business_short_name or entry.business_name
+        return {
+            'first_name': entry.first_name,
+            'last_name': entry.last_name,
+            'entry': entry.id,
+            'start': entry.start_time.isoformat() if iso else entry.start_time,
+            'end': entry.end_time.isoformat() if iso else entry.end_time,
+            'project': '{0} ({1})'.format(entry.project_name, business),
+        }
+
+    def show_overlap(self, entry_a, entry_b=None, **kwargs):
+        data_a = self.make_output_data(entry_a)
         if entry_b:
-            data_b = make_output_data(entry_b)
+            data_b = self.make_output_data(entry_b)
             output = ('Entry %(entry)d for %(first_name)s %(last_name)s from '
                       '%(start)s to %(end)s on %(project)s overlaps ' % data_a +
                       'entry %(entry)d from %(start)s to %(end)s on '
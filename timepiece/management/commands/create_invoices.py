@@ -0,0 +1,87 @@
+import datetime
+from optparse import make_option
+from timeit import default_timer
+
+from dateutil.relativedelta import relativedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from timepiece import utils
+from timepiece.contracts.models import EntryGroup
+
+
+class Command(BaseCommand):
+    """
+    Management command to invoice the approved entries of every billable
+    project for a billing period.
+    Use ./manage.py create_invoices --help for more details
+    """
+    args = '<username>'
+    help = ("Create an invoice, made by the given user, for each billable "
+            "project with approved entries in the billing period.\n"
+            "Use --help for options.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--to-date',
+                    dest='to_date',
+                    default=None,
+                    help='Last day of the billing period, as YYYY-MM-DD '
+                         '(the end of last month by default)'),
+        make_option('--from-date',
+                    dest='from_date',
+                    default=None,
+                    help='First day of the billing period, as YYYY-MM-DD '
+                         '(all earlier entries by default)'),
+        make_option('--not-invoiced',
+                    action='store_const',
+                    dest='status',
+                    const=EntryGroup.NOT_INVOICED,
+                    default=EntryGroup.INVOICED,
+                    help='Mark the entries as not invoiced'),
+        make_option('-c', '--chunk-size',
+                    dest='chunk_size',
+                    type='int',
+                    default=50,
+                    help='Invoice n projects in each transaction'),
+    )
+
+    def handle(self, *args, **kwargs):
+        verbosity = kwargs.get('verbosity', 1)
+        if len(args) != 1:
+            raise CommandError('Give the username of the invoice creator.')
+        try:
+            user = User.objects.get(username=args[0])
+        except User.DoesNotExist:
+            raise CommandError('No user was found with the username %s' % args[0])
+        to_date = self.parse_date(kwargs['to_date'])
+        if to_date is None:
+            to_date = utils.get_month_start().date() - relativedelta(days=1)
+        from_date = self.parse_date(kwargs['from_date'])
+
+        num_invoices = num_entries = 0
+        began = default_timer()
+        chunks = EntryGroup.objects.create_invoices(
+            user, to_date, from_date, status=kwargs['status'],
+            chunk_size=kwargs['chunk_size'])
+        for results in chunks:
+            for invoice, count, elapsed in results:
+                num_invoices += 1
+                num_entries += count
+                if verbosity >= 1:
+                    self.stdout.write('%s: %d entries in %.3fs' % (
+                        invoice.project, count, elapsed))
+        elapsed = default_timer() - began
+        if verbosity >= 1:
+            self.stdout.write(
+                'Created %d invoices for %d entries in %.3fs (%.1f entries/s)' % (
+                    num_invoices, num_entries, elapsed,
+                    num_entries / elapsed if elapsed else 0))
+
+    def parse_date(self, value):
+        if not value:
+            return None
+        try:
+            return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+        except ValueError:
+            raise CommandError('Invalid date: %s' % value)
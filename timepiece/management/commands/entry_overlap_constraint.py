@@ -0,0 +1,106 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction, DatabaseError
+
+from timepiece import utils
+from timepiece.entries.models import (
+    OVERLAP_CONSTRAINT, OVERLAP_CONSTRAINT_SQL, has_overlap_constraint)
+
+
+# Pairs of a user's closed entries which overlap, as the constraint sees them.
+OVERLAPS_SQL = (
+    'SELECT a.id, b.id FROM timepiece_entry a '
+    'JOIN timepiece_entry b ON a.user_id = b.user_id AND a.id < b.id '
+    'AND a.start_time <= b.end_time AND b.start_time <= a.end_time '
+    'WHERE a.end_time IS NOT NULL AND b.end_time IS NOT NULL '
+    'ORDER BY a.id, b.id LIMIT %s')
+
+
+class Command(BaseCommand):
+    """
+    Management command to check, install or remove the PostgreSQL exclusion
+    constraint which prevents a user's closed entries from overlapping.
+    Use ./manage.py entry_overlap_constraint --help for more details
+    """
+    args = '[check|create|drop|sql]'
+    help = ("Check for overlapping entries and whether the overlap constraint "
+            "is installed (check), install it (create), remove it (drop), or "
+            "print the SQL which installs it (sql), for a database superuser "
+            "to run. See TIMEPIECE_ENTRY_OVERLAP_CONSTRAINT.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--limit',
+                    dest='limit',
+                    type='int',
+                    default=20,
+                    help='List at most n overlapping pairs of entries'),
+    )
+
+    def handle(self, *args, **kwargs):
+        action = args[0] if args else 'check'
+        if len(args) > 1 or action not in ('check', 'create', 'drop', 'sql'):
+            raise CommandError('Give one of check, create, drop or sql.')
+        if action == 'sql':
+            for sql in OVERLAP_CONSTRAINT_SQL:
+                self.stdout.write(sql + ';')
+            return
+        if connection.vendor != 'postgresql':
+            raise CommandError('The overlap constraint requires PostgreSQL.')
+        getattr(self, action + '_constraint')(kwargs['limit'])
+
+    def check_constraint(self, limit):
+        enabled = utils.get_setting('TIMEPIECE_ENTRY_OVERLAP_CONSTRAINT')
+        installed = has_overlap_constraint(refresh=True)
+        self.stdout.write('TIMEPIECE_ENTRY_OVERLAP_CONSTRAINT is %s.' % (
+            'enabled' if enabled else 'disabled'))
+        self.stdout.write('The %s constraint is %s.' % (
+            OVERLAP_CONSTRAINT, 'installed' if installed else 'not installed'))
+        if enabled and not installed:
+            self.stdout.write('Overlaps are only checked by Entry.clean() until '
+                              'the constraint is created.')
+        self.write_overlaps(self.find_overlaps(limit))
+
+    def create_constraint(self, limit):
+        if has_overlap_constraint(refresh=True):
+            self.stdout.write('The %s constraint is already installed.' % OVERLAP_CONSTRAINT)
+            return
+        overlaps = self.find_overlaps(limit)
+        if overlaps:
+            self.write_overlaps(overlaps)
+            raise CommandError(
+                'The constraint can not be created while entries overlap. Fix '
+                'them first; check_entries --all lists them in detail.')
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    for sql in OVERLAP_CONSTRAINT_SQL:
+                        cursor.execute(sql)
+        except DatabaseError as e:
+            raise CommandError(
+                'The constraint could not be created: %s\nCreating the '
+                'btree_gist extension requires a database superuser; they can '
+                'run the statements printed by "entry_overlap_constraint sql".'
+                % str(e).strip())
+        has_overlap_constraint(refresh=True)
+        self.stdout.write('Created the %s constraint.' % OVERLAP_CONSTRAINT)
+
+    def drop_constraint(self, limit):
+        with connection.cursor() as cursor:
+            cursor.execute('ALTER TABLE timepiece_entry DROP CONSTRAINT IF EXISTS %s' %
+                           OVERLAP_CONSTRAINT)
+        has_overlap_constraint(refresh=True)
+        self.stdout.write('Dropped the %s constraint.' % OVERLAP_CONSTRAINT)
+
+    def find_overlaps(self, limit):
+        with connection.cursor() as cursor:
+            cursor.execute(OVERLAPS_SQL, [limit])
+            return cursor.fetchall()
+
+    def write_overlaps(self, overlaps):
+        if not overlaps:
+            self.stdout.write('No entries overlap.')
+            return
+        self.stdout.write('Overlapping entries:')
+        for first, second in overlaps:
+            self.stdout.write('  %d and %d' % (first, second))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from timepiece.entries.models import EntryRollup
+
+
+class Command(BaseCommand):
+    """
+    Management command to rebuild the daily entry rollups from scratch.
+    Use ./manage.py rebuild_rollups --help for more details
+    """
+    help = ("Rebuild the daily totals of entry hours which are used by "
+            "reports when TIMEPIECE_USE_ENTRY_ROLLUPS is enabled.")
+
+    def handle(self, *args, **kwargs):
+        verbosity = kwargs.get('verbosity', 1)
+        count = EntryRollup.objects.rebuild()
+        if verbosity >= 1:
+            self.stdout.write('Rebuilt %d entry rollups.' % count)
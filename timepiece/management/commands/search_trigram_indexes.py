@@ -0,0 +1,113 @@
+from optparse import make_option
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction, DatabaseError
+
+from timepiece.crm.models import Business, Project
+
+
+EXTENSION_SQL = 'CREATE EXTENSION IF NOT EXISTS pg_trgm'
+
+# Django matches icontains lookups against UPPER(column::text) on PostgreSQL,
+# so the indexes are built on that expression.
+INDEX_SQL = 'CREATE INDEX IF NOT EXISTS {0} ON {1} USING gin (UPPER({2}::text) gin_trgm_ops)'
+
+
+def get_indexes(users=False):
+    """
+    Returns the (name, model, column) of each trigram index on the columns
+    searched by the quick search and the user, project and business lookups.
+    The user model belongs to another app, so its indexes are only included
+    if users is True.
+    """
+    indexes = [
+        ('timepiece_search_project_name_trgm', Project, 'name'),
+        ('timepiece_search_business_name_trgm', Business, 'name'),
+        ('timepiece_search_business_short_name_trgm', Business, 'short_name'),
+    ]
+    if users:
+        User = get_user_model()
+        indexes.extend([
+            ('timepiece_search_username_trgm', User, 'username'),
+            ('timepiece_search_first_name_trgm', User, 'first_name'),
+            ('timepiece_search_last_name_trgm', User, 'last_name'),
+            ('timepiece_search_email_trgm', User, 'email'),
+        ])
+    return indexes
+
+
+def get_sql(users=False):
+    """Returns the statements which create the trigram indexes."""
+    qn = connection.ops.quote_name
+    return [EXTENSION_SQL] + [
+        INDEX_SQL.format(name, qn(model._meta.db_table), qn(column))
+        for name, model, column in get_indexes(users)]
+
+
+class Command(BaseCommand):
+    """
+    Management command to check, install or remove the PostgreSQL trigram
+    indexes used by searches.
+    Use ./manage.py search_trigram_indexes --help for more details
+    """
+    args = '[check|create|drop|sql]'
+    help = ("List which of the trigram indexes used by searches are installed "
+            "(check), install them (create), remove them (drop), or print the "
+            "SQL which installs them (sql), for a database superuser to run.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('-u', '--users',
+                    dest='users',
+                    action='store_true',
+                    default=False,
+                    help='Include the indexes on the user table, which '
+                         'belongs to django.contrib.auth'),
+    )
+
+    def handle(self, *args, **kwargs):
+        action = args[0] if args else 'check'
+        if len(args) > 1 or action not in ('check', 'create', 'drop', 'sql'):
+            raise CommandError('Give one of check, create, drop or sql.')
+        if action == 'sql':
+            for sql in get_sql(kwargs['users']):
+                self.stdout.write(sql + ';')
+            return
+        if connection.vendor != 'postgresql':
+            raise CommandError('Trigram indexes require PostgreSQL.')
+        getattr(self, action + '_indexes')(kwargs['users'])
+
+    def check_indexes(self, users):
+        installed = self.get_installed()
+        for name, model, column in get_indexes(users):
+            self.stdout.write('%s is %s.' % (
+                name, 'installed' if name in installed else 'not installed'))
+
+    def create_indexes(self, users):
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    for sql in get_sql(users):
+                        cursor.execute(sql)
+        except DatabaseError as e:
+            raise CommandError(
+                'The indexes could not be created: %s\nCreating the pg_trgm '
+                'extension requires a database superuser; they can run the '
+                'statements printed by "search_trigram_indexes sql".'
+                % str(e).strip())
+        self.stdout.write('Created the trigram indexes.')
+
+    def drop_indexes(self, users):
+        installed = self.get_installed()
+        with connection.cursor() as cursor:
+            for name, model, column in get_indexes(users):
+                if name in installed:
+                    cursor.execute('DROP INDEX %s' % connection.ops.quote_name(name))
+                    self.stdout.write('Dropped %s.' % name)
+
+    def get_installed(self):
+        names = [name for name, model, column in get_indexes(users=True)]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT indexname FROM pg_indexes WHERE indexname = ANY(%s)', [names])
+            return set(row[0] for row in cursor.fetchall())
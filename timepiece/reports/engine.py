@@ -0,0 +1,292 @@
+"""
+A small pivot engine for reports on entry hours.
+
+A Report declares the dimensions to group rows by, the grain of its date
+columns, the measures to total and the entries to include. It is computed
+with a single GROUP BY query, and the results are arranged into a dense
+Pivot with totals for each row and column.
+"""
+from collections import namedtuple, OrderedDict
+import datetime
+from decimal import Decimal
+
+from django.db.models import Case, DecimalField, Q, Sum, When
+
+from timepiece import utils
+from timepiece.entries.models import Entry
+from timepiece.reports.utils import find_overtime, generate_dates
+
+
+Dimension = namedtuple('Dimension', ['key', 'labels', 'ordering'])
+
+DIMENSIONS = {
+    'user': Dimension(
+        'user', ('user__first_name', 'user__last_name'),
+        ('user__last_name', 'user__first_name', 'user')),
+    'project': Dimension(
+        'project', ('project__name',), ('project__name', 'project')),
+    'activity': Dimension(
+        'activity', ('activity__name',), ('activity__name', 'activity')),
+    'business': Dimension(
+        'project__business', ('project__business__name',),
+        ('project__business__name', 'project__business')),
+    'project_type': Dimension(
+        'project__type', ('project__type__label',),
+        ('project__type__label', 'project__type')),
+}
+
+MEASURES = ('total', 'billable', 'non_billable', 'leave')
+
+GRAINS = ('day', 'week', 'month', 'year')
+
+
+def _order_by(dimension):
+    """
+    Returns the fields to order a dimension's rows by in the database. The
+    key is ordered by its id: ordering by the foreign key itself would follow
+    the related model's Meta.ordering, which Django 1.8 can't do for Project.
+    """
+    return [field + '__id' if field == dimension.key else field
+            for field in dimension.ordering]
+
+
+def _as_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return value
+
+
+class Report(object):
+    """
+    Declares a pivot of entry hours:
+
+    rows -- names of the DIMENSIONS to group rows by, outermost first.
+    grain -- one of GRAINS to total each date period in its own column, or
+        None for a single column.
+    measures -- names of the MEASURES to total in each cell.
+    filters -- Q objects which the entries must match.
+    start, end -- when given with a grain, every period between these dates
+        gets a column, even if it has no hours.
+    entries -- the Entry queryset to report on (all entries by default).
+    """
+
+    def __init__(self, rows=(), grain=None, measures=('total',), filters=(),
+                 start=None, end=None, entries=None):
+        unknown = [name for name in rows if name not in DIMENSIONS]
+        unknown += [name for name in measures if name not in MEASURES]
+        if grain is not None and grain not in GRAINS:
+            unknown.append(grain)
+        if unknown:
+            raise ValueError('Unknown report option(s): {0}'.format(
+                ', '.join(unknown)))
+        self.rows = tuple(rows)
+        self.grain = grain
+        self.measures = tuple(measures)
+        self.filters = [f for f in filters if f is not None]
+        self.start = start
+        self.end = end
+        self.entries = Entry.no_join.all() if entries is None else entries
+
+    def get_columns(self):
+        """Returns the column dates, if they don't depend on the results."""
+        if self.grain and self.start and self.end:
+            dates = generate_dates(self.start, self.end, by=self.grain)
+            return [_as_date(date) for date in dates]
+        return None
+
+    def get_values(self):
+        values = []
+        for name in self.rows:
+            dimension = DIMENSIONS[name]
+            values.append(dimension.key)
+            values.extend(dimension.labels)
+        return values
+
+    def get_queryset(self):
+        """
+        Returns the values queryset which totals each measure for every
+        combination of row dimensions and date period.
+        """
+        entries = self.entries.filter(*self.filters)
+        values = self.get_values()
+        rollups = entries.get_rollups(values)
+        if rollups is not None:
+            qs = rollups
+            date_sql = 'day::timestamp'
+        else:
+            qs = entries
+            date_sql = '{0}.end_time'.format(Entry._meta.db_table)
+        billableQ = Q(project__type__billable=True, activity__billable=True)
+        leave_ids = utils.get_setting('TIMEPIECE_PAID_LEAVE_PROJECTS').values()
+        leaveQ = Q(project__in=leave_ids) if leave_ids else None
+        conditions = {
+            'billable': billableQ,
+            'non_billable': ~billableQ,
+            'leave': leaveQ,
+        }
+
+        ordering = [field for name in self.rows
+                    for field in _order_by(DIMENSIONS[name])]
+        if self.grain:
+            qs = qs.extra(select={
+                'date': "DATE_TRUNC('{0}', {1})".format(self.grain, date_sql),
+            })
+            values.append('date')
+            ordering.append('date')
+
+        aggregates = {}
+        for measure in self.measures:
+            if measure == 'total':
+                aggregates['total_hours'] = Sum('hours')
+            elif conditions[measure] is not None:
+                aggregates[measure + '_hours'] = Sum(Case(
+                    When(conditions[measure], then='hours'),
+                    output_field=DecimalField()))
+        return qs.values(*values).annotate(**aggregates).order_by(*ordering)
+
+    def run(self):
+        """Runs the report's query and returns its Pivot."""
+        return Pivot.from_results(self, self.get_queryset())
+
+
+class PivotRow(object):
+    """
+    A row of a Pivot. keys and labels map each row dimension to its value
+    (e.g., the user pk) and display name, and values holds the fields they
+    came from. cells holds a dictionary of measure totals for each column,
+    and totals holds the row's totals.
+    """
+
+    def __init__(self, keys, labels, values, cells, totals):
+        self.keys = keys
+        self.labels = labels
+        self.values = values
+        self.cells = cells
+        self.totals = totals
+
+    @property
+    def key(self):
+        return list(self.keys.values())[-1] if self.keys else None
+
+    @property
+    def label(self):
+        return list(self.labels.values())[-1] if self.labels else ''
+
+    def get(self, measure):
+        """Returns the row's values for a measure, one per column."""
+        return [cell[measure] for cell in self.cells]
+
+
+class Pivot(object):
+    """
+    The dense results of a Report: a row for every combination of row
+    dimensions that has hours, with a cell for every column, along with the
+    totals of each column and the grand totals.
+    """
+
+    def __init__(self, dimensions, columns, measures):
+        self.dimensions = tuple(dimensions)
+        self.columns = columns
+        self.measures = measures
+        self.rows = []
+        self.totals = [self._empty() for column in columns]
+        self.total = self._empty()
+        self.num_results = 0
+        self._rows = {}
+
+    @classmethod
+    def from_results(cls, report, results):
+        results = list(results)
+        columns = report.get_columns()
+        if columns is None:
+            if report.grain:
+                columns = sorted(set(_as_date(r['date']) for r in results))
+            else:
+                columns = [None]
+        pivot = cls(report.rows, columns, report.measures)
+        pivot.num_results = len(results)
+        index = dict((column, i) for i, column in enumerate(columns))
+        for result in results:
+            i = index.get(_as_date(result['date'])) if report.grain else 0
+            hours = dict((measure, result.get(measure + '_hours'))
+                         for measure in report.measures)
+            pivot.add(result, i, hours)
+        return pivot
+
+    def _empty(self):
+        return dict((measure, Decimal('0')) for measure in self.measures)
+
+    def add(self, values, i, hours):
+        """
+        Adds hours (a dictionary of measure totals) to column i of the row
+        for the given dimension values. If i is None, the row is included but
+        no hours are added, because they fall outside the report's columns.
+        """
+        key = tuple(values[DIMENSIONS[name].key] for name in self.dimensions)
+        row = self._rows.get(key)
+        if row is None:
+            row = self._rows[key] = self._make_row(values)
+            self.rows.append(row)
+        if i is None:
+            return
+        for measure in self.measures:
+            value = hours.get(measure) or Decimal('0')
+            row.cells[i][measure] += value
+            row.totals[measure] += value
+            self.totals[i][measure] += value
+            self.total[measure] += value
+
+    def _make_row(self, values):
+        keys, labels, fields = [], [], {}
+        for name in self.dimensions:
+            dimension = DIMENSIONS[name]
+            keys.append((name, values[dimension.key]))
+            label = ' '.join(values[field] or '' for field in dimension.labels)
+            labels.append((name, label.strip()))
+            for field in (dimension.key,) + dimension.labels:
+                fields[field] = values[field]
+        cells = [self._empty() for column in self.columns]
+        return PivotRow(OrderedDict(keys), OrderedDict(labels), fields, cells,
+                        self._empty())
+
+    def rollup(self, dimensions):
+        """
+        Returns a Pivot of the same results grouped by only some of the row
+        dimensions, without querying the database again.
+        """
+        pivot = Pivot(dimensions, self.columns, self.measures)
+        pivot.num_results = self.num_results
+        for row in self.rows:
+            for i, cell in enumerate(row.cells):
+                pivot.add(row.values, i, cell)
+        ordering = [field for name in dimensions
+                    for field in DIMENSIONS[name].ordering]
+        pivot.rows.sort(key=lambda row: [
+            (row.values[field] is None, row.values[field]) for field in ordering])
+        return pivot
+
+    def get_totals(self, measure):
+        """Returns the column totals for a measure."""
+        return [totals[measure] for totals in self.totals]
+
+    def table(self, measure, rows=None, total_column=False, overtime=False):
+        """
+        Returns (rows, totals) for one measure, in the form used by the
+        report templates: each row is (label, key, values), where empty
+        values are ''. Only the given rows are included and totaled, if
+        rows is given.
+        """
+        rows = self.rows if rows is None else rows
+        totals = [Decimal('0') for column in self.columns]
+        table_rows = []
+        for row in rows:
+            values = row.get(measure)
+            totals = [t + v for t, v in zip(totals, values)]
+            if total_column:
+                values.append(row.totals[measure])
+            if overtime:
+                values.append(find_overtime(values))
+            table_rows.append((row.label, row.key, [v or '' for v in values]))
+        if total_column:
+            totals.append(sum(totals))
+        return table_rows, [t or '' for t in totals]
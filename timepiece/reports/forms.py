@@ -62,10 +62,18 @@ class ProductivityReportForm(forms.Form):
         ('user', 'User'),
     )
     project = selectable.AutoCompleteSelectField(ProjectLookup)
+    compare = selectable.AutoCompleteSelectMultipleField(
+        ProjectLookup, label='Compare With', required=False)
     organize_by = forms.ChoiceField(
         choices=ORGANIZE_BY_CHOICES, widget=forms.RadioSelect(),
         initial=ORGANIZE_BY_CHOICES[0][0])
 
+    def get_projects(self):
+        """Returns the project, followed by any projects to compare it with."""
+        project = self.cleaned_data['project']
+        compare = self.cleaned_data.get('compare') or []
+        return [project] + [p for p in compare if p != project]
+
 
 class HourlyReportForm(DateForm):
     TRUNC_CHOICES = (
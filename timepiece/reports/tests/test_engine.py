@@ -0,0 +1,83 @@
+import datetime
+from decimal import Decimal
+
+from django.db.models import Q
+from django.test import override_settings
+
+from timepiece import utils
+from timepiece.tests.base import LogTimeMixin
+
+from timepiece.reports.engine import Report
+from timepiece.reports.tests.base import ReportsTestBase
+
+
+class TestReportEngine(LogTimeMixin, ReportsTestBase):
+
+    def setUp(self):
+        super(TestReportEngine, self).setUp()
+        self.day1 = utils.add_timezone(datetime.datetime(2011, 1, 3, 8))
+        self.day3 = utils.add_timezone(datetime.datetime(2011, 1, 5, 8))
+        self.log_time(project=self.p1, start=self.day1, delta=(2, 0))
+        self.log_time(project=self.p2, start=self.day3, delta=(1, 0),
+                      user=self.user2)
+        self.log_time(project=self.sick, start=self.day3, delta=(3, 0))
+
+    def test_dense_matrix(self):
+        """Every column gets a cell, and rows and columns are totaled."""
+        report = Report(rows=('user',), grain='day',
+                        measures=('total', 'billable', 'leave'),
+                        start=self.day1, end=self.day3)
+        with self.assertNumQueries(1):
+            pivot = report.run()
+        self.assertEqual(pivot.columns, [datetime.date(2011, 1, day)
+                                         for day in (3, 4, 5)])
+        rows = dict((row.key, row) for row in pivot.rows)
+        self.assertEqual(set(rows), set([self.user.pk, self.user2.pk]))
+        row = rows[self.user.pk]
+        self.assertEqual(row.label, self.user.get_full_name())
+        self.assertEqual(row.get('total'), [2, 0, 3])
+        self.assertEqual(row.get('billable'), [2, 0, 0])
+        self.assertEqual(row.get('leave'), [0, 0, 3])
+        self.assertEqual(row.totals['total'], Decimal('5'))
+        self.assertEqual(pivot.get_totals('total'), [2, 0, 4])
+        self.assertEqual(pivot.total, {
+            'total': Decimal('6'), 'billable': Decimal('2'),
+            'leave': Decimal('3')})
+
+    def test_table(self):
+        """Tables leave empty cells blank, as the report templates expect."""
+        report = Report(rows=('project_type', 'project'), grain='day',
+                        filters=[Q(user=self.user)],
+                        start=self.day1, end=self.day3)
+        rows, totals = report.run().table('total', total_column=True)
+        self.assertEqual(sorted(rows, key=lambda row: row[1]), [
+            (self.sick.name, self.sick.pk, ['', '', Decimal('3'), Decimal('3')]),
+            (self.p1.name, self.p1.pk, [Decimal('2'), '', '', Decimal('2')]),
+        ])
+        self.assertEqual(totals, [2, '', 3, 5])
+
+    def test_rollup(self):
+        """Rolled up pivots regroup the same results without a query."""
+        pivot = Report(rows=('user', 'project'), grain='week',
+                       start=self.day1, end=self.day3).run()
+        with self.assertNumQueries(0):
+            by_user = pivot.rollup(('user',))
+        self.assertEqual(pivot.num_results, 3)
+        rows = dict((row.key, row.get('total')) for row in by_user.rows)
+        self.assertEqual(rows, {self.user.pk: [5], self.user2.pk: [1]})
+        self.assertEqual(by_user.get_totals('total'), [6])
+
+    @override_settings(TIMEPIECE_USE_ENTRY_ROLLUPS=True)
+    def test_rollups_follow_leave_projects(self):
+        """Paid leave is looked up from the setting when reading rollups."""
+        report = Report(rows=('user',), measures=('leave',),
+                        filters=[Q(user=self.user)],
+                        start=self.day1, end=self.day3)
+        self.assertEqual(report.run().total['leave'], Decimal('3'))
+        leave = {'sick': self.p1.pk}
+        with self.settings(TIMEPIECE_PAID_LEAVE_PROJECTS=leave):
+            self.assertEqual(report.run().total['leave'], Decimal('2'))
+
+    def test_unknown_option(self):
+        self.assertRaises(ValueError, Report, rows=('planet',))
+        self.assertRaises(ValueError, Report, grain='fortnight')
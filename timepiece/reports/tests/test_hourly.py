@@ -10,7 +10,7 @@ from timepiece import utils
 
 from timepiece.entries.models import Entry
 from timepiece.reports.tests.base import ReportsTestBase
-from timepiece.reports.utils import get_project_totals, generate_dates
+from timepiece.reports.engine import Report
 from timepiece.tests.base import ViewTestMixin, LogTimeMixin
 
 
@@ -63,16 +63,14 @@ class TestHourlyReport(ViewTestMixin, LogTimeMixin, ReportsTestBase):
     def test_trunc_day(self):
         self.check_truncs('day', 3, 2)
 
-    def get_project_totals(self, date_headers, trunc, query=Q(),
+    def get_project_totals(self, start, end, trunc, query=Q(),
                            hour_type='total'):
-        """Helper function for testing project_totals utility directly"""
-        entries = Entry.objects.date_trunc(trunc).filter(query)
-        if entries:
-            pj_totals = get_project_totals(entries, date_headers, hour_type)
-            pj_totals = list(pj_totals)
-            rows = pj_totals[0][0]
+        """Returns the hours of each user, and the totals, by trunc."""
+        pivot = Report(rows=('user',), grain=trunc, measures=(hour_type,),
+                       filters=[query], start=start, end=end).run()
+        if pivot.rows:
+            rows, totals = pivot.table(hour_type)
             hours = [hours for name, user_id, hours in rows]
-            totals = pj_totals[0][1]
             return hours, totals
         else:
             return ''
@@ -92,8 +90,7 @@ class TestHourlyReport(ViewTestMixin, LogTimeMixin, ReportsTestBase):
         end = utils.add_timezone(datetime.datetime(2011, 1, 3))
         self.log_daily(start, day2, end)
         trunc = 'day'
-        date_headers = generate_dates(start, end, trunc)
-        pj_totals = self.get_project_totals(date_headers, trunc)
+        pj_totals = self.get_project_totals(start, end, trunc)
         self.assertEqual(pj_totals[0][0],
                          [Decimal('1.00'), Decimal('1.50'), ''])
         self.assertEqual(pj_totals[0][1],
@@ -109,14 +106,13 @@ class TestHourlyReport(ViewTestMixin, LogTimeMixin, ReportsTestBase):
         trunc = 'day'
         billableQ = Q(project__type__billable=True)
         non_billableQ = Q(project__type__billable=False)
-        date_headers = generate_dates(start, end, trunc)
-        pj_billable = self.get_project_totals(date_headers, trunc, Q(),
+        pj_billable = self.get_project_totals(start, end, trunc, Q(),
                                               'billable')
-        pj_billable_q = self.get_project_totals(date_headers, trunc, billableQ,
+        pj_billable_q = self.get_project_totals(start, end, trunc, billableQ,
                                                 'total')
-        pj_non_billable = self.get_project_totals(date_headers, trunc, Q(),
+        pj_non_billable = self.get_project_totals(start, end, trunc, Q(),
                                                   'non_billable')
-        pj_non_billable_q = self.get_project_totals(date_headers, trunc,
+        pj_non_billable_q = self.get_project_totals(start, end, trunc,
                                                     non_billableQ, 'total')
         self.assertEqual(list(pj_billable), list(pj_billable_q))
         self.assertEqual(list(pj_non_billable), list(pj_non_billable_q))
@@ -126,8 +122,7 @@ class TestHourlyReport(ViewTestMixin, LogTimeMixin, ReportsTestBase):
         end = utils.add_timezone(datetime.datetime(2011, 1, 6))
         self.bulk_entries(start, end)
         trunc = 'week'
-        date_headers = generate_dates(start, end, trunc)
-        pj_totals = self.get_project_totals(date_headers, trunc)
+        pj_totals = self.get_project_totals(start, end, trunc)
         self.assertEqual(pj_totals[0][0], [48])
         self.assertEqual(pj_totals[0][1], [24])
         self.assertEqual(pj_totals[1], [72])
@@ -144,8 +139,7 @@ class TestHourlyReport(ViewTestMixin, LogTimeMixin, ReportsTestBase):
                 day = utils.add_timezone(datetime.datetime(2011, month, day))
                 self.log_time(start=day, delta=(worked1, 0), user=self.user)
                 self.log_time(start=day, delta=(worked2, 0), user=self.user2)
-        date_headers = generate_dates(start, end, trunc)
-        pj_totals = self.get_project_totals(date_headers, trunc)
+        pj_totals = self.get_project_totals(start, end, trunc)
         for hour in pj_totals[0][0]:
             self.assertEqual(hour, last_day * worked1)
         for hour in pj_totals[0][1]:
@@ -4,14 +4,19 @@ from decimal import Decimal
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import Permission, User
+from django.db import connection
+from django.db.models import Q
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from timepiece import utils
 from timepiece.tests import factories
 from timepiece.tests.base import ViewTestMixin, LogTimeMixin
 
+from timepiece.crm.timesheet import Timesheet
 from timepiece.entries.models import Entry
-from timepiece.reports.utils import find_overtime
+from timepiece.reports.engine import Report
+from timepiece.reports.utils import find_overtime, get_payroll_totals
 
 
 class PayrollTest(ViewTestMixin, LogTimeMixin, TestCase):
@@ -279,6 +284,77 @@ class PayrollTest(ViewTestMixin, LogTimeMixin, TestCase):
 
         self.assertEquals(totals['grand_total'], Decimal('230.00'))
 
+    def testMonthlyPayrollQueries(self):
+        """
+        The monthly summary is built from two grouped queries, however many
+        users and labels there are. Users with only leave are left out.
+        """
+        self.billable_project = factories.BillableProject()
+        self.nonbillable_project = factories.NonbillableProject()
+        self.all_logs(self.user, self.billable_project, self.nonbillable_project)
+        self.all_logs(self.user2, self.billable_project, self.nonbillable_project)
+        leave_only = factories.User()
+        self.make_entry(leave_only, self.middle, (8, 0), project=self.sick)
+        monthQ = Q(end_time__gt=self.first, end_time__lt=self.next)
+        leaveQ = Q(project__in=[self.sick.pk, self.vacation.pk])
+        statusQ = Q(status__in=[Entry.APPROVED, Entry.INVOICED])
+        with self.assertNumQueries(2):
+            work = Report(rows=('user', 'project_type'),
+                          measures=('billable', 'non_billable'),
+                          filters=[monthQ, statusQ, ~leaveQ]).run()
+            leave = Report(rows=('user', 'project'), filters=[monthQ, leaveQ]).run()
+            labels, rows = get_payroll_totals(work, leave)
+        self.assertEqual(set(row['user_id'] for row in rows[:-1]),
+                         set([self.user.pk, self.user2.pk]))
+        self.assertEqual(rows[-1]['name'], 'Totals')
+        self.assertEqual(rows[-1]['leave'][-1]['hours'], Decimal('120.00'))
+
+    def testPayrollSummaryQueryCount(self):
+        """
+        The payroll summary takes as many queries for twenty times the
+        users, project types and unapproved hours.
+        """
+        def add_users(count):
+            for i in range(count):
+                user = factories.User()
+                project = factories.BillableProject()
+                self.make_entry(user, self.first_week, (4, 0), project=project)
+                self.make_entry(user, self.middle, (2, 0), status=Entry.VERIFIED,
+                                project=project)
+                self.make_entry(user, self.middle, (1, 0), status=Entry.UNVERIFIED,
+                                project=factories.NonbillableProject())
+                self.make_entry(user, self.last, (8, 0), project=self.sick)
+
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(self.url, self.args)
+            self.assertEqual(response.status_code, 200)
+            return len(queries), len(response.context['monthly_totals'])
+
+        self.login_user(self.superuser)
+        add_users(2)
+        queries, rows = count_queries()
+        self.assertEqual(rows, 2 + 1)
+        add_users(38)
+        self.assertEqual(count_queries(), (queries, 40 + 1))
+
+    def testMonthlyPayrollSnapshots(self):
+        """Users' snapshots give the same monthly totals as their entries."""
+        self.billable_project = factories.BillableProject()
+        self.nonbillable_project = factories.NonbillableProject()
+        self.all_logs(self.user, self.billable_project, self.nonbillable_project)
+        self.all_logs(self.user2, self.billable_project, self.nonbillable_project)
+        Entry.no_join.filter(user=self.user2, status=Entry.VERIFIED).update(
+            status=Entry.APPROVED)
+        self.login_user(self.superuser)
+        response = self.client.get(self.url, self.args)
+        with self.settings(TIMEPIECE_TIMESHEET_SNAPSHOTS=True):
+            self.assertTrue(Timesheet(self.user2, self.first, self.next).capture())
+            self.assertFalse(Timesheet(self.user, self.first, self.next).capture())
+            snapshot_response = self.client.get(self.url, self.args)
+        for key in ('labels', 'monthly_totals'):
+            self.assertEqual(snapshot_response.context[key], response.context[key])
+
     def testNoPermission(self):
         """
         Regular users shouldn't be able to retrieve the payroll report
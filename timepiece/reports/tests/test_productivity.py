@@ -4,7 +4,9 @@ from dateutil.relativedelta import relativedelta
 import json
 
 from django.contrib.auth.models import Permission
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from timepiece.tests.base import ViewTestMixin
 from timepiece.tests import factories
@@ -185,6 +187,41 @@ class TestProductivityReport(ViewTestMixin, TestCase):
         self._check_row(report[2], ['User 2', 4.0, 4.0])
         self._check_row(report[3], ['User 3', 4.0, 0.0])
 
+    def test_compare_projects(self):
+        """Several projects are reported side by side."""
+        other = factories.Project()
+        factories.ProjectHours(user=self.users[2], week_start=self.weeks[3],
+                               project=other, hours=3)
+        data = {'project_1': self.project.pk, 'compare_1': [other.pk],
+                'organize_by': 'week'}
+        response = self._get(data=data)
+        form, report, organize_by, worked, assigned = self._unpack(response)
+        self.assertEqual(len(form.errors), 0)
+        self.assertEqual(report[0][1:], [
+            '{0} Worked Hours'.format(self.project.name),
+            '{0} Assigned Hours'.format(self.project.name),
+            '{0} Worked Hours'.format(other.name),
+            '{0} Assigned Hours'.format(other.name),
+        ])
+        self.assertEqual(float(worked), 8.0)
+        self.assertEqual(float(assigned), 11.0)
+        self.assertEqual(report[4][0], u'Oct 15, 2012')
+        self.assertEqual([float(h) for h in report[4][1:]], [4.0, 0.0, 0.0, 3.0])
+
+    def test_query_count(self):
+        """The number of queries doesn't grow with the project's lifetime."""
+        data = {'project_1': self.project.pk, 'organize_by': 'week'}
+        with CaptureQueriesContext(connection) as queries:
+            self._get(data=data)
+        start_time = self.weeks[3] + relativedelta(years=3)
+        factories.Entry(user=self.users[1], project=self.project,
+                        start_time=start_time,
+                        end_time=start_time + relativedelta(hours=2))
+        with self.assertNumQueries(len(queries)):
+            response = self._get(data=data)
+        report = json.loads(response.context['report'])
+        self.assertEqual(len(report), 1 + 4 + 52 * 3)
+
     def test_export(self):
         """Data should be exported in CSV format."""
         data = {'project_1': self.project.pk, 'organize_by': 'week',
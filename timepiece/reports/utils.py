@@ -1,34 +1,10 @@
-import datetime
 from dateutil import rrule
 from dateutil.relativedelta import relativedelta
+from collections import OrderedDict
 from decimal import Decimal
-from itertools import groupby
 
 from timepiece.utils import (
-    get_hours_summary, add_timezone, get_week_start, get_month_start,
-    get_year_start)
-
-
-def date_totals(entries, by):
-    """Yield a user's name and a dictionary of their hours"""
-    date_dict = {}
-    for date, date_entries in groupby(entries, lambda x: x['date']):
-        if isinstance(date, datetime.datetime):
-            date = date.date()
-        d_entries = list(date_entries)
-
-        if by == 'user':
-            name = ' '.join((d_entries[0]['user__first_name'],
-                             d_entries[0]['user__last_name']))
-        elif by == 'project':
-            name = d_entries[0]['project__name']
-        else:
-            name = d_entries[0][by]
-
-        pk = d_entries[0][by]
-        hours = get_hours_summary(d_entries)
-        date_dict[date] = hours
-    return name, pk, date_dict
+    add_timezone, get_week_start, get_month_start, get_year_start)
 
 
 def find_overtime(dates):
@@ -54,48 +30,13 @@ def generate_dates(start=None, end=None, by='week'):
         return rrule.rrule(rrule.DAILY, dtstart=start, until=end)
 
 
-def get_project_totals(entries, date_headers, hour_type=None, overtime=False,
-                       total_column=False, by='user'):
-    """
-    Yield hour totals grouped by user and date. Optionally including overtime.
-    """
-    totals = [0 for date in date_headers]
-    rows = []
-    for thing, thing_entries in groupby(entries, lambda x: x[by]):
-        name, thing_id, date_dict = date_totals(thing_entries, by)
-        dates = []
-        for index, day in enumerate(date_headers):
-            if isinstance(day, datetime.datetime):
-                day = day.date()
-            if hour_type:
-                total = date_dict.get(day, {}).get(hour_type, 0)
-                dates.append(total)
-            else:
-                billable = date_dict.get(day, {}).get('billable', 0)
-                nonbillable = date_dict.get(day, {}).get('non_billable', 0)
-                total = billable + nonbillable
-                dates.append({
-                    'day': day,
-                    'billable': billable,
-                    'nonbillable': nonbillable,
-                    'total': total
-                })
-            totals[index] += total
-        if total_column:
-            dates.append(sum(dates))
-        if overtime:
-            dates.append(find_overtime(dates))
-        dates = [date or '' for date in dates]
-        rows.append((name, thing_id, dates))
-    if total_column:
-        totals.append(sum(totals))
-    totals = [t or '' for t in totals]
-    yield (rows, totals)
-
-
-def get_payroll_totals(month_work_entries, month_leave_entries):
+def get_payroll_totals(work, leave):
     """Summarizes monthly work and leave totals, grouped by user.
 
+    work is a Pivot of billable and non_billable hours with rows by user and
+    project type, and leave is a Pivot of total hours with rows by user and
+    project. Only users with work hours are included.
+
     Returns (labels, rows).
         labels -> {'billable': [proj_labels], 'nonbillable': [proj_labels]}
         rows -> [{
@@ -111,43 +52,59 @@ def get_payroll_totals(month_work_entries, month_leave_entries):
     The last entry in each of the billable/nonbillable/leave lists contains a
     summary of the status. The last row contains sum totals for all other rows.
     """
-    def _get_user_info(entries):
-        """Helper for getting the associated user's first and last name."""
-        fname = entries[0].get('user__first_name', '') if entries else ''
-        lname = entries[0].get('user__last_name', '') if entries else ''
-        name = '{0} {1}'.format(fname, lname).strip()
-        user_id = entries[0].get('user', None) if entries else None
-        return {'name': name, 'user_id': user_id}
+    work_statuses = ('billable', 'nonbillable')
+    leave_statuses = ('leave', )
+    statuses = work_statuses + leave_statuses
+    labels = dict((status, []) for status in statuses)
+    columns = dict((status, {}) for status in statuses)
 
     def _get_index(status, label):
+        """Returns the column for the label, adding it if it is new."""
+        index = columns[status].get(label)
+        if index is None:
+            index = columns[status][label] = len(labels[status])
+            labels[status].append(label)
+        return index
+
+    # A single pass over each set of results records each user's hours by
+    # column, as the number of columns isn't known until the end.
+    users = OrderedDict()
+    for row in work.rows:
+        user = users.get(row.keys['user'])
+        if user is None:
+            user = users[row.keys['user']] = {
+                'name': row.labels['user'], 'user_id': row.keys['user'],
+                'hours': dict((status, {}) for status in statuses),
+            }
+        label = row.labels['project_type']
+        for status, measure in zip(work_statuses, ('billable', 'non_billable')):
+            if row.totals[measure]:
+                index = _get_index(status, label)
+                hours = user['hours'][status]
+                hours[index] = hours.get(index, Decimal()) + row.totals[measure]
+    for row in leave.rows:
+        user = users.get(row.keys['user'])
+        if user is not None:
+            index = _get_index('leave', row.labels['project'])
+            hours = user['hours']['leave']
+            hours[index] = hours.get(index, Decimal()) + row.totals['total']
+
+    def _construct_row(name, user_id=None, hours=None):
         """
-        Returns the index in row[status] (where row is the row corresponding
-        to the current user) where hours for the project label should be
-        recorded.
-
-        If the label does not exist, then it is added to the labels list.
-        Each row and the totals row is updated accordingly.
-
-        Requires that labels, rows, and totals are in scope.
+        Constructs a row from hours by column, where the last entry of each
+        status is its summary.
         """
-        if label in labels[status]:
-            return labels[status].index(label)
-        # Otherwise: update labels, rows, and totals to reflect the addition.
-        labels[status].append(label)
-        for row in rows:
-            row[status].insert(-1, {'hours': Decimal(), 'percent': Decimal()})
-        totals[status].insert(-1, {'hours': Decimal(), 'percent': Decimal()})
-        return len(labels[status]) - 1
-
-    def _construct_row(name, user_id=None):
-        """Constructs an empty row for the given name."""
         row = {'name': name, 'user_id': user_id}
-        for status in labels.keys():
-            # Include an extra entry for summary.
-            row[status] = [{'hours': Decimal(), 'percent': Decimal()}
-                           for i in range(len(labels[status]) + 1)]
-        row['work_total'] = Decimal()
-        row['grand_total'] = Decimal()
+        for status in statuses:
+            values = [Decimal() for label in labels[status]]
+            for index, value in (hours or {}).get(status, {}).items():
+                values[index] = value
+            values.append(sum(values, Decimal()))
+            row[status] = [{'hours': value, 'percent': Decimal()}
+                           for value in values]
+        row['work_total'] = _get_sum(row, work_statuses)
+        row['leave_total'] = _get_sum(row, leave_statuses)
+        row['grand_total'] = row['work_total'] + row['leave_total']
         return row
 
     def _add_percentages(row, statuses, total):
@@ -162,54 +119,40 @@ def get_payroll_totals(month_work_entries, month_leave_entries):
         """Sum the number of hours worked in given statuses."""
         return sum([row[status][-1]['hours'] for status in statuses])
 
-    work_statuses = ('billable', 'nonbillable')
-    leave_statuses = ('leave', )
-    labels = dict([(status, []) for status in work_statuses + leave_statuses])
-    rows = []
+    rows = [_construct_row(**user) for user in users.values()]
     totals = _construct_row('Totals')
-    for user, work_entries in groupby(month_work_entries, lambda e: e['user']):
-
-        work_entries = list(work_entries)
-        row = _construct_row(**_get_user_info(work_entries))
-        rows.append(row)
-        for entry in work_entries:
-            status = 'billable' if entry['billable'] else 'nonbillable'
-            label = entry['project__type__label']
-            index = _get_index(status, label)
-            hours = entry['hours']
-            row[status][index]['hours'] += hours
-            row[status][-1]['hours'] += hours
-            totals[status][index]['hours'] += hours
-            totals[status][-1]['hours'] += hours
-
-        leave_entries = month_leave_entries.filter(user=user)
-        status = 'leave'
-        for entry in leave_entries:
-            label = entry.get('project__name')
-            index = _get_index(status, label)
-            hours = entry.get('hours')
-            row[status][index]['hours'] += hours
-            row[status][-1]['hours'] += hours
-            totals[status][index]['hours'] += hours
-            totals[status][-1]['hours'] += hours
-
+    for row in rows:
+        for status in statuses:
+            for total, entry in zip(totals[status], row[status]):
+                total['hours'] += entry['hours']
+    for row in rows + [totals]:
         row['work_total'] = _get_sum(row, work_statuses)
         _add_percentages(row, work_statuses, row['work_total'])
         row['leave_total'] = _get_sum(row, leave_statuses)
         _add_percentages(row, leave_statuses, row['leave_total'])
         row['grand_total'] = row['work_total'] + row['leave_total']
 
-    totals['work_total'] = _get_sum(totals, work_statuses)
-    _add_percentages(totals, work_statuses, totals['work_total'])
-    totals['leave_total'] = _get_sum(totals, leave_statuses)
-    _add_percentages(totals, leave_statuses, totals['leave_total'])
-    totals['grand_total'] = totals['work_total'] + totals['leave_total']
-
     if rows:
         rows.append(totals)
     return labels, rows
 
 
+def add_snapshot_totals(work, leave, snapshots):
+    """
+    Adds the monthly work and leave totals of users' timesheet snapshots, a
+    dictionary of snapshot data keyed by user, to the pivots given to
+    get_payroll_totals. Returns the combined (work, leave) pivots, in order.
+    """
+    for user, data in snapshots.items():
+        values = {'user': user.pk, 'user__first_name': user.first_name,
+                  'user__last_name': user.last_name}
+        for totals in data['work_totals']:
+            work.add(dict(values, **totals), 0, totals)
+        for totals in data['leave_totals']:
+            leave.add(dict(values, **totals), 0, totals)
+    return work.rollup(work.dimensions), leave.rollup(leave.dimensions)
+
+
 def get_week_window(day=None):
     """Returns (Monday, Sunday) of the requested week."""
     start = get_week_start(day)
@@ -1,4 +1,5 @@
 import csv
+from decimal import Decimal
 import json
 
 from collections import OrderedDict
@@ -6,7 +7,7 @@ from dateutil.relativedelta import relativedelta
 from itertools import groupby
 
 from django.contrib.auth.decorators import permission_required
-from django.db.models import Sum, Q, Min, Max
+from django.db.models import Sum, Q
 from django.http import HttpResponse
 from django.shortcuts import render
 from django.template.defaultfilters import date as date_format_filter
@@ -18,12 +19,13 @@ from timepiece import utils
 from timepiece.utils.csv import CSVViewMixin, DecimalEncoder
 
 from timepiece.contracts.models import ProjectContract
-from timepiece.entries.models import Entry, ProjectHours
+from timepiece.entries.models import Entry, ProjectHours, TimesheetSnapshot
 from timepiece.reports.forms import (
     BillableHoursReportForm, HourlyReportForm, ProductivityReportForm,
     PayrollSummaryReportForm)
+from timepiece.reports.engine import Report
 from timepiece.reports.utils import (
-    get_project_totals, get_payroll_totals, generate_dates, get_week_window)
+    add_snapshot_totals, get_payroll_totals, generate_dates, get_week_window)
 
 
 class ReportMixin(object):
@@ -44,10 +46,10 @@ class ReportMixin(object):
             entryQ = self.get_entry_query(start, end, data)
             trunc = data['trunc']
             if entryQ:
-                vals = ('pk', 'activity', 'project', 'project__name',
+                vals = ('activity', 'project', 'project__name',
                         'project__status', 'project__type__label')
-                entries = Entry.objects.date_trunc(
-                    trunc, extra_values=vals).filter(entryQ)
+                entries = Entry.objects.filter(entryQ).date_trunc(
+                    trunc, extra_values=vals)
             else:
                 entries = Entry.objects.none()
 
@@ -58,6 +60,7 @@ class ReportMixin(object):
                 'to_date': end,
                 'date_headers': date_headers,
                 'entries': entries,
+                'entry_query': entryQ,
                 'filter_form': form,
                 'trunc': trunc,
             })
@@ -67,6 +70,7 @@ class ReportMixin(object):
                 'to_date': None,
                 'date_headers': [],
                 'entries': Entry.objects.none(),
+                'entry_query': None,
                 'filter_form': form,
                 'trunc': '',
             })
@@ -153,14 +157,13 @@ class HourlyReport(ReportMixin, CSVViewMixin, TemplateView):
     template_name = 'timepiece/reports/hourly.html'
 
     def convert_context_to_csv(self, context):
-        """Convert the context dictionary into a CSV file."""
-        content = []
+        """Convert the context dictionary into the rows of a CSV file."""
         date_headers = context['date_headers']
 
         headers = ['Name']
         headers.extend([date.strftime('%m/%d/%Y') for date in date_headers])
         headers.append('Total')
-        content.append(headers)
+        yield headers
 
         summaries = context['summaries']
 
@@ -170,11 +173,10 @@ class HourlyReport(ReportMixin, CSVViewMixin, TemplateView):
             for name, user_id, hours in rows:
                 data = [name]
                 data.extend(hours)
-                content.append(data)
+                yield data
             total = ['Totals']
             total.extend(totals)
-            content.append(total)
-        return content
+            yield total
 
     @property
     def defaults(self):
@@ -201,30 +203,27 @@ class HourlyReport(ReportMixin, CSVViewMixin, TemplateView):
         context = super(HourlyReport, self).get_context_data(**kwargs)
 
         # Sum the hours totals for each user & interval.
-        entries = context['entries']
+        entryQ = context['entry_query']
         date_headers = context['date_headers']
 
         summaries = []
-        if context['entries']:
-            summaries.append(('By User', get_project_totals(
-                entries.order_by('user__last_name', 'user__id', 'date'),
-                date_headers, 'total', total_column=True, by='user')))
-
-            entries = entries.order_by('project__type__label', 'project__name',
-                                       'project__id', 'date')
-            func = lambda x: x['project__type__label']
-            for label, group in groupby(entries, func):
+        if entryQ:
+            # Both tables are rolled up from a single set of results.
+            pivot = Report(rows=('user', 'project_type', 'project'),
+                           grain=context['trunc'], filters=[entryQ],
+                           start=context['from_date'],
+                           end=context['to_date']).run()
+            by_user = pivot.rollup(('user',))
+            if by_user.rows:
+                summaries.append(('By User', [
+                    by_user.table('total', total_column=True)]))
+
+            by_project = pivot.rollup(('project_type', 'project'))
+            func = lambda row: row.labels['project_type']
+            for label, group in groupby(by_project.rows, func):
                 title = label + ' Projects'
-                summaries.append((
-                    title,
-                    get_project_totals(
-                        list(group),
-                        date_headers,
-                        'total',
-                        total_column=True,
-                        by='project',
-                    ),
-                ))
+                summaries.append((title, [
+                    by_project.table('total', list(group), total_column=True)]))
 
         # Adjust date headers & create range headers.
         from_date = context['from_date']
@@ -274,13 +273,11 @@ class BillableHours(ReportMixin, TemplateView):
     def get_context_data(self, **kwargs):
         context = super(BillableHours, self).get_context_data(**kwargs)
 
-        entries = context['entries']
-        date_headers = context['date_headers']
-        data_map = self.get_hours_data(entries, date_headers)
-
         from_date = context['from_date']
         to_date = context['to_date']
         trunc = context['trunc']
+        data_map = self.get_hours_data(
+            context['entry_query'], from_date, to_date, trunc)
         kwargs = {trunc + 's': 1}  # For relativedelta
 
         keys = sorted(data_map.keys())
@@ -311,21 +308,19 @@ class BillableHours(ReportMixin, TemplateView):
             # Select all available users, activities, and project types.
             return BillableHoursReportForm(self.defaults, select_all=True)
 
-    def get_hours_data(self, entries, date_headers):
+    def get_hours_data(self, entryQ, from_date, to_date, trunc):
         """Sum billable and non-billable hours across all users."""
-        project_totals = get_project_totals(
-            entries, date_headers, total_column=False) if entries else []
-
         data_map = {}
-        for rows, totals in project_totals:
-            for user, user_id, periods in rows:
-                for period in periods:
-                    day = period['day']
-                    if day not in data_map:
-                        data_map[day] = {'billable': 0, 'nonbillable': 0}
-                    data_map[day]['billable'] += period['billable']
-                    data_map[day]['nonbillable'] += period['nonbillable']
-
+        if not entryQ:
+            return data_map
+        pivot = Report(grain=trunc, measures=('billable', 'non_billable'),
+                       filters=[entryQ], start=from_date, end=to_date).run()
+        if pivot.rows:
+            for day, totals in zip(pivot.columns, pivot.totals):
+                data_map[day] = {
+                    'billable': totals['billable'],
+                    'nonbillable': totals['non_billable'],
+                }
         return data_map
 
 
@@ -350,19 +345,22 @@ def report_payroll_summary(request):
     workQ = ~Q(project__in=projects.values())
     statusQ = Q(status=Entry.INVOICED) | Q(status=Entry.APPROVED)
     # Weekly totals
-    week_entries = Entry.objects.date_trunc('week').filter(
-        weekQ, statusQ, workQ
-    )
     date_headers = generate_dates(from_date, last_billable, by='week')
-    weekly_totals = list(get_project_totals(week_entries, date_headers,
-                                            'total', overtime=True))
-    # Monthly totals
-    leave = Entry.objects.filter(monthQ, ~workQ)
-    leave = leave.values('user', 'hours', 'project__name')
-    extra_values = ('project__type__label',)
-    month_entries = Entry.objects.date_trunc('month', extra_values)
-    month_entries_valid = month_entries.filter(monthQ, statusQ, workQ)
-    labels, monthly_totals = get_payroll_totals(month_entries_valid, leave)
+    weekly = Report(rows=('user',), grain='week', filters=[weekQ, statusQ, workQ],
+                    start=from_date, end=last_billable).run()
+    weekly_totals = [weekly.table('total', overtime=True)]
+    # Monthly totals, from the snapshots of users' approved months if
+    # there are any.
+    snapshots = TimesheetSnapshot.objects.get_user_data(from_date)
+    snapshotQ = ~Q(user__in=[user.pk for user in snapshots]) if snapshots else Q()
+    work = Report(rows=('user', 'project_type'),
+                  measures=('billable', 'non_billable'),
+                  filters=[monthQ, statusQ, workQ, snapshotQ]).run()
+    leave = Report(rows=('user', 'project'),
+                   filters=[monthQ, ~workQ, snapshotQ]).run()
+    if snapshots:
+        work, leave = add_snapshot_totals(work, leave, snapshots)
+    labels, monthly_totals = get_payroll_totals(work, leave)
     # Unapproved and unverified hours
     entries = Entry.objects.filter(monthQ).order_by()  # No ordering
     user_values = ['user__pk', 'user__first_name', 'user__last_name']
@@ -382,6 +380,64 @@ def report_payroll_summary(request):
     })
 
 
+def get_productivity(projects, organize_by):
+    """
+    Returns a row of worked and assigned hours for each of the projects, in
+    turn, for every week of their combined time range or for every user who
+    worked on or was assigned to any of them. Worked and assigned hours are
+    each totaled with one grouped query, and joined on the week or user.
+    """
+    by_week = organize_by == 'week'
+    columns = dict((project.pk, 2 * i) for i, project in enumerate(projects))
+    hours = {}
+    names = {}
+
+    def _add(key, project, offset, value):
+        if key not in hours:
+            hours[key] = [Decimal('0')] * (2 * len(projects))
+        hours[key][columns[project] + offset] += value or 0
+
+    actualsQ = Q(project__in=columns.keys(), end_time__isnull=False)
+    actuals = Report(rows=('project',) if by_week else ('project', 'user'),
+                     grain='week' if by_week else None,
+                     filters=[actualsQ]).run()
+    for row in actuals.rows:
+        if by_week:
+            for week, cell in zip(actuals.columns, row.cells):
+                if cell['total']:
+                    _add(week, row.keys['project'], 0, cell['total'])
+        else:
+            names[row.keys['user']] = row.labels['user']
+            _add(row.keys['user'], row.keys['project'], 0, row.totals['total'])
+
+    fields = ['project'] + (
+        ['week_start'] if by_week else ['user', 'user__first_name', 'user__last_name'])
+    projections = ProjectHours.objects.filter(project__in=columns.keys())
+    projections = projections.values(*fields).annotate(hours=Sum('hours'))
+    for projection in projections.order_by():
+        if by_week:
+            _add(projection['week_start'], projection['project'], 1,
+                 projection['hours'])
+        else:
+            names[projection['user']] = '{0} {1}'.format(
+                projection['user__first_name'], projection['user__last_name'])
+            _add(projection['user'], projection['project'], 1,
+                 projection['hours'])
+
+    report = []
+    if by_week:
+        # Every week of the time range gets a row, even if it has no hours.
+        current, latest = (min(hours), max(hours)) if hours else (None, None)
+        while hours and current <= latest:
+            report.append([date_format_filter(current, 'M j, Y')] + hours.get(
+                current, [Decimal('0')] * (2 * len(projects))))
+            current += relativedelta(days=7)
+    else:
+        users = sorted(hours, key=lambda user: names[user].replace(' ', '').lower())
+        report = [[names[user]] + hours[user] for user in users]
+    return report
+
+
 @permission_required('entries.view_entry_summary')
 def report_productivity(request):
     report = []
@@ -389,65 +445,24 @@ def report_productivity(request):
 
     form = ProductivityReportForm(request.GET or None)
     if form.is_valid():
-        project = form.cleaned_data['project']
+        projects = form.get_projects()
         organize_by = form.cleaned_data['organize_by']
         export = request.GET.get('export', False)
 
-        actualsQ = Q(project=project, end_time__isnull=False)
-        actuals = Entry.objects.filter(actualsQ)
-        projections = ProjectHours.objects.filter(project=project)
-        entry_count = actuals.count() + projections.count()
-
-        if organize_by == 'week' and entry_count > 0:
-            # Determine the project's time range.
-            amin, amax, pmin, pmax = (None, None, None, None)
-            if actuals.count() > 0:
-                amin = list(actuals.aggregate(Min('start_time')).values())[0]
-                amin = utils.get_week_start(amin).date()
-                amax = list(actuals.aggregate(Max('start_time')).values())[0]
-                amax = utils.get_week_start(amax).date()
-            if projections.count() > 0:
-                pmin = list(projections.aggregate(Min('week_start')).values())[0]
-                pmax = list(projections.aggregate(Max('week_start')).values())[0]
-            current = min(amin, pmin) if (amin and pmin) else (amin or pmin)
-            latest = max(amax, pmax) if (amax and pmax) else (amax or pmax)
-
-            # Report for each week during the project's time range.
-            while current <= latest:
-                next_week = current + relativedelta(days=7)
-                actual_hours = actuals.filter(start_time__gte=current, start_time__lt=next_week)
-                actual_hours = list(actual_hours.aggregate(Sum('hours')).values())[0]
-                projected_hours = projections.filter(
-                    week_start__gte=current, week_start__lt=next_week)
-                projected_hours = list(projected_hours.aggregate(Sum('hours')).values())[0]
-                report.append([date_format_filter(current, 'M j, Y'),
-                              actual_hours or 0, projected_hours or 0])
-                current = next_week
-
-        elif organize_by == 'user' and entry_count > 0:
-            # Determine all users who worked on or were assigned to the
-            # project.
-            vals = ('user', 'user__first_name', 'user__last_name')
-            ausers = list(actuals.values_list(*vals).distinct())
-            pusers = list(projections.values_list(*vals).distinct())
-            key = lambda x: (x[1] + x[2]).lower()  # Sort by name
-            users = sorted(list(set(ausers + pusers)), key=key)
-
-            # Report for each user.
-            for user in users:
-                name = '{0} {1}'.format(user[1], user[2])
-                actual_hours = actuals.filter(user=user[0])
-                actual_hours = list(actual_hours.aggregate(Sum('hours')).values())[0]
-                projected_hours = projections.filter(user=user[0])
-                projected_hours = list(projected_hours.aggregate(Sum('hours')).values())[0]
-                report.append([name, actual_hours or 0, projected_hours or 0])
-
-        col_headers = [organize_by.title(), 'Worked Hours', 'Assigned Hours']
+        report = get_productivity(projects, organize_by)
+        if len(projects) == 1:
+            col_headers = [organize_by.title(), 'Worked Hours', 'Assigned Hours']
+        else:
+            col_headers = [organize_by.title()]
+            for project in projects:
+                col_headers.extend(['{0} Worked Hours'.format(project.name),
+                                    '{0} Assigned Hours'.format(project.name)])
         report.insert(0, col_headers)
 
         if export:
             response = HttpResponse(content_type='text/csv')
-            filename = '{0}_productivity'.format(project.name)
+            filename = '{0}_productivity'.format(
+                '_'.join(project.name for project in projects))
             content_disp = 'attachment; filename={0}.csv'.format(filename)
             response['Content-Disposition'] = content_disp
             writer = csv.writer(response)
@@ -459,8 +474,8 @@ def report_productivity(request):
         'form': form,
         'report': json.dumps(report, cls=DecimalEncoder),
         'type': organize_by or '',
-        'total_worked': sum([r[1] for r in report[1:]]),
-        'total_assigned': sum([r[2] for r in report[1:]]),
+        'total_worked': sum([sum(r[1::2]) for r in report[1:]]),
+        'total_assigned': sum([sum(r[2::2]) for r in report[1:]]),
     })
 
 
@@ -472,7 +487,7 @@ def report_estimation_accuracy(request):
     contracts = ProjectContract.objects.filter(
         status=ProjectContract.STATUS_COMPLETE,
         type=ProjectContract.PROJECT_FIXED
-    )
+    ).with_metrics()
     data = [('Target (hrs)', 'Actual (hrs)', 'Point Label')]
     for c in contracts:
         if c.contracted_hours() == 0:
@@ -6,6 +6,16 @@ var all_users = new UserCollection();
 
 var project_hours = new ProjectHoursCollection();
 
+var bulk_url;
+
+// The projects and users used for autocompletion are kept between page
+// loads, and the server only sends them again when they have changed.
+var REFERENCE_KEY = 'timepiece.schedule.reference';
+
+// Changed cells are saved together, shortly after the last change.
+var pending_changes = [],
+    flush_timer = null;
+
 function showError(msg) {
     var html = '<div class="alert alert-error">' + msg +
         '<a class="close" data-dismiss="alert" href="#">&times;</a></div>';
@@ -24,6 +34,7 @@ function processData(data) {
     if(typeof ajax_url === 'undefined') {
         ajax_url = data.ajax_url;
     }
+    bulk_url = data.bulk_url;
 
     // Store all projects for autocomplete
     for(var i = 0; i < all_projects.length; i++) {
@@ -120,6 +131,26 @@ function updateTotals(col, data) {
     }
 }
 
+function loadReference() {
+    try {
+        return JSON.parse(window.localStorage.getItem(REFERENCE_KEY)) || {};
+    } catch(e) {
+        return {};
+    }
+}
+
+function saveReference(data) {
+    try {
+        window.localStorage.setItem(REFERENCE_KEY, JSON.stringify({
+            version: data.reference_version,
+            all_projects: data.all_projects,
+            all_users: data.all_users
+        }));
+    } catch(e) {
+        // Storage is unavailable or full; the data is sent on every load.
+    }
+}
+
 // Entry point to load all data into the table
 function getData(week_start) {
     if(!week_start) {
@@ -127,11 +158,95 @@ function getData(week_start) {
         week_start = d.getFullYear() + '-' + (d.getMonth() + 1) + '-' + d.getDate();
     }
 
-    $.getJSON(ajax_url, { week_start: week_start }, function(data, status, xhr) {
+    var reference = loadReference(),
+        params = { week_start: week_start, reference: reference.version || '' };
+
+    $.getJSON(ajax_url, params, function(data, status, xhr) {
+        if(data.all_projects) {
+            saveReference(data);
+        } else {
+            data.all_projects = reference.all_projects;
+            data.all_users = reference.all_users;
+        }
         processData(data);
     });
 }
 
+// Queues the hours of a user on a project to be saved for the week being
+// shown. Zero hours removes them. success is called with the saved hours, if
+// any. A cell that is changed again before the changes are saved is only
+// saved once, with its latest hours; error still restores it to the value it
+// had before its first change.
+function saveHours(user, project, hours, success, error) {
+    var week_start = $('h2[data-date]').data('date'),
+        key = week_start + '-' + user.id + '-' + project.id,
+        item = {
+            key: key,
+            week_start: week_start,
+            change: { user: user.id, project: project.id, hours: hours },
+            success: success,
+            error: error
+        };
+
+    for(var i = 0; i < pending_changes.length; i++) {
+        if(pending_changes[i].key === key) {
+            item.error = pending_changes[i].error;
+            pending_changes.splice(i, 1);
+            break;
+        }
+    }
+    pending_changes.push(item);
+
+    clearTimeout(flush_timer);
+    flush_timer = setTimeout(flushChanges, 250);
+}
+
+// Saves the queued changes, with one request for each week they were made in.
+function flushChanges() {
+    var weeks = {}, week_start;
+
+    for(var i = 0; i < pending_changes.length; i++) {
+        week_start = pending_changes[i].week_start;
+        weeks[week_start] = weeks[week_start] || [];
+        weeks[week_start].push(pending_changes[i]);
+    }
+    pending_changes = [];
+
+    for(week_start in weeks) {
+        postChanges(week_start, weeks[week_start]);
+    }
+}
+
+function postChanges(week_start, batch) {
+    $.ajax({
+        type: 'POST',
+        url: bulk_url,
+        contentType: 'application/json',
+        dataType: 'json',
+        data: JSON.stringify({
+            week_start: week_start,
+            changes: $.map(batch, function(item) { return item.change; })
+        }),
+        success: function(data, status, xhr) {
+            var saved = {}, i;
+
+            for(i = 0; i < data.project_hours.length; i++) {
+                var ph = data.project_hours[i];
+                saved[ph.user + '-' + ph.project] = ph;
+            }
+            for(i = 0; i < batch.length; i++) {
+                var change = batch[i].change;
+                batch[i].success(saved[change.user + '-' + change.project]);
+            }
+        },
+        error: function(xhr, status, error) {
+            for(var i = 0; i < batch.length; i++) {
+                batch[i].error();
+            }
+        }
+    });
+}
+
 function ajax(url, data, success, error, type) {
     $.ajax({
         type: type,
@@ -254,19 +369,14 @@ $(function() {
 
                 if(time && hours && time > 0) {
                     // If we have times and hours in the row/col, then update the current hours
-                    $.post(ajax_url, {
-                        'project': hours.project.id,
-                        'user': hours.user.id,
-                        'hours': time,
-                        'week_start': $('h2[data-date]').data('date')
-                    }, function(data, status, xhr) {
+                    saveHours(hours.user, hours.project, time, function(ph) {
                         var diff = time - hours.hours;
                         updateTotals(col, diff);
 
                         hours.hours = time;
                         hours.published = false;
                         $('.dataTable').handsontable('setDataAtCell', row, col, time);
-                    }, function(xhr, status, error) {
+                    }, function() {
                         $('.dataTable').handsontable('setDataAtCell', row, col, before);
                         showError('Could not save the project hours. Please notify an administrator.');
                     });
@@ -277,19 +387,14 @@ $(function() {
                     user = users.get_by_col(col);
 
                     if(project && user && before === '') {
-                        $.post(ajax_url, {
-                            'user': user.id,
-                            'project': project.id,
-                            'hours': time,
-                            'week_start': $('h2[data-date]').data('date')
-                        }, function(data, status, xhr) {
-                            hours = new ProjectHours(parseInt(data, 10), time, project, false);
+                        saveHours(user, project, time, function(ph) {
+                            hours = new ProjectHours(ph.id, time, project, false);
                             hours.user = user;
                             hours.row = project.row;
                             hours.col = user.col;
                             project_hours.add(hours);
                             updateTotals(col, time);
-                        }, function(xhr, status, error) {
+                        }, function() {
                             $('.dataTable').handsontable('setDataAtCell', row, col, '');
                             showError('Could not save the project hours. Please notify an administrator.');
                         });
@@ -348,12 +453,12 @@ $(function() {
                     }
                 } else if(row >= 1 && col >= 1) {
                     function deleteHours() {
-                        $.del(ajax_url + hours.id + '/', function(data, status, xhr) {
+                        saveHours(hours.user, hours.project, 0, function() {
                             updateTotals(col, -hours.hours);
 
                             project_hours.remove(hours);
                             $('.dataTable').handsontable('setDataAtCell', row, col, '');
-                        }, function(xhr, status, error) {
+                        }, function() {
                             $('.dataTable').handsontable('setDataAtCell', row, col, before);
                             showError('Could not delete the project hours. Please notify an administrator.');
                         });
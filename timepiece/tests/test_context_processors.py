@@ -0,0 +1,96 @@
+import datetime
+
+from django.test import TestCase, override_settings
+from django.test.client import RequestFactory
+
+from timepiece.context_processors import quick_clock_in
+
+from . import factories
+
+
+class QuickClockInTestCase(TestCase):
+
+    def setUp(self):
+        self.user = factories.User()
+        self.request = RequestFactory().get('/')
+        self.request.user = self.user
+        self.start = datetime.datetime(2016, 3, 1, 8)
+
+    def trackable_project(self, **kwargs):
+        return factories.Project(
+            type__enable_timetracking=True,
+            status__enable_timetracking=True, **kwargs)
+
+    def log_time(self, project, days):
+        start_time = self.start + datetime.timedelta(days=days)
+        return factories.Entry(user=self.user, project=project,
+                               start_time=start_time,
+                               end_time=start_time + datetime.timedelta(hours=1))
+
+    def get_projects(self):
+        context = quick_clock_in(self.request)
+        return list(context['work_projects']), list(context['leave_projects'])
+
+    def test_recent_projects(self):
+        """The 10 most recently used trackable projects are listed."""
+        projects = [self.trackable_project() for i in range(12)]
+        for i, project in enumerate(projects):
+            self.log_time(project, days=i)
+        self.log_time(projects[0], days=12)
+        leave = self.trackable_project()
+        self.log_time(leave, days=20)
+        factories.ProjectRelationship(user=self.user, project=leave)
+        self.log_time(factories.Project(), days=21)
+        leave_projects = {'sick': leave.pk}
+        with self.settings(TIMEPIECE_PAID_LEAVE_PROJECTS=leave_projects):
+            with self.assertNumQueries(2):
+                work_projects, leave_projects = self.get_projects()
+        self.assertEqual(work_projects, [projects[0]] + projects[11:2:-1])
+        self.assertEqual(leave_projects, [leave])
+
+    def test_lazy(self):
+        """The projects are not looked up unless they are used."""
+        with self.assertNumQueries(0):
+            quick_clock_in(self.request)
+
+    @override_settings(
+        CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        TIMEPIECE_QUICK_CLOCK_IN_CACHE='default',
+        TIMEPIECE_PAID_LEAVE_PROJECTS={})
+    def test_cached(self):
+        """The projects are cached until the user's entries change."""
+        project = self.trackable_project()
+        self.log_time(project, days=0)
+        self.assertEqual(self.get_projects(), ([project], []))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_projects(), ([project], []))
+        other = self.trackable_project()
+        self.log_time(other, days=1)
+        self.assertEqual(self.get_projects(), ([other, project], []))
+        factories.ProjectRelationship(user=self.user, project=other)
+        with self.assertNumQueries(1):
+            self.get_projects()
+
+    @override_settings(
+        CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        TIMEPIECE_QUICK_CLOCK_IN_CACHE='default')
+    def test_cache_forgotten(self):
+        """The cached projects are discarded when the projects change."""
+        project = self.trackable_project(name='Old')
+        self.log_time(project, days=0)
+        self.get_projects()
+        project.name = 'New'
+        project.save()
+        self.assertEqual(self.get_projects()[0][0].name, 'New')
+        project.status.enable_timetracking = False
+        project.status.save()
+        self.assertEqual(self.get_projects(), ([], []))
+
+        leave = self.trackable_project()
+        factories.ProjectRelationship(user=self.user, project=leave)
+        with self.settings(TIMEPIECE_PAID_LEAVE_PROJECTS={'sick': leave.pk}):
+            self.assertEqual(self.get_projects(), ([], [leave]))
+            leave.project_relationships.all().delete()
+            self.assertEqual(self.get_projects(), ([], []))
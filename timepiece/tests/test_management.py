@@ -1,10 +1,19 @@
+import datetime
+import json
+
 from dateutil.relativedelta import relativedelta
+from six import StringIO
 
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.utils import timezone
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 
 from timepiece import utils
 from timepiece.management.commands import check_entries
+from timepiece.contracts.models import EntryGroup
+from timepiece.entries import models as entry_models
 from timepiece.entries.models import Entry
 
 from . import factories
@@ -196,3 +205,292 @@ class CheckEntries(TestCase):
                 self.assertEqual(
                     total_overlaps, num_days * len(self.all_users))
                 return
+
+    def testCheckEntryNested(self):
+        """
+        An entry that lies entirely within another one overlaps it, even when
+        later entries start before the outer entry ends.
+        """
+        start = self.good_start - relativedelta(days=70)
+        self.make_entry(start_time=start, end_time=start + relativedelta(hours=4))
+        self.make_entry(start_time=start + relativedelta(hours=1))
+        self.make_entry(start_time=start + relativedelta(hours=2))
+        self.make_entry(start_time=start + relativedelta(hours=5))
+        command = check_entries.Command()
+        entries = next(command.find_entries(
+            command.find_users('first1'), start, 'first1'))
+        self.assertEqual(command.check_entry(entries, verbosity=0), 2)
+
+    def testCheckEntriesJson(self):
+        """With --json, the command writes a machine-readable report."""
+        self.make_entry(start_time=self.good_start - relativedelta(days=2, minutes=5),
+                        end_time=self.good_start - relativedelta(days=2) +
+                        relativedelta(hours=1))
+        self.make_entry(start_time=self.good_start - relativedelta(days=2))
+        out = StringIO()
+        call_command('check_entries', json=True, stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['total'], 1)
+        self.assertEqual(len(report['users']), 1)
+        self.assertEqual(report['users'][0]['user'], self.user.pk)
+        self.assertEqual(report['users'][0]['total'], 1)
+
+    def testSharedEndpoints(self):
+        """
+        Entries which share a start or end time overlap; entries which only
+        touch don't.
+        """
+        start = self.good_start - relativedelta(days=70)
+
+        def row(begin, end):
+            return check_entries.EntryRow(
+                None, self.user.pk, '', '', start + relativedelta(hours=begin),
+                start + relativedelta(hours=end), 0, '', '', '')
+
+        self.assertTrue(check_entries.rows_overlap(row(0, 2), row(0, 2)))
+        self.assertTrue(check_entries.rows_overlap(row(0, 2), row(0, 1)))
+        self.assertTrue(check_entries.rows_overlap(row(0, 2), row(1, 2)))
+        self.assertFalse(check_entries.rows_overlap(row(0, 2), row(2, 3)))
+        rows = [row(0, 2), row(0, 2), row(2, 3)]
+        self.assertEqual(len(list(check_entries.find_overlaps(rows))), 1)
+
+
+class CheckEntriesParallel(TransactionTestCase):
+    """The worker processes must see committed entries."""
+
+    def testWorkers(self):
+        """--workers reports the same overlaps as a serial check."""
+        start = timezone.now() - relativedelta(days=3, hour=8, minute=0,
+                                               second=0, microsecond=0)
+        for i in range(5):
+            user = factories.User(first_name='first%d' % (5 - i), last_name='last')
+            for hours in (0, 1, 2):
+                factories.Entry(user=user, start_time=start + relativedelta(hours=hours),
+                                end_time=start + relativedelta(hours=hours + 2))
+
+        def report(**kwargs):
+            out = StringIO()
+            call_command('check_entries', json=True, stdout=out, **kwargs)
+            return json.loads(out.getvalue())
+
+        serial = report()
+        self.assertEqual(serial['total'], 10)
+        self.assertEqual(report(workers=2), serial)
+
+
+class BenchmarkReports(TestCase):
+
+    def testBenchmarkHourly(self):
+        """Generated entries are timed and then rolled back."""
+        user = factories.User(username='benchmark0')
+        out = StringIO()
+        call_command('benchmark_reports', 'hourly', users=2, days=14, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual([line.split(':')[0] for line in lines],
+                         ['hourly, entries', 'hourly, rollups'])
+        self.assertFalse(Entry.objects.exists())
+        self.assertEqual(list(User.objects.all()), [user])
+
+    def testBenchmarkPayroll(self):
+        """The monthly payroll summary takes two queries, however many users."""
+        leave = {'sick': factories.Project().pk}
+        out = StringIO()
+        with self.settings(TIMEPIECE_PAID_LEAVE_PROJECTS=leave):
+            call_command('benchmark_reports', 'payroll', users=3, days=60, stdout=out)
+        label, result = out.getvalue().strip().split(': ')
+        self.assertEqual(label, 'payroll, monthly')
+        self.assertIn(', 2 queries in ', result)
+        self.assertFalse(Entry.objects.exists())
+
+
+class CreateInvoices(TestCase):
+
+    def setUp(self):
+        super(CreateInvoices, self).setUp()
+        self.user = factories.Superuser()
+        self.billable = [factories.BillableProject() for i in range(3)]
+        self.nonbillable = factories.NonbillableProject()
+        start = utils.add_timezone(datetime.datetime(2011, 1, 3, 8))
+        for project in self.billable + [self.nonbillable]:
+            for days in (0, 1):
+                factories.Entry(
+                    project=project, status=Entry.APPROVED,
+                    start_time=start + relativedelta(days=days),
+                    end_time=start + relativedelta(days=days, hours=2))
+        factories.Entry(
+            project=self.billable[0], status=Entry.VERIFIED,
+            start_time=start, end_time=start + relativedelta(hours=2))
+
+    def testCreateInvoices(self):
+        """Approved entries on billable projects are invoiced in chunks."""
+        out = StringIO()
+        call_command('create_invoices', self.user.username,
+                     to_date='2011-01-31', chunk_size=2, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 3 + 1)
+        self.assertTrue(lines[-1].startswith('Created 3 invoices for 6 entries'))
+        for project in self.billable:
+            invoice = EntryGroup.objects.get(project=project)
+            self.assertEqual(invoice.user, self.user)
+            self.assertEqual(invoice.end, datetime.date(2011, 1, 31))
+            self.assertEqual(
+                set(invoice.entries.values_list('status', flat=True)),
+                set([Entry.INVOICED]))
+        self.assertFalse(EntryGroup.objects.filter(project=self.nonbillable).exists())
+        self.assertEqual(Entry.objects.filter(status=Entry.VERIFIED).count(), 1)
+
+        # Nothing is left to invoice the second time.
+        out = StringIO()
+        call_command('create_invoices', self.user.username,
+                     to_date='2011-01-31', stdout=out)
+        self.assertTrue(out.getvalue().startswith('Created 0 invoices'))
+
+    def testBillingPeriod(self):
+        """Entries outside of the billing period are left alone."""
+        call_command('create_invoices', self.user.username,
+                     from_date='2011-01-04', to_date='2011-01-31',
+                     verbosity=0)
+        self.assertEqual(EntryGroup.objects.count(), 3)
+        self.assertEqual(Entry.objects.filter(status=Entry.INVOICED).count(), 3)
+
+    def testUnknownUser(self):
+        self.assertRaises(CommandError, call_command, 'create_invoices', 'nobody',
+                          verbosity=0)
+
+
+class ChangeTimesheets(TestCase):
+
+    def setUp(self):
+        super(ChangeTimesheets, self).setUp()
+        self.group = factories.Group()
+        self.users = [factories.User() for i in range(3)]
+        for user in self.users:
+            user.groups.add(self.group)
+        self.start = datetime.datetime(2011, 1, 3, 8)
+        for user in self.users[:2]:
+            for days in (0, 1):
+                factories.Entry(
+                    user=user, start_time=self.start + relativedelta(days=days),
+                    end_time=self.start + relativedelta(days=days, hours=2))
+
+    def get_statuses(self, user):
+        return set(Entry.no_join.filter(user=user).values_list('status', flat=True))
+
+    def testVerifyGroup(self):
+        """Users with hours are verified, and the others reported."""
+        out = StringIO()
+        call_command('change_timesheets', 'verify', month='2011-01',
+                     group=self.group.name, chunk_size=2, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 3 + 1)
+        self.assertEqual(len([line for line in lines if '2 entries, 4.00 hours' in line]), 2)
+        self.assertEqual(len([line for line in lines if 'Has no hours to verify' in line]), 1)
+        self.assertTrue(lines[-1].startswith('Verified 2 of 3 time sheets for January 2011'))
+        for user in self.users[:2]:
+            self.assertEqual(self.get_statuses(user), set([Entry.VERIFIED]))
+
+    def testApproveUsers(self):
+        """Only the verified entries of the given users are approved."""
+        Entry.no_join.filter(user=self.users[0]).update(status=Entry.VERIFIED)
+        usernames = ','.join(user.username for user in self.users[:2])
+        call_command('change_timesheets', 'approve', month='2011-01',
+                     users=usernames, verbosity=0)
+        self.assertEqual(self.get_statuses(self.users[0]), set([Entry.APPROVED]))
+        self.assertEqual(self.get_statuses(self.users[1]), set([Entry.UNVERIFIED]))
+
+    def testApproveUnverified(self):
+        """Users who still have unverified entries are not approved."""
+        Entry.no_join.filter(user=self.users[0]).update(status=Entry.VERIFIED)
+        factories.Entry(user=self.users[0], start_time=self.start + relativedelta(days=2),
+                        end_time=self.start + relativedelta(days=2, hours=1))
+        out = StringIO()
+        call_command('change_timesheets', 'approve', month='2011-01',
+                     users=self.users[0].username, stdout=out)
+        self.assertIn('Has unverified entries', out.getvalue())
+        self.assertEqual(self.get_statuses(self.users[0]),
+                         set([Entry.VERIFIED, Entry.UNVERIFIED]))
+
+    def testActiveEntry(self):
+        """Users with an active entry are left alone."""
+        factories.Entry(user=self.users[0], start_time=self.start + relativedelta(days=2),
+                        end_time=None)
+        out = StringIO()
+        call_command('change_timesheets', 'verify', month='2011-01',
+                     users=self.users[0].username, stdout=out)
+        self.assertIn('Has an active entry', out.getvalue())
+        self.assertEqual(self.get_statuses(self.users[0]), set([Entry.UNVERIFIED]))
+
+    def testInvalidArguments(self):
+        self.assertRaises(CommandError, call_command, 'change_timesheets', 'reject',
+                          group=self.group.name, verbosity=0)
+        self.assertRaises(CommandError, call_command, 'change_timesheets', 'verify',
+                          verbosity=0)
+        self.assertRaises(CommandError, call_command, 'change_timesheets', 'verify',
+                          users='nobody', verbosity=0)
+        self.assertRaises(CommandError, call_command, 'change_timesheets', 'verify',
+                          month='January', group=self.group.name, verbosity=0)
+
+
+class EntryOverlapConstraint(TestCase):
+
+    def setUp(self):
+        super(EntryOverlapConstraint, self).setUp()
+        self.user = factories.User()
+        self.start = datetime.datetime(2016, 3, 1, 8)
+
+    def make_entry(self, hours, length=1):
+        start = self.start + relativedelta(hours=hours)
+        return factories.Entry(user=self.user, start_time=start,
+                               end_time=start + relativedelta(hours=length))
+
+    def call(self, *args):
+        out = StringIO()
+        call_command('entry_overlap_constraint', *args, stdout=out)
+        return out.getvalue()
+
+    def testSql(self):
+        self.assertIn('EXCLUDE USING gist', self.call('sql'))
+
+    def testCheck(self):
+        """Overlapping pairs of entries are listed."""
+        first = self.make_entry(0, length=2)
+        second = self.make_entry(1)
+        self.make_entry(3)
+        output = self.call('check')
+        self.assertIn('constraint is not installed', output)
+        self.assertIn('%d and %d' % (first.pk, second.pk), output)
+        second.delete()
+        self.assertIn('No entries overlap', self.call())
+
+    def testCreateWithOverlaps(self):
+        """The constraint isn't created while entries overlap."""
+        self.make_entry(0, length=2)
+        self.make_entry(1)
+        self.assertRaises(CommandError, self.call, 'create')
+        self.assertFalse(entry_models.has_overlap_constraint(refresh=True))
+
+    def testUnknownAction(self):
+        self.assertRaises(CommandError, self.call, 'install')
+
+
+class SearchTrigramIndexes(TestCase):
+
+    def call(self, *args, **kwargs):
+        out = StringIO()
+        call_command('search_trigram_indexes', *args, stdout=out, **kwargs)
+        return out.getvalue()
+
+    def testSql(self):
+        """The user table is only indexed when asked for."""
+        sql = self.call('sql')
+        self.assertIn('gin_trgm_ops', sql)
+        self.assertNotIn('auth_user', sql)
+        self.assertIn('auth_user', self.call('sql', users=True))
+
+    def testCheck(self):
+        output = self.call('check')
+        self.assertIn('timepiece_search_project_name_trgm is not installed', output)
+        self.assertNotIn('username', output)
+
+    def testUnknownAction(self):
+        self.assertRaises(CommandError, self.call, 'install')
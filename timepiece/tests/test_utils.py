@@ -1,8 +1,12 @@
 import datetime
 from decimal import Decimal
 
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+
+from timepiece.entries.models import Entry
 from timepiece.utils import get_active_entry, ActiveEntryError
+from timepiece.utils.csv import iterate_in_chunks
 from timepiece.utils.views import format_totals
 from timepiece import utils
 
@@ -61,6 +65,70 @@ class GetActiveEntryTest(TestCase):
         factories.Entry(user=self.user, start_time=now)
         self.assertRaises(ActiveEntryError, get_active_entry, self.user)
 
+    def test_get_active_entry_memoized(self):
+        """The active entry is only looked up once for a user instance."""
+        entry = factories.Entry(user=self.user, start_time=datetime.datetime.now())
+        with self.assertNumQueries(1):
+            self.assertEqual(entry, get_active_entry(self.user))
+            self.assertEqual(entry, get_active_entry(self.user))
+            self.assertTrue(self.user.clocked_in)
+        entry.end_time = entry.start_time + datetime.timedelta(hours=1)
+        entry.save()
+        self.assertIsNone(get_active_entry(self.user))
+
+    def test_get_active_entry_memo_forgotten(self):
+        """Queryset updates discard the entry memoized on any user instance."""
+        entry = factories.Entry(user=self.user, start_time=datetime.datetime.now())
+        user = User.objects.get(pk=self.user.pk)
+        self.assertEqual(entry, get_active_entry(user))
+        Entry.no_join.filter(pk=entry.pk).update(end_time=entry.start_time)
+        self.assertIsNone(get_active_entry(user))
+
+    @override_settings(
+        CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        TIMEPIECE_ACTIVE_ENTRY_CACHE='default')
+    def test_get_active_entry_cached(self):
+        """The active entry is shared between user instances by the cache."""
+        entry = factories.Entry(user=self.user, start_time=datetime.datetime.now())
+        self.assertEqual(entry, get_active_entry(User.objects.get(pk=self.user.pk)))
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(entry, get_active_entry(user))
+        Entry.no_join.filter(pk=entry.pk).update(end_time=entry.start_time)
+        self.assertIsNone(get_active_entry(User.objects.get(pk=self.user.pk)))
+
+    def test_annotate_clocked_in(self):
+        factories.Entry(user=self.user, start_time=datetime.datetime.now())
+        other = factories.User()
+        users = utils.annotate_clocked_in(User.objects.filter(
+            pk__in=(self.user.pk, other.pk)).order_by('pk'))
+        with self.assertNumQueries(1):
+            clocked_in = [(user.pk, user.clocked_in) for user in users]
+        self.assertEqual(clocked_in, [(self.user.pk, True), (other.pk, False)])
+
+
+class IterateInChunksTest(TestCase):
+
+    def test_iterate_in_chunks(self):
+        """All rows are read, in order, a chunk at a time."""
+        start = datetime.datetime(2016, 1, 4, 8)
+        user = factories.User()
+        entries = []
+        for i in range(5):
+            # Pairs of entries start at the same time, but for different users.
+            start_time = start + datetime.timedelta(hours=i // 2)
+            entries.append(factories.Entry(
+                user=user if i % 2 else factories.User(),
+                start_time=start_time,
+                end_time=start_time + datetime.timedelta(minutes=30)))
+        rows = Entry.no_join.values('id', 'start_time')
+        with self.assertNumQueries(3):
+            ids = [row['id'] for row in iterate_in_chunks(
+                rows, ('start_time', 'id'), chunk_size=2)]
+        expected = sorted(entries, key=lambda e: (e.start_time, e.pk))
+        self.assertEqual(ids, [entry.pk for entry in expected])
+
 
 class FormatTotalsTest(TestCase):
 
@@ -1,13 +1,30 @@
 import datetime
+import uuid
+
 from dateutil.relativedelta import relativedelta
 
 from django.apps import apps
 from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
 from django.utils import timezone
 
 from timepiece.defaults import TimepieceDefaults
 
 
+# Where get_active_entry() memoizes a user's active entry on the instance.
+ACTIVE_ENTRY_ATTR = '_timepiece_active_entry'
+
+# Incremented by forget_active_entries(). Memoized active entries are only
+# used while it is unchanged, so that they are discarded whichever user
+# instance they were memoized on.
+_active_entry_generation = 0
+
+# Changing the value of this cache key discards every user's cached quick
+# clock in projects.
+QUICK_CLOCK_IN_GENERATION_KEY = 'timepiece:quick_clock_in:generation'
+
+
 class ActiveEntryError(Exception):
     """A user should have no more than one active entry at a given time."""
     pass
@@ -29,17 +46,120 @@ def add_timezone(value, tz=None):
 
 
 def get_active_entry(user, select_for_update=False):
-    """Returns the user's currently-active entry, or None."""
+    """
+    Returns the user's currently-active entry, or None.
+
+    The entry is looked up with a single query and memoized on the user
+    instance, so repeated calls for request.user only query once per request.
+    If TIMEPIECE_ACTIVE_ENTRY_CACHE names a cache, the result is also shared
+    between requests through it. Locking reads always use the database.
+    """
+    generation = _active_entry_generation
+    if not select_for_update:
+        memo = user.__dict__.get(ACTIVE_ENTRY_ATTR)
+        if memo is not None and memo[0] == generation:
+            return memo[1]
+        cache = get_active_entry_cache()
+        entry = cache.get(get_active_entry_key(user.pk)) if cache else None
+        if entry is not None:
+            return _remember_active_entry(user, entry or None, generation)
+
     entries = apps.get_model('entries', 'Entry').no_join
     if select_for_update:
         entries = entries.select_for_update()
-    entries = entries.filter(user=user, end_time__isnull=True)
-
-    if not entries.exists():
-        return None
-    if entries.count() > 1:
+    entries = list(entries.filter(user=user, end_time__isnull=True)[:2])
+    if len(entries) > 1:
         raise ActiveEntryError('Only one active entry is allowed.')
-    return entries[0]
+    entry = entries[0] if entries else None
+
+    cache = get_active_entry_cache()
+    if cache:
+        # False marks a user known to have no active entry.
+        cache.set(get_active_entry_key(user.pk), entry or False)
+    return _remember_active_entry(user, entry, generation)
+
+
+def _remember_active_entry(user, entry, generation):
+    if entry is not None:
+        entry.user = user
+    user.__dict__[ACTIVE_ENTRY_ATTR] = (generation, entry)
+    return entry
+
+
+def get_active_entry_cache():
+    """Returns the cache used to share active entries, if there is one."""
+    alias = get_setting('TIMEPIECE_ACTIVE_ENTRY_CACHE')
+    return caches[alias] if alias else None
+
+
+def get_active_entry_key(user_id):
+    return 'timepiece:active_entry:{0}'.format(user_id)
+
+
+def forget_active_entries(users):
+    """
+    Discards the shared active entry of each of the given users (or user
+    pks), after their entries have changed. Every active entry memoized on a
+    user instance is discarded, as other instances of the same users may
+    hold one.
+    """
+    global _active_entry_generation
+    _active_entry_generation += 1
+    cache = get_active_entry_cache()
+    if cache and users:
+        cache.delete_many([get_active_entry_key(getattr(user, 'pk', user))
+                           for user in users])
+
+
+def get_quick_clock_in_cache():
+    """Returns the cache used to share quick clock in projects, if any."""
+    alias = get_setting('TIMEPIECE_QUICK_CLOCK_IN_CACHE')
+    return caches[alias] if alias else None
+
+
+def get_quick_clock_in_key(user_id):
+    """
+    Returns the cache key of the user's quick clock in projects, which
+    changes whenever forget_quick_clock_in() discards every user's.
+    """
+    cache = get_quick_clock_in_cache()
+    generation = cache.get(QUICK_CLOCK_IN_GENERATION_KEY)
+    if generation is None:
+        cache.add(QUICK_CLOCK_IN_GENERATION_KEY, uuid.uuid4().hex, None)
+        generation = cache.get(QUICK_CLOCK_IN_GENERATION_KEY)
+    return 'timepiece:quick_clock_in:{0}:{1}'.format(generation, user_id)
+
+
+def forget_quick_clock_in(users=None):
+    """
+    Discards the cached quick clock in projects of each of the given users
+    (or user pks), after their entries or project relationships have changed.
+    If users is None, every user's are discarded, after projects, or the
+    businesses, types or statuses they are shown or chosen by, have changed.
+    """
+    cache = get_quick_clock_in_cache()
+    if not cache:
+        return
+    if users is None:
+        cache.set(QUICK_CLOCK_IN_GENERATION_KEY, uuid.uuid4().hex, None)
+    elif users:
+        cache.delete_many([get_quick_clock_in_key(getattr(user, 'pk', user))
+                           for user in users])
+
+
+def annotate_clocked_in(users):
+    """
+    Selects whether each of the given users has an active entry, so that
+    user.clocked_in doesn't need a query for every user in a list.
+    """
+    qn = connections[users.db].ops.quote_name
+    entry_table = qn(apps.get_model('entries', 'Entry')._meta.db_table)
+    user_table = qn(users.model._meta.db_table)
+    sql = ('EXISTS (SELECT 1 FROM {entry} WHERE {entry}.{user_id} = '
+           '{user}.{pk} AND {entry}.{end_time} IS NULL)').format(
+        entry=entry_table, user=user_table, user_id=qn('user_id'),
+        pk=qn(users.model._meta.pk.column), end_time=qn('end_time'))
+    return users.extra(select={'clocked_in': sql})
 
 
 def get_hours_summary(entries):
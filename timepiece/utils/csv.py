@@ -4,7 +4,10 @@ import csv
 from decimal import Decimal
 from json import JSONEncoder
 
-from django.http import HttpResponse
+from django.db.models import Q
+from django.http import HttpResponse, StreamingHttpResponse
+
+from timepiece import utils
 
 
 class DecimalEncoder(JSONEncoder):
@@ -15,21 +18,70 @@ class DecimalEncoder(JSONEncoder):
         return super(DecimalEncoder, self).default(obj)
 
 
+class Echo(object):
+    """A file-like object which returns whatever is written to it."""
+
+    def write(self, value):
+        return value
+
+
+def iterate_in_chunks(queryset, keys=('id',), chunk_size=1000):
+    """
+    Yields the results of the queryset, ordered by the given keys, reading
+    chunk_size rows at a time so that memory use doesn't grow with the number
+    of results. Each chunk starts after the last row of the previous chunk,
+    so the keys must identify a row uniquely (e.g., end them with 'id').
+    """
+    queryset = queryset.order_by(*keys)
+    chunk = queryset
+    while True:
+        rows = list(chunk[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        chunk = queryset.filter(_after_row(rows[-1], keys))
+
+
+def _after_row(row, keys):
+    """Returns a query for the rows which sort after the given one."""
+    if isinstance(row, dict):
+        values = [row[key] for key in keys]
+    else:
+        values = [getattr(row, key) for key in keys]
+    query = Q()
+    for i, key in enumerate(keys):
+        after = Q(**{key + '__gt': values[i]})
+        for prev_key, prev_value in zip(keys[:i], values[:i]):
+            after &= Q(**{prev_key: prev_value})
+        query |= after
+    return query
+
+
 class CSVViewMixin(object):
 
     def render_to_response(self, context):
-        response = HttpResponse(content_type='text/csv')
         fn = self.get_filename(context)
-        response['Content-Disposition'] = 'attachment; filename=%s.csv' % fn
         rows = self.convert_context_to_csv(context)
-        writer = csv.writer(response)
-        for row in rows:
-            writer.writerow(row)
+        if utils.get_setting('TIMEPIECE_STREAM_CSV'):
+            # Write each row to the client as it is produced.
+            writer = csv.writer(Echo())
+            response = StreamingHttpResponse(
+                (writer.writerow(row) for row in rows), content_type='text/csv')
+        else:
+            response = HttpResponse(content_type='text/csv')
+            writer = csv.writer(response)
+            for row in rows:
+                writer.writerow(row)
+        response['Content-Disposition'] = 'attachment; filename=%s.csv' % fn
         return response
 
     def get_filename(self, context):
         raise NotImplemented('You must implement this in the subclass')
 
     def convert_context_to_csv(self, context):
-        """Convert the context dictionary into a CSV file."""
+        """
+        Convert the context dictionary into the rows of a CSV file. This may
+        be a generator, so that rows are only read as they are written.
+        """
         raise NotImplemented('You must implement this in the subclass')